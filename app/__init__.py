@@ -48,7 +48,7 @@ def create_app():
             "allow_headers": ["Content-Type", "Authorization", "Accept",
                               "Origin", "X-Requested-With"],
             "supports_credentials": True,
-            "expose_headers": ["Content-Type", "Authorization"],
+            "expose_headers": ["Content-Type", "Authorization", "X-Cursore-Successivo"],
             "max_age": 3600
         }
     })
@@ -58,6 +58,61 @@ def create_app():
     migrate.init_app(app, db)
     login_manager.init_app(app)
 
+    # coda per generare i PDF degli ordini fuori dalla richiesta
+    from app.utils.coda_pdf import coda_pdf
+    app.config['PDF_ASINCRONO'] = os.environ.get('PDF_ASINCRONO', '1') == '1'
+    app.config['PDF_WORKER'] = int(os.environ.get('PDF_WORKER', 2))
+    app.config['PDF_SU_RICHIESTA'] = os.environ.get('PDF_SU_RICHIESTA', '0') == '1'
+    # oltre questo numero di pagine da renderizzare si usa un pool di processi (0 per disattivarlo)
+    app.config['PDF_SOGLIA_PARALLELA'] = int(os.environ.get('PDF_SOGLIA_PARALLELA', 20))
+    app.config['PDF_PROCESSI'] = int(os.environ.get('PDF_PROCESSI', os.cpu_count() or 1))
+    coda_pdf.init_app(app)
+
+    # dove finiscono i PDF: 'cloudinary' oppure 'locale' (cartella servita da /api/biglietti/pdf/)
+    app.config['STORAGE_BIGLIETTI'] = os.environ.get('STORAGE_BIGLIETTI', 'cloudinary')
+    app.config['STORAGE_LOCALE_DIR'] = os.environ.get('STORAGE_LOCALE_DIR', os.path.join(app.instance_path, 'pdf'))
+    app.config['STORAGE_LOCALE_URL'] = os.environ.get('STORAGE_LOCALE_URL', '/api/biglietti/pdf/')
+
+    # le cache in memoria dei worker restano allineate con LISTEN/NOTIFY di Postgres
+    # (da disattivare solo con un unico worker)
+    from app.utils.notifiche import notifiche
+    app.config['NOTIFICHE_POSTGRES'] = os.environ.get('NOTIFICHE_POSTGRES', '1') == '1'
+    notifiche.init_app(app, db)
+
+    # versioni delle risorse per gli ETag delle GET
+    from app.utils.versioni import versioni
+    versioni.init_app(app)
+
+    # proiezioni future di ogni film, tenute finché non cambia la loro versione
+    from app.utils.proiezioni_film import proiezioni_film
+    app.config['PROIEZIONI_MAX_FILM'] = int(os.environ.get('PROIEZIONI_MAX_FILM', 500))
+    proiezioni_film.init_app(app)
+
+    # cache dell'occupazione dei posti
+    from app.utils.mappa_posti import mappa_posti
+    app.config['OCCUPAZIONE_MAX_PROIEZIONI'] = int(os.environ.get('OCCUPAZIONE_MAX_PROIEZIONI', 1000))
+    mappa_posti.init_app(app, db)
+
+    from app.utils.blocchi_posti import blocchi_posti
+    app.config['BLOCCO_POSTI_DURATA'] = int(os.environ.get('BLOCCO_POSTI_DURATA', 300))
+    app.config['BLOCCO_POSTI_MASSIMI'] = int(os.environ.get('BLOCCO_POSTI_MASSIMI', 50))
+    blocchi_posti.init_app(app, db)
+
+    # acquisti sulla stessa proiezione: quanto aspettare il lock della proiezione (millisecondi)
+    # e quante volte rifare una transazione finita in deadlock o in lock_timeout
+    app.config['LOCK_PROIEZIONE_TIMEOUT'] = int(os.environ.get('LOCK_PROIEZIONE_TIMEOUT', 5000))
+    app.config['TRANSAZIONE_TENTATIVI'] = int(os.environ.get('TRANSAZIONE_TENTATIVI', 3))
+
+    # stream SSE dell'occupazione: ogni quanto mandare il ping e dopo quanto chiudere
+    # (il client si riconnette da solo riprendendo dall'ultima versione ricevuta)
+    from app.utils.hub_posti import hub_posti
+    app.config['SSE_HEARTBEAT'] = int(os.environ.get('SSE_HEARTBEAT', 15))
+    app.config['SSE_DURATA_MASSIMA'] = int(os.environ.get('SSE_DURATA_MASSIMA', 600))
+    hub_posti.init_app(app)
+
+    from app.comandi import registra_comandi
+    registra_comandi(app)
+
     from app.routes import autenticazione, film, proiezioni, biglietti, posti, ordini
 
     # registrazione API
@@ -0,0 +1,42 @@
+import click
+from flask.cli import with_appcontext
+
+from .models import Ordine, STATO_PDF_IN_ATTESA, STATO_PDF_ERRORE
+
+
+# Comandi da lanciare con `flask <comando>` per la manutenzione
+
+
+@click.command('pdf-riaccoda')
+@with_appcontext
+def pdf_riaccoda():
+    """Rigenera i PDF degli ordini rimasti in attesa o andati in errore."""
+    from .services.ordini_service import OrdiniService
+
+    ordini = Ordine.query.filter(Ordine.stato_pdf.in_([STATO_PDF_IN_ATTESA, STATO_PDF_ERRORE])).all()
+    for ordine in ordini:
+        try:
+            OrdiniService.genera_pdf_ordine(ordine.id)
+            click.echo(f"Ordine {ordine.id}: PDF generato")
+        except Exception as e:
+            click.echo(f"Ordine {ordine.id}: errore {e}", err=True)
+
+
+@click.command('posti-riallinea')
+@click.option('--anche-passate', is_flag=True, help="Ricalcola anche le proiezioni già iniziate.")
+@with_appcontext
+def posti_riallinea(anche_passate):
+    """Ricalcola i posti disponibili delle proiezioni dai biglietti venduti."""
+    from . import db
+    from .services.proiezione_service import ProiezioneService
+
+    corrette = ProiezioneService.riallinea_posti_disponibili(anche_passate)
+    db.session.commit()
+    for id_proiezione, vecchio, nuovo in corrette:
+        click.echo(f"Proiezione {id_proiezione}: {vecchio} -> {nuovo} posti disponibili")
+    click.echo(f"{len(corrette)} proiezioni corrette")
+
+
+def registra_comandi(app):
+    app.cli.add_command(pdf_riaccoda)
+    app.cli.add_command(posti_riallinea)
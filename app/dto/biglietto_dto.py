@@ -1,3 +1,4 @@
+from datetime import datetime
 from dataclasses import dataclass
 from typing import List, Optional
 
@@ -59,3 +60,48 @@ class BigliettoDTO:
             'nome_ospite': self.nome_ospite,
             'cognome_ospite': self.cognome_ospite
         }
+
+
+# Biglietto appena venduto, con i dati di posto, sala, film e proiezione che tornano
+# dalla stessa query che lo inserisce (BigliettiService.inserisci_biglietti)
+@dataclass
+class BigliettoAcquistatoDTO:
+    id: int
+    id_posto: int
+    fila: str
+    numero: int
+    sala: str
+    film_titolo: str
+    data_ora: datetime
+    costo: float
+    nome_ospite: Optional[str] = None
+    cognome_ospite: Optional[str] = None
+
+    @classmethod
+    def from_riga(cls, riga):
+        return cls(
+            id=riga.id,
+            id_posto=riga.id_posto,
+            fila=riga.fila,
+            numero=riga.numero,
+            sala=riga.sala,
+            film_titolo=riga.film_titolo,
+            data_ora=riga.data_ora,
+            costo=float(riga.costo),
+            nome_ospite=riga.nome_ospite,
+            cognome_ospite=riga.cognome_ospite
+        )
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'id_posto': self.id_posto,
+            'fila': self.fila,
+            'numero': self.numero,
+            'sala': self.sala,
+            'film_titolo': self.film_titolo,
+            'data_ora': self.data_ora.isoformat(),
+            'costo': self.costo,
+            'nome_ospite': self.nome_ospite,
+            'cognome_ospite': self.cognome_ospite
+        }
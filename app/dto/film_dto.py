@@ -34,3 +34,23 @@ class FilmDTO:
             'descrizione': self.descrizione,
             'generi': self.generi
         }
+
+
+@dataclass
+class RisultatoRicercaDTO(FilmDTO):
+    punteggio: float
+    # titolo e pezzi della descrizione con le parole trovate tra <mark> e </mark>
+    titolo_evidenziato: str
+    estratto: str
+
+    @classmethod
+    def from_film(cls, film: FilmDTO, punteggio, titolo_evidenziato, estratto):
+        return cls(**vars(film), punteggio=punteggio, titolo_evidenziato=titolo_evidenziato, estratto=estratto)
+
+    def to_dict(self):
+        return {
+            **super().to_dict(),
+            'punteggio': self.punteggio,
+            'titolo_evidenziato': self.titolo_evidenziato,
+            'estratto': self.estratto
+        }
@@ -8,6 +8,7 @@ class OrdineDTO:
     id: int
     data_acquisto: str
     pdf_url: Optional[str]
+    stato_pdf: str
     proiezione: dict
     biglietti: List[BigliettoDTO]
 
@@ -17,6 +18,7 @@ class OrdineDTO:
             id=ordine.id,
             data_acquisto=ordine.data_acquisto.isoformat(),
             pdf_url=ordine.pdf_url,
+            stato_pdf=ordine.stato_pdf,
             proiezione={
                 'id': proiezione.id,
                 'film_id': film.id,
@@ -35,6 +37,7 @@ class OrdineDTO:
             'id': self.id,
             'data_acquisto': self.data_acquisto,
             'pdf_url': self.pdf_url,
+            'stato_pdf': self.stato_pdf,
             'proiezione': self.proiezione,
             'biglietti': [biglietto.to_dict() for biglietto in self.biglietti]
         }
\ No newline at end of file
@@ -1,4 +1,5 @@
 from dataclasses import dataclass
+from typing import List
 
 
 @dataclass
@@ -40,3 +41,43 @@ class PostoOccupatoDTO:
             'fila': self.fila,
             'numero': self.numero
         }
+
+
+@dataclass
+class MappaPostiDTO:
+    id_proiezione: int
+    sala: str
+    file: List[dict]
+    numero_posti: int
+    posti_occupati: int
+    occupati: str
+    posti_bloccati: int
+    bloccati: str
+    versione: int
+
+    @classmethod
+    def from_mappa(cls, id_proiezione, voce, bloccati):
+        return cls(
+            id_proiezione=id_proiezione,
+            sala=voce.layout.nome_sala,
+            file=voce.layout.file,
+            numero_posti=len(voce.layout),
+            posti_occupati=voce.occupati.conta(),
+            occupati=voce.occupati.to_base64(),
+            posti_bloccati=bloccati.conta(),
+            bloccati=bloccati.to_base64(),
+            versione=voce.versione
+        )
+
+    def to_dict(self):
+        return {
+            'id_proiezione': self.id_proiezione,
+            'sala': self.sala,
+            'file': self.file,
+            'numero_posti': self.numero_posti,
+            'posti_occupati': self.posti_occupati,
+            'occupati': self.occupati,
+            'posti_bloccati': self.posti_bloccati,
+            'bloccati': self.bloccati,
+            'versione': self.versione
+        }
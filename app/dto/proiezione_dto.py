@@ -1,6 +1,6 @@
 from datetime import datetime
 from dataclasses import dataclass
-from ..models import Sala, Proiezione
+from ..models import Proiezione
 
 
 @dataclass
@@ -9,15 +9,28 @@ class ProiezioneDTO:
     data_ora: datetime
     costo: float
     sala: str
+    posti_disponibili: int
 
     @classmethod
     def from_model(cls, proiezione: Proiezione):
-        sala_nome = Sala.query.get(proiezione.id_sala).nome
         return cls(
             id=proiezione.id,
             data_ora=proiezione.data_ora,
             costo=proiezione.costo,
-            sala=sala_nome
+            sala=proiezione.sala.nome,
+            posti_disponibili=proiezione.posti_disponibili
+        )
+
+    # Da una riga della query con le sole colonne che servono (id, data_ora, costo, sala, posti_disponibili),
+    # senza caricare i modelli né fare altre query per la sala
+    @classmethod
+    def from_riga(cls, riga):
+        return cls(
+            id=riga.id,
+            data_ora=riga.data_ora,
+            costo=riga.costo,
+            sala=riga.sala,
+            posti_disponibili=riga.posti_disponibili
         )
 
     def to_dict(self):
@@ -25,5 +38,32 @@ class ProiezioneDTO:
             'id': self.id,
             'data_ora': self.data_ora.isoformat(),
             'costo': self.costo,
-            'sala': self.sala
+            'sala': self.sala,
+            'posti_disponibili': self.posti_disponibili
+        }
+
+
+# Proiezione nella programmazione di più film: porta con sé il film
+@dataclass
+class ProiezioneProgrammaDTO(ProiezioneDTO):
+    id_film: int
+    titolo: str
+
+    @classmethod
+    def from_riga(cls, riga):
+        return cls(
+            id=riga.id,
+            data_ora=riga.data_ora,
+            costo=riga.costo,
+            sala=riga.sala,
+            posti_disponibili=riga.posti_disponibili,
+            id_film=riga.id_film,
+            titolo=riga.titolo
+        )
+
+    def to_dict(self):
+        return {
+            **super().to_dict(),
+            'id_film': self.id_film,
+            'titolo': self.titolo
         }
@@ -1,8 +1,11 @@
 from datetime import datetime
 from . import db
 from flask_login import UserMixin
-from sqlalchemy.dialects.postgresql import ENUM, ARRAY
-from sqlalchemy import Index
+from sqlalchemy.dialects.postgresql import ENUM, ARRAY, TSVECTOR
+from sqlalchemy import Index, DDL, event
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import deferred
+from sqlalchemy.schema import CreateColumn
 
 GenereFilm = ENUM(
     'Azione', 'Avventura', 'Commedia', 'Drammatico', 'Horror',
@@ -13,6 +16,14 @@ GenereFilm = ENUM(
 )
 
 
+# Testo indicizzato per la ricerca: il titolo pesa più del regista, che pesa più della descrizione
+TESTO_RICERCA_FILM = (
+    "setweight(to_tsvector('italian', coalesce(titolo, '')), 'A') || "
+    "setweight(to_tsvector('italian', coalesce(regista, '')), 'B') || "
+    "setweight(to_tsvector('italian', coalesce(descrizione, '')), 'C')"
+)
+
+
 class Film(db.Model):
     __tablename__ = 'film'
     id = db.Column('id_film', db.Integer, primary_key=True)
@@ -21,13 +32,26 @@ class Film(db.Model):
     durata = db.Column(db.Integer, nullable=True)
     url_copertina = db.Column(db.String(255), nullable=False)
     descrizione = db.Column(db.String(500), nullable=False)
-    generi = db.Column(ARRAY(GenereFilm), nullable=False)
+    # su un database di prova diverso da Postgres i generi sono una lista JSON
+    generi = db.Column(ARRAY(GenereFilm).with_variant(db.JSON(), 'sqlite'), nullable=False)
+    # colonna generata da Postgres, la aggiorna da solo a ogni modifica del film;
+    # deferred perché serve solo nelle query di ricerca. Solo su Postgres (vedi _crea_colonna):
+    # altrove la ricerca usa l'indice in memoria
+    ricerca = deferred(db.Column(TSVECTOR, db.Computed(TESTO_RICERCA_FILM, persisted=True),
+                                 info={'solo_postgresql': True}))
 
     proiezioni = db.relationship('Proiezione', back_populates='film', cascade='all, delete-orphan')
 
     __table_args__ = (
         Index('idx_film_titolo', 'titolo'),
+        # filtro per genere (generi && ARRAY[...]) e ricerca nel titolo (ILIKE '%...%')
+        Index('idx_film_generi', 'generi', postgresql_using='gin').ddl_if(dialect='postgresql'),
+        Index('idx_film_titolo_trgm', 'titolo', postgresql_using='gin',
+              postgresql_ops={'titolo': 'gin_trgm_ops'}).ddl_if(dialect='postgresql'),
+        Index('idx_film_ricerca', 'ricerca', postgresql_using='gin').ddl_if(dialect='postgresql'),
     )
+    # dopo un insert la colonna ricerca non si rilegge con RETURNING: non serve, e fuori da Postgres non c'è
+    __mapper_args__ = {'eager_defaults': False}
 
 
 class User(UserMixin, db.Model):
@@ -69,6 +93,13 @@ class Proiezione(db.Model):
     id_sala = db.Column(db.Integer, db.ForeignKey('sala.id_sala'), nullable=False)
     data_ora = db.Column(db.DateTime, nullable=False)
     costo = db.Column(db.Numeric(10, 2), nullable=False)
+    # incrementata nella stessa transazione di ogni acquisto o rimozione di biglietti,
+    # è la versione dell'occupazione dei posti condivisa da tutti i worker
+    versione_occupazione = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+    # posti non ancora venduti, aggiornati nello stesso UPDATE di versione_occupazione
+    # (PostoService.registra_variazione); `flask posti-riallinea` li ricalcola da biglietto.
+    # Se all'INSERT non c'è, il trigger TRIGGER_POSTI_DISPONIBILI ci mette i posti della sala.
+    posti_disponibili = db.Column(db.Integer, nullable=False, server_default=db.FetchedValue())
 
     film = db.relationship('Film', back_populates='proiezioni')
     sala = db.relationship('Sala', back_populates='proiezioni')
@@ -81,6 +112,12 @@ class Proiezione(db.Model):
     )
 
 
+# stati della generazione del PDF di un ordine, che avviene in background
+STATO_PDF_IN_ATTESA = 'in_attesa'
+STATO_PDF_PRONTO = 'pronto'
+STATO_PDF_ERRORE = 'errore'
+
+
 class Ordine(db.Model):
     __tablename__ = 'ordine'
     id = db.Column('id_ordine', db.Integer, primary_key=True)
@@ -92,9 +129,11 @@ class Ordine(db.Model):
     proiezione = db.relationship('Proiezione', back_populates='ordini')
     biglietti = db.relationship('Biglietto', back_populates='ordine', cascade='all, delete-orphan')
     pdf_url = db.Column(db.String(255))
+    stato_pdf = db.Column(db.String(20), nullable=False, default=STATO_PDF_IN_ATTESA)
 
     __table_args__ = (
-        Index('idx_ordine_utente', 'id_utente'),
+        # storico degli ordini di un utente dal più recente, paginato su (data_acquisto, id)
+        Index('idx_ordine_utente_data', 'id_utente', data_acquisto.desc(), id.desc()),
         Index('idx_ordine_proiezione', 'id_proiezione'),
     )
 
@@ -115,7 +154,9 @@ class Biglietto(db.Model):
     ordine = db.relationship('Ordine', back_populates='biglietti')
 
     __table_args__ = (
-        Index('idx_biglietto_proiezione', 'id_proiezione'),
+        # un posto si vende una volta sola per proiezione; l'indice del vincolo
+        # serve anche le ricerche per proiezione
+        db.UniqueConstraint('id_proiezione', 'id_posto', name='uq_biglietto_proiezione_posto'),
         Index('idx_biglietto_utente', 'id_utente'),
     )
 
@@ -134,3 +175,132 @@ class Posto(db.Model):
         Index('idx_posto_sala', 'id_sala'),
         db.UniqueConstraint('id_sala', 'fila', 'numero', name='uq_sala_fila_numero'),
     )
+
+
+# Posto tenuto da un utente durante il checkout, finché non compra o scade il blocco.
+# Una riga con scadenza passata vale come se non ci fosse e viene sovrascritta dal blocco successivo.
+class BloccoPosto(db.Model):
+    __tablename__ = 'blocco_posto'
+    id_proiezione = db.Column(db.Integer, db.ForeignKey('proiezione.id_proiezione', ondelete='CASCADE'), primary_key=True)
+    id_posto = db.Column(db.Integer, db.ForeignKey('posto.id_posto', ondelete='CASCADE'), primary_key=True)
+    id_utente = db.Column(db.Integer, db.ForeignKey('utente.id_utente', ondelete='CASCADE'), nullable=False)
+    # in UTC, come time.time() con cui la confrontano i worker
+    scadenza = db.Column(db.DateTime, nullable=False)
+
+    __table_args__ = (
+        Index('idx_blocco_posto_utente', 'id_utente', 'id_proiezione'),
+    )
+
+
+# Contatore delle modifiche di una risorsa servita in GET ('film', 'proiezioni:<id_film>', 'sala:<id_sala>'),
+# usato per gli ETag. Lo aggiornano i trigger qui sotto, così conta anche le modifiche fatte a mano
+# sul database, e ogni incremento manda un NOTIFY sul canale versioni_risorse.
+class VersioneRisorsa(db.Model):
+    __tablename__ = 'versione_risorsa'
+    risorsa = db.Column(db.String(64), primary_key=True)
+    versione = db.Column(db.BigInteger, nullable=False, default=0)
+    # in UTC, finisce nell'header Last-Modified
+    aggiornata = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+
+
+# Stesso SQL della migrazione che crea i trigger, per i database creati con db.create_all()
+TRIGGER_VERSIONI = DDL("""
+CREATE OR REPLACE FUNCTION incrementa_versione_risorsa(nome text) RETURNS void AS $$
+BEGIN
+    INSERT INTO versione_risorsa (risorsa, versione, aggiornata) VALUES (nome, 1, timezone('utc', now()))
+    ON CONFLICT (risorsa) DO UPDATE SET versione = versione_risorsa.versione + 1, aggiornata = timezone('utc', now());
+    PERFORM pg_notify('versioni_risorse', nome);
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION trigger_versione_film() RETURNS trigger AS $$
+BEGIN
+    PERFORM incrementa_versione_risorsa('film');
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION trigger_versione_proiezione() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM incrementa_versione_risorsa('proiezioni:' || OLD.id_film);
+    END IF;
+    IF TG_OP <> 'DELETE' AND (TG_OP = 'INSERT' OR NEW.id_film <> OLD.id_film) THEN
+        PERFORM incrementa_versione_risorsa('proiezioni:' || NEW.id_film);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION trigger_versione_posto() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM incrementa_versione_risorsa('sala:' || OLD.id_sala);
+    END IF;
+    IF TG_OP <> 'DELETE' AND (TG_OP = 'INSERT' OR NEW.id_sala <> OLD.id_sala) THEN
+        PERFORM incrementa_versione_risorsa('sala:' || NEW.id_sala);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- il nome della sala compare nelle proiezioni e nella mappa dei posti
+CREATE OR REPLACE FUNCTION trigger_versione_sala() RETURNS trigger AS $$
+BEGIN
+    PERFORM incrementa_versione_risorsa('sala:' || NEW.id_sala);
+    PERFORM incrementa_versione_risorsa('proiezioni:' || id_film)
+        FROM (SELECT DISTINCT id_film FROM proiezione WHERE id_sala = NEW.id_sala) AS film_in_sala;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS versione_film ON film;
+CREATE TRIGGER versione_film AFTER INSERT OR UPDATE OR DELETE ON film
+    FOR EACH STATEMENT EXECUTE FUNCTION trigger_versione_film();
+
+-- versione_occupazione e posti_disponibili cambiano a ogni acquisto e non toccano l'elenco delle proiezioni
+DROP TRIGGER IF EXISTS versione_proiezione ON proiezione;
+CREATE TRIGGER versione_proiezione AFTER INSERT OR DELETE OR UPDATE OF id_film, id_sala, data_ora, costo
+    ON proiezione FOR EACH ROW EXECUTE FUNCTION trigger_versione_proiezione();
+
+DROP TRIGGER IF EXISTS versione_posto ON posto;
+CREATE TRIGGER versione_posto AFTER INSERT OR UPDATE OR DELETE ON posto
+    FOR EACH ROW EXECUTE FUNCTION trigger_versione_posto();
+
+DROP TRIGGER IF EXISTS versione_sala ON sala;
+CREATE TRIGGER versione_sala AFTER UPDATE OF nome ON sala
+    FOR EACH ROW EXECUTE FUNCTION trigger_versione_sala();
+""")
+
+# Stesso SQL della migrazione che aggiunge posti_disponibili: una nuova proiezione parte da tutti
+# i posti della sala, anche se inserita senza passare dai modelli
+TRIGGER_POSTI_DISPONIBILI = DDL("""
+CREATE OR REPLACE FUNCTION trigger_posti_disponibili() RETURNS trigger AS $$
+BEGIN
+    IF NEW.posti_disponibili IS NULL THEN
+        NEW.posti_disponibili := (SELECT count(*) FROM posto WHERE posto.id_sala = NEW.id_sala);
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS posti_disponibili_proiezione ON proiezione;
+CREATE TRIGGER posti_disponibili_proiezione BEFORE INSERT ON proiezione
+    FOR EACH ROW EXECUTE FUNCTION trigger_posti_disponibili();
+""")
+
+# trigger, estensioni e indici GIN esistono solo su Postgres: con db.create_all() su un database
+# di prova diverso (SQLite) le tabelle si creano senza, e la ricerca dei film usa l'indice in memoria
+event.listen(db.metadata, 'after_create', TRIGGER_VERSIONI.execute_if(dialect='postgresql'))
+event.listen(db.metadata, 'after_create', TRIGGER_POSTI_DISPONIBILI.execute_if(dialect='postgresql'))
+# l'indice trigram sul titolo ha bisogno dell'estensione pg_trgm
+event.listen(db.metadata, 'before_create',
+             DDL("CREATE EXTENSION IF NOT EXISTS pg_trgm").execute_if(dialect='postgresql'))
+
+
+# Le colonne segnate con info={'solo_postgresql': True} non si creano sugli altri database
+@compiles(CreateColumn)
+def _crea_colonna(elemento, compilatore, **kw):
+    if elemento.element.info.get('solo_postgresql') and compilatore.dialect.name != 'postgresql':
+        return None
+    return compilatore.visit_create_column(elemento, **kw)
@@ -1,8 +1,13 @@
-from flask import request, current_app
+import re
+
+from flask import request, current_app, send_from_directory
 from flask_login import current_user, login_required
-from ..services.biglietti_service import BigliettiService
+from ..services.biglietti_service import BigliettiService, PostiNonDisponibili
 from ..services.ordini_service import OrdiniService
 from ..models import db
+from ..utils.coda_pdf import coda_pdf
+from ..utils.storage import get_storage, StorageLocale
+from ..utils.transazioni import ripeti_transazione
 from flask_restx import Namespace, Resource, fields
 
 biglietti_ns = Namespace('biglietti', description='Operazioni relative ai biglietti')
@@ -19,15 +24,36 @@ acquisto_biglietto_input = biglietti_ns.model('AcquistoBigliettoInput', {
     'biglietti': fields.List(fields.Nested(posto_in_biglietto_model), required=True, description='Lista di biglietti da acquistare')
 })
 
+biglietto_acquistato_model = biglietti_ns.model('BigliettoAcquistato', {
+    'id': fields.Integer(description='ID del biglietto'),
+    'id_posto': fields.Integer(description='ID del posto'),
+    'fila': fields.String(description='Fila del posto'),
+    'numero': fields.Integer(description='Numero del posto'),
+    'sala': fields.String(description='Nome della sala'),
+    'film_titolo': fields.String(description='Titolo del film'),
+    'data_ora': fields.String(description='Data e ora della proiezione'),
+    'costo': fields.Float(description='Costo del biglietto'),
+    'nome_ospite': fields.String(description='Nome dell\'ospite'),
+    'cognome_ospite': fields.String(description='Cognome dell\'ospite')
+})
+
 acquisto_biglietto_output = biglietti_ns.model('AcquistoBigliettoOutput', {
     'id_biglietti': fields.List(fields.Integer, description='Lista degli ID dei biglietti acquistati'),
-    'pdf_urls': fields.List(fields.String, description='URL del PDF del biglietto')
+    'id_ordine': fields.Integer(description='ID dell\'ordine creato'),
+    'stato_pdf': fields.String(description='Stato della generazione del PDF (in_attesa, pronto, errore)'),
+    'pdf_urls': fields.List(fields.String, description='URL del PDF del biglietto, vuota finché il PDF non è pronto'),
+    'biglietti': fields.List(fields.Nested(biglietto_acquistato_model), description='Biglietti acquistati')
 })
 
 error_model = biglietti_ns.model('Error', {
     'error': fields.String(description='Messaggio di errore')
 })
 
+posti_non_disponibili_model = biglietti_ns.model('PostiNonDisponibili', {
+    'errore': fields.String(description='Messaggio di errore'),
+    'posti_non_disponibili': fields.List(fields.Integer, description='ID dei posti già venduti')
+})
+
 
 @biglietti_ns.route('/acquisto')
 class AcquistoBiglietto(Resource):
@@ -36,35 +62,74 @@ class AcquistoBiglietto(Resource):
     @biglietti_ns.expect(acquisto_biglietto_input)
     @biglietti_ns.response(200, 'Successo', acquisto_biglietto_output)
     @biglietti_ns.response(400, 'Dati in input non validi', error_model)
+    @biglietti_ns.response(409, 'Posti già venduti', posti_non_disponibili_model)
     @biglietti_ns.response(500, 'Errore del server', error_model)
     def post(self):
         data = request.json
 
-        if not data.get('biglietti'):
+        if not isinstance(data.get('biglietti'), list) or not data['biglietti']:
             return {'errore': 'I dati in input non sono validi'}, 400
 
-        try:
+        def acquisto():
             ordine = OrdiniService.crea_ordine(
                 user_id=current_user.id,
                 id_proiezione=data['id_proiezione']
             )
 
-            id_biglietti, pdf_url = BigliettiService.acquista_biglietto(
+            biglietti = BigliettiService.acquista_biglietto(
                 current_user.id,
                 data['id_proiezione'],
                 data['biglietti'],
                 ordine.id
             )
 
-            ordine.pdf_url = pdf_url
+            OrdiniService.segna_pdf_da_generare(ordine)
+            # la risposta si prepara prima del commit, che fa scadere l'ordine:
+            # leggerlo dopo vorrebbe dire rileggerlo dal database
+            risposta = {
+                'id_biglietti': [biglietto.id for biglietto in biglietti],
+                'id_ordine': ordine.id,
+                'stato_pdf': ordine.stato_pdf,
+                'pdf_urls': [ordine.pdf_url] if ordine.pdf_url else [],
+                'biglietti': [biglietto.to_dict() for biglietto in biglietti]
+            }
             db.session.commit()
+            return risposta
+
+        try:
+            # con tanti acquisti sulla stessa proiezione un deadlock o un lock_timeout si riprovano
+            risposta = ripeti_transazione(acquisto)
 
-            return {
-                'id_biglietti': id_biglietti,
-                'pdf_urls': [pdf_url]
-            }, 200
+            # il PDF viene generato e caricato in background (o al primo download),
+            # il frontend controlla lo stato su /api/ordini/<id>/stato-pdf
+            coda_pdf.accoda(risposta['id_ordine'])
+
+            return risposta, 200
+
+        except PostiNonDisponibili as e:
+            db.session.rollback()
+            return {'errore': str(e), 'posti_non_disponibili': e.posti}, 409
+
+        except ValueError as e:
+            db.session.rollback()
+            return {'errore': str(e)}, 400
 
         except Exception as e:
             db.session.rollback()
             current_app.logger.error(f"Errore durante l\'acqusito: {str(e)}")
             return {'errore': str(e)}, 500
+
+
+@biglietti_ns.route('/pdf/<string:chiave>')
+@biglietti_ns.param('chiave', 'Hash del PDF seguito da .pdf')
+class PdfLocale(Resource):
+    @biglietti_ns.response(200, 'Successo')
+    @biglietti_ns.response(404, 'PDF non trovato')
+    def get(self, chiave):
+        """Scarica un PDF salvato nello storage locale"""
+        storage = get_storage()
+        if not isinstance(storage, StorageLocale) or not re.fullmatch(r'[0-9a-f]{64}\.pdf', chiave):
+            biglietti_ns.abort(404, 'PDF non trovato')
+
+        # il nome è l'hash del contenuto, quindi il file non cambia mai
+        return send_from_directory(storage.cartella, chiave, mimetype='application/pdf', max_age=31536000)
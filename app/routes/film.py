@@ -1,5 +1,15 @@
+import json
+import zlib
+
+from flask import Response, request
 from flask_restx import Namespace, Resource, fields
+from ..models import GenereFilm
 from ..services.film_service import FilmService
+from ..utils.cache_http import risposta_condizionale, CACHE_CATALOGO
+from ..utils.cursori import codifica_cursore, decodifica_cursore
+
+LIMITE_PAGINA = 20
+LIMITE_PAGINA_MASSIMO = 100
 
 film_ns = Namespace('film', description='Operazioni sui film')
 
@@ -14,24 +24,139 @@ film_model = film_ns.model('Film', {
     'generi': fields.List(fields.String, description='Generi del film')
 })
 
+risultato_ricerca_model = film_ns.inherit('RisultatoRicerca', film_model, {
+    'punteggio': fields.Float(description='Rilevanza del film per la ricerca'),
+    'titolo_evidenziato': fields.String(description='Titolo in HTML (con escape) con le parole trovate tra <mark> e </mark>'),
+    'estratto': fields.String(description='Pezzi della descrizione in HTML (con escape) con le parole trovate tra <mark> e </mark>')
+})
+
 
+# Lista e dettaglio escono già serializzati dal catalogo in memoria, senza passare da flask-restx
 @film_ns.route('/')
 class FilmList(Resource):
+    @film_ns.doc(params={
+        'genere': 'Solo i film di questo genere (ripetibile: basta uno dei generi indicati)',
+        'titolo': 'Solo i film con questo testo nel titolo',
+        'limite': f'Film per pagina (default {LIMITE_PAGINA}, massimo {LIMITE_PAGINA_MASSIMO})',
+        'cursore': 'Valore di X-Cursore-Successivo della pagina precedente'
+    })
     @film_ns.response(200, 'Successo', [film_model])
+    @film_ns.response(304, 'Non modificato')
+    @film_ns.response(400, 'Parametri non validi')
+    def get(self):
+        """Recupera la lista dei film
+
+        Senza parametri restituisce tutto il catalogo. Con uno qualsiasi dei parametri restituisce
+        una pagina dei film filtrati, in ordine di id: se ce ne sono altri la risposta ha l'header
+        X-Cursore-Successivo, da passare come cursore per la pagina dopo.
+        """
+        if any(parametro in request.args for parametro in ('genere', 'titolo', 'limite', 'cursore')):
+            return FilmList.pagina()
+
+        catalogo = FilmService.get_catalogo()
+        return risposta_condizionale(
+            f'film-{catalogo.versione}',
+            lambda: Response(catalogo.lista, mimetype='application/json'),
+            CACHE_CATALOGO,
+            catalogo.ultima_modifica
+        )
+
+    @staticmethod
+    def pagina():
+        generi = request.args.getlist('genere')
+        if any(genere not in GenereFilm.enums for genere in generi):
+            film_ns.abort(400, message=f"Generi ammessi: {', '.join(GenereFilm.enums)}")
+        limite = request.args.get('limite', LIMITE_PAGINA, type=int)
+        if not 1 <= limite <= LIMITE_PAGINA_MASSIMO:
+            film_ns.abort(400, message=f'limite deve essere tra 1 e {LIMITE_PAGINA_MASSIMO}')
+        dopo_id = None
+        if request.args.get('cursore'):
+            try:
+                dopo_id, = decodifica_cursore(request.args['cursore'], int)
+            except ValueError as e:
+                film_ns.abort(400, message=str(e))
+
+        def genera():
+            film, prossimo = FilmService.get_pagina_film(generi, request.args.get('titolo'), dopo_id, limite)
+            risposta = Response(json.dumps([f.to_dict() for f in film], separators=(',', ':')),
+                                mimetype='application/json')
+            if prossimo is not None:
+                risposta.headers['X-Cursore-Successivo'] = codifica_cursore(prossimo)
+            return risposta
+
+        # la pagina dipende dalla versione del catalogo e dai parametri
+        versione, ultima_modifica = FilmService.get_versione_catalogo()
+        return risposta_condizionale(
+            f'film-{versione}-{zlib.crc32(request.query_string):08x}',
+            genera,
+            CACHE_CATALOGO,
+            ultima_modifica
+        )
+
+
+@film_ns.route('/ricerca')
+class RicercaFilm(Resource):
+    @film_ns.doc(params={
+        'q': 'Testo da cercare nel titolo, nel regista e nella descrizione (accetta "frasi" e -parole da escludere)',
+        'limite': f'Risultati per pagina (default {LIMITE_PAGINA}, massimo {LIMITE_PAGINA_MASSIMO})',
+        'cursore': 'Valore di X-Cursore-Successivo della pagina precedente'
+    })
+    @film_ns.response(200, 'Successo', [risultato_ricerca_model])
+    @film_ns.response(304, 'Non modificato')
+    @film_ns.response(400, 'Parametri non validi')
     def get(self):
-        """Recupera la lista di tutti i film"""
-        films = FilmService.get_film()
-        return [film.to_dict() for film in films]
+        """Cerca i film per titolo, regista e descrizione
+
+        I risultati sono in ordine di rilevanza: il titolo conta più del regista, che conta più
+        della descrizione. Se ce ne sono altri la risposta ha l'header X-Cursore-Successivo.
+        """
+        testo = request.args.get('q', '').strip()
+        if not testo:
+            film_ns.abort(400, message='Il parametro q è obbligatorio')
+        limite = request.args.get('limite', LIMITE_PAGINA, type=int)
+        if not 1 <= limite <= LIMITE_PAGINA_MASSIMO:
+            film_ns.abort(400, message=f'limite deve essere tra 1 e {LIMITE_PAGINA_MASSIMO}')
+        dopo = None
+        if request.args.get('cursore'):
+            try:
+                dopo = decodifica_cursore(request.args['cursore'], (int, float), int)
+            except ValueError as e:
+                film_ns.abort(400, message=str(e))
+
+        def genera():
+            risultati, prossimo = FilmService.cerca_film(testo, dopo, limite)
+            risposta = Response(json.dumps([r.to_dict() for r in risultati], separators=(',', ':')),
+                                mimetype='application/json')
+            if prossimo is not None:
+                risposta.headers['X-Cursore-Successivo'] = codifica_cursore(*prossimo)
+            return risposta
+
+        # come le pagine del catalogo: i risultati cambiano solo quando cambiano i film
+        versione, ultima_modifica = FilmService.get_versione_catalogo()
+        return risposta_condizionale(
+            f'film-{versione}-{zlib.crc32(request.query_string):08x}',
+            genera,
+            CACHE_CATALOGO,
+            ultima_modifica
+        )
 
 
 @film_ns.route('/<int:film_id>')
 @film_ns.param('film_id', 'ID del film')
 class Film(Resource):
     @film_ns.response(200, 'Successo', film_model)
+    @film_ns.response(304, 'Non modificato')
     @film_ns.response(404, 'Film non trovato')
     def get(self, film_id):
         """Recupera un film specifico tramite ID"""
-        film = FilmService.get_film_per_id(film_id)
-        if not film:
+        catalogo = FilmService.get_catalogo()
+        film = catalogo.per_id.get(film_id)
+        if film is None:
             film_ns.abort(404, message='Film non trovato')
-        return film.to_dict()
\ No newline at end of file
+
+        return risposta_condizionale(
+            f'film-{catalogo.versione}',
+            lambda: Response(film, mimetype='application/json'),
+            CACHE_CATALOGO,
+            catalogo.ultima_modifica
+        )
@@ -1,8 +1,17 @@
+import os
+from datetime import datetime
+
 from flask_restx import Namespace, Resource, fields
 from flask_login import current_user, login_required
-from flask import current_app
+from flask import current_app, request, send_file
 from ..services.ordini_service import OrdiniService
-from dataclasses import asdict
+from ..services.biglietti_service import PostiNonDisponibili
+from ..utils.cursori import codifica_cursore, decodifica_cursore
+from ..utils.transazioni import ripeti_transazione
+
+LIMITE_PAGINA = 20
+LIMITE_PAGINA_MASSIMO = 100
+STATI_ORDINE = ('prossimi', 'passati')
 
 # Namespace
 ordini_ns = Namespace('ordini', description='Operazioni sugli ordini')
@@ -28,9 +37,33 @@ risposta_ordine = ordini_ns.model('RispostaOrdine', {
 
 risposta_pdf = ordini_ns.model('RispostaPdf', {
     'message': fields.String(description='Messaggio di successo'),
+    'stato_pdf': fields.String(description='Stato della generazione del PDF (in_attesa, pronto, errore)'),
     'pdf_url': fields.String(description='URL del PDF generato')
 })
 
+biglietto_aggiunto_model = ordini_ns.model('BigliettoAggiunto', {
+    'id': fields.Integer(description='ID del biglietto'),
+    'id_posto': fields.Integer(description='ID del posto'),
+    'fila': fields.String(description='Fila del posto'),
+    'numero': fields.Integer(description='Numero del posto'),
+    'sala': fields.String(description='Nome della sala'),
+    'film_titolo': fields.String(description='Titolo del film'),
+    'data_ora': fields.String(description='Data e ora della proiezione'),
+    'costo': fields.Float(description='Costo del biglietto'),
+    'nome_ospite': fields.String(description='Nome dell\'ospite'),
+    'cognome_ospite': fields.String(description='Cognome dell\'ospite')
+})
+
+risposta_aggiungi_biglietti = ordini_ns.inherit('RispostaAggiungiBiglietti', risposta_pdf, {
+    'biglietti': fields.List(fields.Nested(biglietto_aggiunto_model), description='Biglietti aggiunti')
+})
+
+risposta_stato_pdf = ordini_ns.model('RispostaStatoPdf', {
+    'id': fields.Integer(description='ID dell\'ordine'),
+    'stato_pdf': fields.String(description='Stato della generazione del PDF (in_attesa, pronto, errore)'),
+    'pdf_url': fields.String(description='URL del PDF, valorizzato quando lo stato è pronto')
+})
+
 risposta_errore = ordini_ns.model('RispostaErrore', {
     'error': fields.String(description='Messaggio di errore')
 })
@@ -38,15 +71,38 @@ risposta_errore = ordini_ns.model('RispostaErrore', {
 
 @ordini_ns.route('')
 class ListaOrdini(Resource):
+    @ordini_ns.doc(params={
+        'stato': 'prossimi (proiezioni non ancora iniziate) o passati, di default tutti',
+        'limite': f'Ordini per pagina (default {LIMITE_PAGINA}, massimo {LIMITE_PAGINA_MASSIMO})',
+        'cursore': 'Valore di X-Cursore-Successivo della pagina precedente'
+    })
     @ordini_ns.response(200, 'Successo', risposta_ordine)
+    @ordini_ns.response(400, 'Parametri non validi', risposta_errore)
     @ordini_ns.response(500, 'Errore interno del server', risposta_errore)
     @login_required
     def get(self):
-        """Recupera tutti gli ordini dell'utente"""
+        """Recupera gli ordini dell'utente, dal più recente
+
+        Restituisce una pagina alla volta: se ce ne sono altri la risposta ha l'header
+        X-Cursore-Successivo, da passare come cursore per la pagina dopo.
+        """
+        stato = request.args.get('stato')
+        if stato is not None and stato not in STATI_ORDINE:
+            ordini_ns.abort(400, f"stato deve essere {' o '.join(STATI_ORDINE)}")
+        limite = request.args.get('limite', LIMITE_PAGINA, type=int)
+        if not 1 <= limite <= LIMITE_PAGINA_MASSIMO:
+            ordini_ns.abort(400, f'limite deve essere tra 1 e {LIMITE_PAGINA_MASSIMO}')
+        dopo = None
+        if request.args.get('cursore'):
+            try:
+                dopo = decodifica_cursore(request.args['cursore'], datetime, int)
+            except ValueError as e:
+                ordini_ns.abort(400, str(e))
+
         try:
-            ordini = OrdiniService.get_ordini_utente()
-            # Converto i DTO in dizionari
-            return {'orders': [asdict(ordine) for ordine in ordini]}, 200
+            ordini, prossimo = OrdiniService.get_ordini_utente(stato, dopo, limite)
+            intestazioni = {'X-Cursore-Successivo': codifica_cursore(*prossimo)} if prossimo else {}
+            return {'orders': [ordine.to_dict() for ordine in ordini]}, 200, intestazioni
         except Exception as e:
             current_app.logger.error(f"Errore recupero ordini: {str(e)}")
             ordini_ns.abort(500, 'Impossibile recuperare gli ordini')
@@ -75,22 +131,31 @@ class Ordine(Resource):
 @ordini_ns.param('ordine_id', 'ID dell\'ordine')
 class AggiungiBiglietti(Resource):
     @ordini_ns.expect(richiesta_aggiungi_biglietti)
-    @ordini_ns.response(200, 'Successo', risposta_pdf)
+    @ordini_ns.response(200, 'Successo', risposta_aggiungi_biglietti)
     @ordini_ns.response(400, 'Dati in input non validi', risposta_errore)
+    @ordini_ns.response(409, 'Posti già venduti', risposta_errore)
     @ordini_ns.response(500, 'Errore interno del server', risposta_errore)
     @login_required
     def post(self, ordine_id):
         """Aggiunge biglietti a un ordine esistente"""
-        try:
-            dati = ordini_ns.payload
-            if 'biglietti' not in dati:
-                ordini_ns.abort(400, 'Dati biglietti mancanti')
+        # fuori dal try: abort solleva un'eccezione che il ramo generico trasformerebbe in 500
+        dati = ordini_ns.payload
+        biglietti_richiesti = dati.get('biglietti') if isinstance(dati, dict) else None
+        if not isinstance(biglietti_richiesti, list) or not biglietti_richiesti:
+            ordini_ns.abort(400, 'Dati biglietti mancanti')
 
-            pdf_url = OrdiniService.aggiungi_biglietti(ordine_id, current_user.id, dati['biglietti'])
+        try:
+            ordine, biglietti = ripeti_transazione(
+                lambda: OrdiniService.aggiungi_biglietti(ordine_id, current_user.id, biglietti_richiesti)
+            )
             return {
                 'message': 'Biglietti aggiunti con successo',
-                'pdf_url': pdf_url
+                'stato_pdf': ordine.stato_pdf,
+                'pdf_url': ordine.pdf_url,
+                'biglietti': [biglietto.to_dict() for biglietto in biglietti]
             }, 200
+        except PostiNonDisponibili as e:
+            ordini_ns.abort(409, str(e), posti_non_disponibili=e.posti)
         except ValueError as e:
             ordini_ns.abort(400, str(e))
         except Exception as e:
@@ -113,13 +178,69 @@ class RimuoviPosto(Resource):
             if 'idPosto' not in dati:
                 ordini_ns.abort(400, 'ID posto mancante')
 
-            pdf_url = OrdiniService.rimuovi_posto(ordine_id, current_user.id, dati['idPosto'])
+            ordine = OrdiniService.rimuovi_posto(ordine_id, current_user.id, dati['idPosto'])
             return {
                 'message': 'Posto rimosso con successo',
-                'pdf_url': pdf_url
+                'stato_pdf': ordine.stato_pdf,
+                'pdf_url': ordine.pdf_url
             }, 200
         except ValueError as e:
             ordini_ns.abort(400, str(e))
         except Exception as e:
             current_app.logger.error(f"Errore durante la rimozione del posto: {str(e)}")
             ordini_ns.abort(500, 'Impossibile rimuovere il posto dall\'ordine')
+
+
+@ordini_ns.route('/<int:ordine_id>/stato-pdf')
+@ordini_ns.param('ordine_id', 'ID dell\'ordine')
+class StatoPdf(Resource):
+    @ordini_ns.response(200, 'Successo', risposta_stato_pdf)
+    @ordini_ns.response(400, 'Dati in input non validi', risposta_errore)
+    @login_required
+    def get(self, ordine_id):
+        """Recupera lo stato della generazione del PDF di un ordine"""
+        try:
+            ordine = OrdiniService.get_stato_pdf(ordine_id, current_user.id)
+            return {
+                'id': ordine.id,
+                'stato_pdf': ordine.stato_pdf,
+                'pdf_url': ordine.pdf_url
+            }, 200
+        except ValueError as e:
+            ordini_ns.abort(400, str(e))
+
+
+@ordini_ns.route('/<int:ordine_id>/pdf')
+@ordini_ns.param('ordine_id', 'ID dell\'ordine')
+class PdfOrdine(Resource):
+    @ordini_ns.response(200, 'PDF dell\'ordine')
+    @ordini_ns.response(206, 'Parte del PDF richiesta con l\'header Range')
+    @ordini_ns.response(304, 'Il PDF non è cambiato rispetto all\'ETag inviato')
+    @ordini_ns.response(400, 'Dati in input non validi', risposta_errore)
+    @ordini_ns.response(500, 'Errore interno del server', risposta_errore)
+    @login_required
+    def get(self, ordine_id):
+        """Scarica il PDF di un ordine, generandolo al primo download"""
+        try:
+            versione, pdf = OrdiniService.get_pdf_ordine(ordine_id, current_user.id)
+        except ValueError as e:
+            ordini_ns.abort(400, str(e))
+        except Exception as e:
+            current_app.logger.error(f"Errore nella generazione del PDF dell'ordine: {str(e)}")
+            ordini_ns.abort(500, 'Impossibile generare il PDF dell\'ordine')
+
+        # il file arriva già aperto, così resta leggibile anche se l'archivio lo cancella
+        # mentre lo inviamo. send_file lo legge a blocchi e lo chiude a fine risposta;
+        # If-None-Match e Range li gestisco qui perché da un file aperto non conosce la dimensione.
+        # L'ETag è la versione dei biglietti, quindi cambia solo se cambia l'ordine
+        dimensione = os.fstat(pdf.fileno()).st_size
+        risposta = send_file(
+            pdf,
+            mimetype='application/pdf',
+            download_name=f"ordine{ordine_id}.pdf",
+            etag=versione,
+            conditional=False,
+            max_age=0
+        )
+        risposta.content_length = dimensione
+        return risposta.make_conditional(request, accept_ranges=True, complete_length=dimensione)
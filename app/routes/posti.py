@@ -1,5 +1,14 @@
+import json
+import time
+
+from flask import Response, current_app, request, stream_with_context
+from flask_login import current_user, login_required
 from flask_restx import Namespace, Resource, fields
+from ..models import db
+from ..services.blocchi_service import BlocchiService
 from ..services.posto_service import PostoService
+from ..utils.cache_http import risposta_condizionale, CACHE_POSTI
+from ..utils.hub_posti import hub_posti
 
 
 posti_ns = Namespace('posti', description='Operazioni sui posti delle proiezioni')
@@ -16,18 +25,44 @@ posto_occupato_model = posti_ns.model('PostoOccupato', {
     'numero': fields.Integer(description='Numero del posto occupato')
 })
 
+fila_model = posti_ns.model('FilaMappa', {
+    'fila': fields.String(description='Fila'),
+    'posti': fields.List(fields.List(fields.Integer), description='Coppie [id_posto, numero] in ordine di numero')
+})
+
+mappa_posti_model = posti_ns.model('MappaPosti', {
+    'id_proiezione': fields.Integer(description='ID della proiezione'),
+    'sala': fields.String(description='Nome della sala'),
+    'file': fields.List(fields.Nested(fila_model), description='Layout della sala, fila per fila'),
+    'numero_posti': fields.Integer(description='Numero di posti della sala'),
+    'posti_occupati': fields.Integer(description='Numero di posti venduti'),
+    'occupati': fields.String(description='Bitset in base64: il bit i (dal più significativo del primo byte) '
+                                          'vale 1 se l\'i-esimo posto del layout è occupato'),
+    'posti_bloccati': fields.Integer(description='Numero di posti bloccati da utenti in fase di acquisto'),
+    'bloccati': fields.String(description='Bitset in base64 dei posti bloccati, con lo stesso ordine di occupati'),
+    'versione': fields.Integer(description='Versione dell\'occupazione, cresce a ogni acquisto o rimozione')
+})
+
 
 @posti_ns.route('/<int:id_proiezione>')
 @posti_ns.param('id_proiezione', 'ID della proiezione')
 class PostiList(Resource):
     @posti_ns.doc('lista_posti')
     @posti_ns.response(200, 'Successo', [posto_model])
+    @posti_ns.response(304, 'Non modificato')
     @posti_ns.response(500, 'Errore interno del server')
     def get(self, id_proiezione):
         """Recupera tutti i posti per una specifica proiezione"""
         try:
-            posti = PostoService.get_posti_proiezione(id_proiezione)
-            return [posto.to_dict() for posto in posti]
+            etag = PostoService.get_versioni_posti(id_proiezione)
+            if etag is None:
+                return []
+            # il JSON è già pronto nel layout della sala: niente serializzazione per richiesta
+            return risposta_condizionale(
+                etag['layout'],
+                lambda: Response(PostoService.get_posti_proiezione_json(id_proiezione), mimetype='application/json'),
+                CACHE_POSTI
+            )
         except Exception as e:
             posti_ns.abort(500, message=str(e))
 
@@ -37,11 +72,248 @@ class PostiList(Resource):
 class PostiOccupati(Resource):
     @posti_ns.doc('lista_posti_occupati')
     @posti_ns.response(200, 'Successo', [posto_occupato_model])
+    @posti_ns.response(304, 'Non modificato')
     @posti_ns.response(500, 'Errore interno del server')
     def get(self, id_proiezione):
         """Recupera tutti i posti occupati per una specifica proiezione"""
         try:
-            posti_occupati = PostoService.get_posti_occupati(id_proiezione)
-            return [posto.to_dict() for posto in posti_occupati]
+            etag = PostoService.get_versioni_posti(id_proiezione)
+            if etag is None:
+                return []
+            return risposta_condizionale(
+                etag['occupazione'],
+                lambda: [posto.to_dict() for posto in PostoService.get_posti_occupati(id_proiezione)],
+                CACHE_POSTI
+            )
+        except Exception as e:
+            posti_ns.abort(500, message=str(e))
+
+
+@posti_ns.route('/mappa/<int:id_proiezione>')
+@posti_ns.param('id_proiezione', 'ID della proiezione')
+class MappaPosti(Resource):
+    @posti_ns.doc('mappa_posti')
+    @posti_ns.response(200, 'Successo', mappa_posti_model)
+    @posti_ns.response(304, 'Non modificato')
+    @posti_ns.response(404, 'Proiezione non trovata')
+    @posti_ns.response(500, 'Errore interno del server')
+    def get(self, id_proiezione):
+        """Recupera layout della sala e posti occupati di una proiezione in forma compatta"""
+        try:
+            etag = PostoService.get_versioni_posti(id_proiezione)
+        except Exception as e:
+            posti_ns.abort(500, message=str(e))
+
+        if etag is None:
+            posti_ns.abort(404, message='Proiezione non trovata')
+        return risposta_condizionale(
+            etag['mappa'],
+            lambda: PostoService.get_mappa_posti(id_proiezione).to_dict(),
+            CACHE_POSTI
+        )
+
+
+@posti_ns.route('/migliori/<int:id_proiezione>')
+@posti_ns.param('id_proiezione', 'ID della proiezione')
+class PostiMigliori(Resource):
+    @posti_ns.doc('posti_migliori', params={'numero': 'Quanti posti vicini servono'})
+    @posti_ns.response(200, 'Successo (lista vuota se non ci sono abbastanza posti vicini)', [posto_model])
+    @posti_ns.response(400, 'Numero di posti non valido')
+    @posti_ns.response(404, 'Proiezione non trovata')
+    @posti_ns.response(500, 'Errore interno del server')
+    def get(self, id_proiezione):
+        """Trova i migliori posti vicini (stessa fila, numeri consecutivi) per un gruppo
+
+        Tra i gruppi di posti liberi e non bloccati sceglie il più centrale, sia nella fila che
+        nella sala. I posti non vengono bloccati: per tenerli va chiamato POST /blocchi.
+        """
+        numero = request.args.get('numero', type=int)
+        if numero is None or not 1 <= numero <= current_app.config['BLOCCO_POSTI_MASSIMI']:
+            posti_ns.abort(400, message=f"numero deve essere tra 1 e {current_app.config['BLOCCO_POSTI_MASSIMI']}")
+
+        try:
+            posti = PostoService.get_posti_migliori(id_proiezione, numero)
         except Exception as e:
             posti_ns.abort(500, message=str(e))
+
+        if posti is None:
+            posti_ns.abort(404, message='Proiezione non trovata')
+        return [posto.to_dict() for posto in posti], 200
+
+
+def evento_sse(tipo, versione, dati):
+    return f"event: {tipo}\nid: {versione}\ndata: {json.dumps(dati, separators=(',', ':'))}\n\n"
+
+
+def stream_occupazione(id_proiezione, da_versione):
+    heartbeat = current_app.config['SSE_HEARTBEAT']
+    fine = time.monotonic() + current_app.config['SSE_DURATA_MASSIMA']
+    canale = hub_posti.iscrivi(id_proiezione)
+    try:
+        # il client si riconnette da solo dopo 3 secondi, mandando Last-Event-ID
+        yield "retry: 3000\n\n"
+
+        mappa = PostoService.get_mappa_posti(id_proiezione)
+        # lo stream resta aperto a lungo: la connessione al database non deve restare occupata
+        db.session.close()
+        if mappa is None:
+            yield evento_sse('errore', 0, {'errore': 'Proiezione non trovata'})
+            return
+
+        versione = da_versione
+        # a chi riprende lo stream i blocchi vanno rimandati comunque
+        bloccati = None
+        invia_mappa = da_versione is None or da_versione > mappa.versione
+        if not invia_mappa and da_versione < mappa.versione:
+            # il client è indietro: se il buffer ha tutte le variazioni che gli mancano bastano quelle
+            eventi, invia_mappa = hub_posti.attendi(canale, da_versione, 0)
+            invia_mappa = invia_mappa or not eventi or eventi[0].versione != da_versione + 1
+
+        while time.monotonic() < fine:
+            if invia_mappa:
+                if mappa is None:
+                    mappa = PostoService.get_mappa_posti(id_proiezione)
+                    db.session.close()
+                    if mappa is None:
+                        # la proiezione è stata eliminata mentre lo stream era aperto
+                        yield evento_sse('errore', versione or 0, {'errore': 'Proiezione non trovata'})
+                        return
+                yield evento_sse('mappa', mappa.versione, {
+                    'versione': mappa.versione,
+                    'occupati': mappa.occupati,
+                    'posti_occupati': mappa.posti_occupati,
+                    'bloccati': mappa.bloccati
+                })
+                versione = mappa.versione
+                bloccati = mappa.bloccati
+                invia_mappa = False
+            mappa = None
+
+            eventi, invia_mappa = hub_posti.attendi(canale, versione, heartbeat)
+            if invia_mappa:
+                continue
+
+            # i blocchi non hanno una versione e scadono da soli: confronto con l'ultimo bitset
+            # mandato, dopo ogni risveglio (un blocco scaduto si vede al più al ping successivo)
+            attuali = PostoService.get_posti_bloccati(id_proiezione)
+            db.session.close()
+            if attuali is None:
+                yield evento_sse('errore', versione or 0, {'errore': 'Proiezione non trovata'})
+                return
+            if attuali != bloccati:
+                yield evento_sse('blocchi', versione, {'bloccati': attuali})
+                bloccati = attuali
+            elif not eventi:
+                # commento SSE: tiene viva la connessione attraverso proxy e load balancer
+                yield ": ping\n\n"
+                continue
+
+            for evento in eventi:
+                yield evento_sse('variazione', evento.versione, {
+                    'versione': evento.versione,
+                    'occupati': evento.occupati,
+                    'liberati': evento.liberati
+                })
+                versione = evento.versione
+    finally:
+        hub_posti.disiscrivi(id_proiezione, canale)
+
+
+@posti_ns.route('/stream/<int:id_proiezione>')
+@posti_ns.param('id_proiezione', 'ID della proiezione')
+class StreamPosti(Resource):
+    @posti_ns.doc('stream_posti', params={
+        'versione': 'Versione da cui riprendere, in alternativa all\'header Last-Event-ID'
+    })
+    @posti_ns.response(200, 'Stream text/event-stream')
+    def get(self, id_proiezione):
+        """Stream (Server-Sent Events) delle variazioni dell'occupazione dei posti di una proiezione
+
+        Il primo evento è `mappa` con i bitset dei posti occupati e bloccati (come in /mappa), poi
+        arrivano eventi `variazione` con gli id dei posti occupati e liberati ed eventi `blocchi`
+        con il nuovo bitset dei posti bloccati. L'id di ogni evento è la versione
+        dell'occupazione: riconnettendosi con Last-Event-ID si ricevono solo le variazioni perse.
+        """
+        da_versione = request.headers.get('Last-Event-ID', type=int)
+        if da_versione is None:
+            da_versione = request.args.get('versione', type=int)
+
+        return Response(
+            stream_with_context(stream_occupazione(id_proiezione, da_versione)),
+            mimetype='text/event-stream',
+            headers={
+                'Cache-Control': 'no-cache',
+                # nginx non deve bufferizzare lo stream
+                'X-Accel-Buffering': 'no'
+            }
+        )
+
+
+blocco_input = posti_ns.model('BloccoPostiInput', {
+    'posti': fields.List(fields.Integer, required=True, description='ID dei posti da bloccare')
+})
+
+rilascio_input = posti_ns.model('RilascioPostiInput', {
+    'posti': fields.List(fields.Integer, description='ID dei posti da rilasciare, se manca tutti quelli dell\'utente')
+})
+
+blocco_output = posti_ns.model('BloccoPosti', {
+    'posti': fields.List(fields.Integer, description='ID dei posti bloccati dall\'utente'),
+    'non_disponibili': fields.List(fields.Integer, description='Posti richiesti ma già venduti o bloccati da altri'),
+    'scadenza': fields.String(description='Scadenza dei blocchi (ISO 8601, UTC)')
+})
+
+
+@posti_ns.route('/blocchi/<int:id_proiezione>')
+@posti_ns.param('id_proiezione', 'ID della proiezione')
+class BlocchiProiezione(Resource):
+    @login_required
+    @posti_ns.doc('blocca_posti')
+    @posti_ns.expect(blocco_input)
+    @posti_ns.response(200, 'Successo', blocco_output)
+    @posti_ns.response(400, 'Dati in input non validi')
+    @posti_ns.response(500, 'Errore interno del server')
+    def post(self, id_proiezione):
+        """Blocca dei posti per l'utente durante l'acquisto
+
+        I posti restano riservati per BLOCCO_POSTI_DURATA secondi: nessun altro può bloccarli o comprarli.
+        Quelli già venduti o bloccati da altri finiscono in non_disponibili.
+        """
+        posti = (request.json or {}).get('posti')
+        if not isinstance(posti, list) or not all(isinstance(posto, int) for posto in posti):
+            posti_ns.abort(400, message='I dati in input non sono validi')
+
+        try:
+            return BlocchiService.blocca(current_user.id, id_proiezione, posti), 200
+        except ValueError as e:
+            db.session.rollback()
+            return {'message': str(e)}, 400
+        except Exception as e:
+            db.session.rollback()
+            return {'message': str(e)}, 500
+
+    @login_required
+    @posti_ns.doc('rinnova_blocchi')
+    @posti_ns.response(200, 'Successo', blocco_output)
+    @posti_ns.response(500, 'Errore interno del server')
+    def put(self, id_proiezione):
+        """Rinnova la scadenza dei blocchi ancora attivi dell'utente sulla proiezione"""
+        try:
+            return BlocchiService.rinnova(current_user.id, id_proiezione), 200
+        except Exception as e:
+            db.session.rollback()
+            return {'message': str(e)}, 500
+
+    @login_required
+    @posti_ns.doc('rilascia_blocchi')
+    @posti_ns.expect(rilascio_input)
+    @posti_ns.response(200, 'Successo')
+    @posti_ns.response(500, 'Errore interno del server')
+    def delete(self, id_proiezione):
+        """Rilascia i posti bloccati dall'utente sulla proiezione"""
+        posti = (request.get_json(silent=True) or {}).get('posti')
+        try:
+            return {'posti': BlocchiService.rilascia(current_user.id, id_proiezione, posti)}, 200
+        except Exception as e:
+            db.session.rollback()
+            return {'message': str(e)}, 500
@@ -1,6 +1,9 @@
+from datetime import date, timedelta
+
 from flask import request
 from flask_restx import Namespace, Resource, fields
 from ..services.proiezione_service import ProiezioneService
+from ..utils.cache_http import risposta_condizionale, CACHE_CATALOGO
 
 proiezioni_ns = Namespace('proiezioni', description='Operazioni sulle proiezioni')
 
@@ -9,14 +12,34 @@ proiezione_model = proiezioni_ns.model('Proiezione', {
     'id': fields.Integer(description='ID della proiezione'),
     'data_ora': fields.String(description='Data e ora della proiezione'),
     'costo': fields.Float(description='Costo della proiezione'),
-    'sala': fields.String(description='Nome della sala')
+    'sala': fields.String(description='Nome della sala'),
+    'posti_disponibili': fields.Integer(description='Posti non ancora venduti (0 = esaurita)')
+})
+
+proiezione_programma_model = proiezioni_ns.inherit('ProiezioneProgramma', proiezione_model, {
+    'id_film': fields.Integer(description='ID del film'),
+    'titolo': fields.String(description='Titolo del film')
+})
+
+giorno_programma_model = proiezioni_ns.model('GiornoProgramma', {
+    'giorno': fields.String(description='Data (YYYY-MM-DD)'),
+    'proiezioni': fields.List(fields.Nested(proiezione_programma_model), description='Proiezioni in ordine di orario')
 })
 
+# ampiezza massima della finestra della programmazione, in giorni
+GIORNI_PROGRAMMAZIONE_MASSIMI = 31
+
+
+def _solo_disponibili():
+    return request.args.get('solo_disponibili', '').lower() in ('1', 'true')
+
 
 @proiezioni_ns.route('/')
 class ProiezioneList(Resource):
     @proiezioni_ns.param('film_id', 'ID del film', type=int, required=True)
+    @proiezioni_ns.param('solo_disponibili', 'Se true esclude le proiezioni esaurite', type=bool)
     @proiezioni_ns.response(200, 'Successo', [proiezione_model])
+    @proiezioni_ns.response(304, 'Non modificato')
     @proiezioni_ns.response(400, 'Errore sui dati in ingresso')
     @proiezioni_ns.response(500, 'Errore interno del server')
     def get(self):
@@ -26,7 +49,43 @@ class ProiezioneList(Resource):
             return {'errore': 'L\'id del film non è presente'}, 400
 
         try:
-            proiezioni = ProiezioneService.get_proiezioni(film_id)
-            return [p.to_dict() for p in proiezioni]
+            etag, proiezioni = ProiezioneService.get_proiezioni_versionate(film_id)
+            if _solo_disponibili():
+                # i posti disponibili sono già nella lista, filtrare non costa query
+                proiezioni = [p for p in proiezioni if p.posti_disponibili > 0]
+                etag += '-disponibili'
+            return risposta_condizionale(etag, lambda: [p.to_dict() for p in proiezioni], CACHE_CATALOGO)
+        except Exception as e:
+            return {'error': str(e)}, 500
+
+
+@proiezioni_ns.route('/programmazione')
+class Programmazione(Resource):
+    @proiezioni_ns.doc(params={
+        'dal': 'Primo giorno (YYYY-MM-DD), di default oggi',
+        'al': 'Ultimo giorno compreso (YYYY-MM-DD), di default uguale a dal',
+        'film_id': 'Solo le proiezioni di questo film (ripetibile), di default tutti i film',
+        'solo_disponibili': 'Se true esclude le proiezioni esaurite'
+    })
+    @proiezioni_ns.response(200, 'Successo', [giorno_programma_model])
+    @proiezioni_ns.response(400, 'Errore sui dati in ingresso')
+    @proiezioni_ns.response(500, 'Errore interno del server')
+    def get(self):
+        """Recupera le proiezioni future di tutti i film (o di alcuni) in un intervallo di giorni, divise per giorno"""
+        try:
+            dal = date.fromisoformat(request.args['dal']) if 'dal' in request.args else date.today()
+            al = date.fromisoformat(request.args['al']) if 'al' in request.args else dal
+            film_ids = [int(film_id) for film_id in request.args.getlist('film_id')]
+        except ValueError:
+            return {'errore': 'Date (YYYY-MM-DD) o id dei film non validi'}, 400
+        if al < dal or al - dal >= timedelta(days=GIORNI_PROGRAMMAZIONE_MASSIMI):
+            return {'errore': f'L\'intervallo deve andare da 1 a {GIORNI_PROGRAMMAZIONE_MASSIMI} giorni'}, 400
+
+        try:
+            return [
+                {'giorno': giorno.isoformat(), 'proiezioni': [p.to_dict() for p in proiezioni]}
+                for giorno, proiezioni in ProiezioneService.get_programmazione(
+                    dal, al, film_ids, _solo_disponibili())
+            ], 200
         except Exception as e:
             return {'error': str(e)}, 500
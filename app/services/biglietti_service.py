@@ -1,40 +1,93 @@
-from datetime import datetime
-from ..models import Biglietto, Film, Proiezione, Sala, Posto, db
-from ..utils.cloudinary_utils import upload_pdf_to_cloudinary
-from ..utils.pdf_utils import genera_biglietto_pdf
+from sqlalchemy.dialects.postgresql import insert
+
+from ..models import Biglietto, Proiezione, Posto, Sala, Film, db
+from ..dto.biglietto_dto import BigliettoAcquistatoDTO
+from .posto_service import PostoService
+from .blocchi_service import BlocchiService
+
+
+# Alcuni posti richiesti sono già stati venduti: posti contiene i loro id
+class PostiNonDisponibili(ValueError):
+    def __init__(self, posti):
+        super().__init__('Alcuni posti selezionati non sono più disponibili')
+        self.posti = posti
 
 
 class BigliettiService:
     @staticmethod
-    def acquista_biglietto(user_id, id_proiezione, biglietti_data, ordine_id):
-        biglietti_acquistati = []
-        id_biglietti = []
-
-        for biglietto_data in biglietti_data:
-            biglietto = Biglietto(
-                id_proiezione=id_proiezione,
-                id_utente=user_id,
-                id_posto=biglietto_data['id_posto'],
-                id_ordine=ordine_id,
-                nome_ospite=biglietto_data.get('nome_ospite'),
-                cognome_ospite=biglietto_data.get('cognome_ospite')
+    def acquista_biglietto(user_id, id_proiezione, biglietti_data, ordine_id) -> list[BigliettoAcquistatoDTO]:
+        # il PDF non si genera più qui: lo fa la coda in background dopo il commit
+        # i blocchi dell'utente su questi posti diventano biglietti nella stessa transazione
+        BlocchiService.converti(user_id, id_proiezione, [b['id_posto'] for b in biglietti_data])
+        return BigliettiService.inserisci_biglietti(user_id, id_proiezione, ordine_id, biglietti_data)
+
+    # Inserisce i biglietti con un solo INSERT ... ON CONFLICT DO NOTHING: il vincolo unico
+    # su (id_proiezione, id_posto) garantisce che nessun posto venga venduto due volte, anche
+    # con richieste concorrenti, e i posti che non tornano da RETURNING sono quelli persi.
+    # Va chiamato dopo BlocchiService.converti, che tiene il lock sulla proiezione: così chi
+    # arriva dopo vede già i biglietti di chi ha comprato prima invece di aspettarne il commit.
+    # Nella stessa query aggiorna versione_occupazione e posti_disponibili della proiezione
+    # (l'UPDATE di PostoService.registra_variazione) e ritorna i biglietti con posto, sala e
+    # film già in join: un solo round trip qualunque sia il numero di biglietti.
+    @staticmethod
+    def inserisci_biglietti(user_id, id_proiezione, ordine_id, biglietti_data) -> list[BigliettoAcquistatoDTO]:
+        # senza biglietti l'INSERT non ritorna righe e non c'è niente da aggiornare
+        if not biglietti_data:
+            raise ValueError('Nessun biglietto da inserire')
+
+        posti = [b['id_posto'] for b in biglietti_data]
+        if len(set(posti)) != len(posti):
+            raise ValueError('Lo stesso posto è stato richiesto più volte')
+
+        inseriti = insert(Biglietto).values([{
+            'id_proiezione': id_proiezione,
+            'id_utente': user_id,
+            'id_posto': biglietto_data['id_posto'],
+            'id_ordine': ordine_id,
+            'nome_ospite': biglietto_data.get('nome_ospite'),
+            'cognome_ospite': biglietto_data.get('cognome_ospite')
+        } for biglietto_data in biglietti_data]) \
+            .on_conflict_do_nothing(constraint='uq_biglietto_proiezione_posto') \
+            .returning(Biglietto.id, Biglietto.id_posto, Biglietto.nome_ospite, Biglietto.cognome_ospite) \
+            .cte('inseriti')
+
+        # se qualche posto è perso il chiamante fa rollback, quindi può contare solo gli inseriti
+        proiezione = db.update(Proiezione) \
+            .where(Proiezione.id == id_proiezione) \
+            .values(versione_occupazione=Proiezione.versione_occupazione + 1,
+                    posti_disponibili=Proiezione.posti_disponibili
+                    - db.select(db.func.count()).select_from(inseriti).scalar_subquery()) \
+            .returning(Proiezione.id_film, Proiezione.id_sala, Proiezione.data_ora, Proiezione.costo,
+                       Proiezione.versione_occupazione) \
+            .cte('proiezione_aggiornata')
+
+        righe = db.session.execute(
+            db.select(
+                inseriti.c.id_biglietto.label('id'),
+                inseriti.c.id_posto,
+                Posto.fila,
+                Posto.numero,
+                Sala.nome.label('sala'),
+                Film.titolo.label('film_titolo'),
+                proiezione.c.data_ora,
+                proiezione.c.costo,
+                inseriti.c.nome_ospite,
+                inseriti.c.cognome_ospite,
+                proiezione.c.versione_occupazione
             )
-            db.session.add(biglietto)
-            db.session.flush()
-            id_biglietti.append(biglietto.id)
-            biglietti_acquistati.append(biglietto)
-
-        tickets_info = (
-            db.session.query(Biglietto, Film, Proiezione, Sala, Posto)
-            .join(Proiezione, Biglietto.id_proiezione == Proiezione.id)
-            .join(Film, Proiezione.id_film == Film.id)
-            .join(Sala, Proiezione.id_sala == Sala.id)
-            .join(Posto, Biglietto.id_posto == Posto.id)
-            .filter(Biglietto.id.in_(id_biglietti))
-            .all()
-        )
-
-        pdf_buffer = genera_biglietto_pdf(tickets_info, ordine_id)
-        pdf_url = upload_pdf_to_cloudinary(pdf_buffer, f"ticket{ordine_id}{datetime.now()}")
-
-        return id_biglietti, pdf_url
+            .select_from(inseriti)
+            .join(Posto, Posto.id == inseriti.c.id_posto)
+            .join(proiezione, db.true())
+            .join(Film, Film.id == proiezione.c.id_film)
+            .join(Sala, Sala.id == proiezione.c.id_sala)
+        ).all()
+
+        per_posto = {riga.id_posto: riga for riga in righe}
+        persi = [id_posto for id_posto in posti if id_posto not in per_posto]
+        if persi:
+            # il chiamante fa rollback, quindi non resta nessun biglietto dell'ordine
+            raise PostiNonDisponibili(persi)
+
+        # la cache dell'occupazione si aggiorna solo dopo il commit
+        PostoService.notifica_variazione(id_proiezione, righe[0].versione_occupazione, occupati=posti)
+        return [BigliettoAcquistatoDTO.from_riga(per_posto[id_posto]) for id_posto in posti]
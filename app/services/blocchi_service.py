@@ -0,0 +1,165 @@
+from datetime import datetime, timezone, timedelta
+
+from flask import current_app
+from sqlalchemy import text
+from sqlalchemy.dialects.postgresql import insert
+
+from ..models import BloccoPosto, Biglietto, Posto, Proiezione, db
+from ..utils.blocchi_posti import blocchi_posti
+
+
+def _adesso():
+    # blocco_posto.scadenza è in UTC senza fuso, come datetime.utcnow()
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
+
+def _timestamp(scadenza):
+    return scadenza.replace(tzinfo=timezone.utc).timestamp()
+
+
+# Blocchi temporanei dei posti durante il checkout.
+# Un utente blocca i posti che ha scelto per BLOCCO_POSTI_DURATA secondi, può rinnovarli
+# o rilasciarli, e al momento dell'acquisto i suoi blocchi diventano biglietti.
+# Nessun altro può bloccare o comprare un posto bloccato finché il blocco non scade.
+class BlocchiService:
+    @staticmethod
+    def blocca(id_utente, id_proiezione, posti):
+        massimi = current_app.config['BLOCCO_POSTI_MASSIMI']
+        posti = list(dict.fromkeys(posti))
+        if not posti or len(posti) > massimi:
+            raise ValueError(f"Si possono bloccare da 1 a {massimi} posti")
+
+        if BlocchiService.serializza_proiezione(id_proiezione) < datetime.now():
+            raise ValueError('La proiezione è già iniziata')
+        adesso = _adesso()
+
+        # il limite vale per tutti i blocchi attivi dell'utente sulla proiezione, non solo per
+        # questa richiesta, altrimenti con più richieste (e rinnova) si bloccherebbe tutta la sala.
+        # Il conteggio è sotto il lock della proiezione, quindi due richieste insieme non lo superano.
+        # I posti richiesti che l'utente ha già bloccato si contano una volta sola.
+        gia_bloccati = db.session.query(db.func.count()).select_from(BloccoPosto).filter(
+            BloccoPosto.id_proiezione == id_proiezione,
+            BloccoPosto.id_utente == id_utente,
+            BloccoPosto.scadenza > adesso,
+            BloccoPosto.id_posto.notin_(posti)
+        ).scalar()
+        if gia_bloccati + len(posti) > massimi:
+            raise ValueError(f"Si possono bloccare al massimo {massimi} posti per proiezione: "
+                             f"ne hai già {gia_bloccati} bloccati")
+        scadenza = adesso + timedelta(seconds=current_app.config['BLOCCO_POSTI_DURATA'])
+
+        # prendo solo i posti della sala giusta e non ancora venduti; se un posto ha già un blocco
+        # lo sovrascrivo solo se è scaduto o se è dello stesso utente
+        liberi = db.select(
+            db.literal(id_proiezione), Posto.id, db.literal(id_utente), db.literal(scadenza)
+        ).join(Proiezione, Proiezione.id_sala == Posto.id_sala) \
+            .where(Proiezione.id == id_proiezione, Posto.id.in_(posti)) \
+            .where(~db.exists().where(Biglietto.id_proiezione == id_proiezione, Biglietto.id_posto == Posto.id))
+
+        istruzione = insert(BloccoPosto).from_select(['id_proiezione', 'id_posto', 'id_utente', 'scadenza'], liberi)
+        istruzione = istruzione.on_conflict_do_update(
+            index_elements=[BloccoPosto.id_proiezione, BloccoPosto.id_posto],
+            set_={'id_utente': istruzione.excluded.id_utente, 'scadenza': istruzione.excluded.scadenza},
+            where=(BloccoPosto.scadenza <= adesso) | (BloccoPosto.id_utente == id_utente)
+        ).returning(BloccoPosto.id_posto)
+        bloccati = list(db.session.execute(istruzione).scalars())
+
+        blocchi_posti.registra(db.session, id_proiezione, id_utente, bloccati, _timestamp(scadenza))
+        db.session.commit()
+
+        presi = set(bloccati)
+        return {
+            'posti': bloccati,
+            'non_disponibili': [id_posto for id_posto in posti if id_posto not in presi],
+            'scadenza': scadenza.replace(tzinfo=timezone.utc).isoformat()
+        }
+
+    @staticmethod
+    def rinnova(id_utente, id_proiezione):
+        adesso = _adesso()
+        scadenza = adesso + timedelta(seconds=current_app.config['BLOCCO_POSTI_DURATA'])
+
+        # un blocco già scaduto non si rinnova: nel frattempo il posto potrebbe averlo preso un altro
+        rinnovati = list(db.session.execute(
+            db.update(BloccoPosto)
+            .where(BloccoPosto.id_proiezione == id_proiezione,
+                   BloccoPosto.id_utente == id_utente,
+                   BloccoPosto.scadenza > adesso)
+            .values(scadenza=scadenza)
+            .returning(BloccoPosto.id_posto)
+        ).scalars())
+
+        blocchi_posti.registra(db.session, id_proiezione, id_utente, rinnovati, _timestamp(scadenza))
+        db.session.commit()
+
+        return {'posti': rinnovati, 'scadenza': scadenza.replace(tzinfo=timezone.utc).isoformat()}
+
+    @staticmethod
+    def rilascia(id_utente, id_proiezione, posti=None):
+        istruzione = db.delete(BloccoPosto).where(
+            BloccoPosto.id_proiezione == id_proiezione,
+            BloccoPosto.id_utente == id_utente
+        )
+        if posti:
+            istruzione = istruzione.where(BloccoPosto.id_posto.in_(posti))
+        rilasciati = list(db.session.execute(istruzione.returning(BloccoPosto.id_posto)).scalars())
+
+        blocchi_posti.registra(db.session, id_proiezione, id_utente, rilasciati, None)
+        db.session.commit()
+        return rilasciati
+
+    # Da chiamare nella transazione dell'acquisto, prima di inserire i biglietti:
+    # i blocchi dell'utente su quei posti vengono tolti insieme all'inserimento dei biglietti,
+    # mentre se un posto è bloccato da qualcun altro l'acquisto fallisce.
+    @staticmethod
+    def converti(id_utente, id_proiezione, posti):
+        BlocchiService.serializza_proiezione(id_proiezione)
+        adesso = _adesso()
+
+        # un solo DELETE per tutti i blocchi su quei posti: se tra questi ce n'è uno ancora valido
+        # di un altro utente l'acquisto fallisce e il rollback del chiamante lo rimette a posto
+        tolti = db.session.execute(
+            db.delete(BloccoPosto)
+            .where(BloccoPosto.id_proiezione == id_proiezione, BloccoPosto.id_posto.in_(posti))
+            .returning(BloccoPosto.id_posto, BloccoPosto.id_utente, BloccoPosto.scadenza)
+        ).all()
+        if any(blocco.id_utente != id_utente and blocco.scadenza > adesso for blocco in tolti):
+            raise ValueError('Alcuni posti selezionati sono bloccati da un altro utente')
+
+        blocchi_posti.registra(db.session, id_proiezione, id_utente, [blocco.id_posto for blocco in tolti], None)
+
+    # Blocca la riga della proiezione fino alla fine della transazione: blocchi e acquisti
+    # sulla stessa proiezione passano uno alla volta, quelli su proiezioni diverse no.
+    # L'attesa è limitata da LOCK_PROIEZIONE_TIMEOUT: oltre, la transazione fallisce
+    # e utils/transazioni la ripete.
+    # FOR NO KEY UPDATE e non FOR UPDATE: l'insert dell'ordine (o del blocco) prende un
+    # FOR KEY SHARE sulla proiezione per la foreign key, e con FOR UPDATE due acquisti
+    # che hanno già creato l'ordine andrebbero in deadlock.
+    @staticmethod
+    def serializza_proiezione(id_proiezione):
+        db.session.execute(text("SELECT set_config('lock_timeout', :timeout, true)"),
+                           {'timeout': f"{current_app.config['LOCK_PROIEZIONE_TIMEOUT']}ms"})
+        data_ora = db.session.query(Proiezione.data_ora) \
+            .filter(Proiezione.id == id_proiezione) \
+            .with_for_update(key_share=True) \
+            .scalar()
+        if data_ora is None:
+            raise ValueError('Proiezione non trovata')
+        return data_ora
+
+    # Blocchi attivi di una proiezione, {id_posto: (id_utente, scadenza)}
+    @staticmethod
+    def get_blocchi(id_proiezione):
+        blocchi = blocchi_posti.get(id_proiezione)
+        if blocchi is not None:
+            return blocchi
+
+        epoca = blocchi_posti.epoca()
+        righe = db.session.query(BloccoPosto.id_posto, BloccoPosto.id_utente, BloccoPosto.scadenza) \
+            .filter(BloccoPosto.id_proiezione == id_proiezione, BloccoPosto.scadenza > _adesso()) \
+            .all()
+        return blocchi_posti.salva(
+            id_proiezione,
+            [(id_posto, id_utente, _timestamp(scadenza)) for id_posto, id_utente, scadenza in righe],
+            epoca
+        )
@@ -1,5 +1,14 @@
-from ..models import Film
-from ..dto.film_dto import FilmDTO
+import json
+
+from flask import current_app
+from sqlalchemy import Double, cast, func, or_, and_
+
+from ..models import Film, db
+from ..dto.film_dto import FilmDTO, RisultatoRicercaDTO
+from ..utils.catalogo_film import catalogo_film, Catalogo
+from ..utils.indice_ricerca import (indice_film, evidenzia, html_evidenziato,
+                                    INIZIO_EVIDENZIATO, FINE_EVIDENZIATO)
+from ..utils.versioni import versioni
 
 
 class FilmService:
@@ -14,3 +23,116 @@ class FilmService:
     def get_film_per_id(film_id: int):
         film = Film.query.get(film_id)
         return FilmDTO.from_model(film) if film else None
+
+    @staticmethod
+    # Versione del catalogo e data dell'ultima modifica, per ETag e Last-Modified
+    def get_versione_catalogo():
+        return versioni.get('film')
+
+    @staticmethod
+    # Una pagina del catalogo in ordine di id, filtrata per generi (basta uno) e per una parte
+    # del titolo. dopo_id è l'id dell'ultimo film della pagina precedente.
+    # Ritorna (film, id dell'ultimo film se ce ne sono altri, altrimenti None).
+    def get_pagina_film(generi=None, titolo=None, dopo_id=None, limite=20):
+        query = Film.query
+        if generi:
+            # && sull'array usa l'indice GIN idx_film_generi
+            query = query.filter(Film.generi.overlap(generi))
+        if titolo:
+            # ILIKE con % da entrambi i lati usa l'indice trigram idx_film_titolo_trgm
+            escape = titolo.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_')
+            query = query.filter(Film.titolo.ilike(f'%{escape}%', escape='\\'))
+        if dopo_id is not None:
+            query = query.filter(Film.id > dopo_id)
+
+        # uno in più per sapere se c'è una pagina successiva
+        film = query.order_by(Film.id).limit(limite + 1).all()
+        prossimo = film[limite - 1].id if len(film) > limite else None
+        return [FilmDTO.from_model(f) for f in film[:limite]], prossimo
+
+    @staticmethod
+    # Ricerca nel titolo, nel regista e nella descrizione, in ordine di punteggio e poi di id.
+    # dopo è (punteggio, id) dell'ultimo risultato della pagina precedente.
+    # Ritorna (risultati, (punteggio, id) dell'ultimo se ce ne sono altri, altrimenti None).
+    def cerca_film(testo, dopo=None, limite=20):
+        if db.engine.dialect.name == 'postgresql':
+            risultati = FilmService._cerca_postgres(testo, dopo, limite)
+        else:
+            risultati = FilmService._cerca_indice(testo, dopo, limite)
+        prossimo = (risultati[limite - 1].punteggio, risultati[limite - 1].id) if len(risultati) > limite else None
+        return risultati[:limite], prossimo
+
+    @staticmethod
+    def _cerca_postgres(testo, dopo, limite):
+        # websearch_to_tsquery accetta quello che scrive un utente ("frasi", -esclusi, or)
+        # senza errori di sintassi; @@ usa l'indice GIN idx_film_ricerca
+        query = func.websearch_to_tsquery('italian', testo)
+        # float8 perché il punteggio del cursore torni identico nel confronto
+        punteggio = cast(func.ts_rank(Film.ricerca, query), Double)
+
+        # prima trovo la pagina, poi calcolo gli estratti (ts_headline è costoso) solo per quella
+        pagina = db.session.query(Film.id.label('id'), punteggio.label('punteggio')).filter(Film.ricerca.op('@@')(query))
+        if dopo is not None:
+            pagina = pagina.filter(or_(punteggio < dopo[0], and_(punteggio == dopo[0], Film.id > dopo[1])))
+        pagina = pagina.order_by(punteggio.desc(), Film.id).limit(limite + 1).subquery()
+
+        # ts_headline non fa l'escape dell'HTML: le parole trovate escono tra due delimitatori,
+        # tolti prima dal testo del film, e i <mark> si mettono dopo l'escape (html_evidenziato)
+        delimitatori = f'StartSel={INIZIO_EVIDENZIATO}, StopSel={FINE_EVIDENZIATO}'
+        righe = db.session.query(
+            Film,
+            pagina.c.punteggio,
+            func.ts_headline('italian', FilmService._senza_delimitatori(Film.titolo), query,
+                             f'HighlightAll=true, {delimitatori}'),
+            func.ts_headline('italian', FilmService._senza_delimitatori(Film.descrizione), query,
+                             f'{delimitatori}, MaxFragments=2, MaxWords=20, MinWords=8')
+        ).join(pagina, Film.id == pagina.c.id).order_by(pagina.c.punteggio.desc(), Film.id).all()
+        return [RisultatoRicercaDTO.from_film(FilmDTO.from_model(film), p, html_evidenziato(titolo),
+                                              html_evidenziato(estratto))
+                for film, p, titolo, estratto in righe]
+
+    @staticmethod
+    def _senza_delimitatori(colonna):
+        return func.translate(colonna, INIZIO_EVIDENZIATO + FINE_EVIDENZIATO, '')
+
+    @staticmethod
+    # Senza Postgres la ricerca si fa sull'indice in memoria costruito dal catalogo (utils/indice_ricerca)
+    def _cerca_indice(testo, dopo, limite):
+        indice = indice_film.get(FilmService.get_catalogo())
+        risultati, cercate = indice.cerca(testo, dopo, limite)
+        return [RisultatoRicercaDTO.from_film(
+            FilmDTO(**indice.film(id_film)),
+            p,
+            evidenzia(indice.film(id_film)['titolo'], cercate),
+            evidenzia(indice.film(id_film)['descrizione'], cercate)
+        ) for p, id_film in risultati]
+
+    @staticmethod
+    # Catalogo già serializzato (utils/catalogo_film), ricostruito solo quando cambiano i film
+    def get_catalogo() -> Catalogo:
+        versione, ultima_modifica = FilmService.get_versione_catalogo()
+        catalogo, da_ricostruire = catalogo_film.get(versione)
+        if da_ricostruire:
+            catalogo = catalogo_film.ricostruisci(
+                versione, lambda: FilmService._costruisci_catalogo(versione, ultima_modifica)
+            ) or catalogo
+        return catalogo
+
+    @staticmethod
+    # Da chiamare all'avvio del worker, così la prima richiesta non paga la costruzione del catalogo
+    def precarica_catalogo():
+        try:
+            catalogo = FilmService.get_catalogo()
+            current_app.logger.info(f"Catalogo dei film precaricato: {len(catalogo.per_id)} film")
+        except Exception as e:
+            # database non raggiungibile all'avvio: il catalogo si costruirà alla prima richiesta
+            current_app.logger.warning(f"Catalogo dei film non precaricato: {e}")
+
+    @staticmethod
+    def _costruisci_catalogo(versione, ultima_modifica):
+        # la versione è letta prima dei film: se cambiano nel frattempo il catalogo
+        # ha una versione vecchia e alla prossima richiesta si ricostruisce
+        film = [FilmDTO.from_model(film).to_dict() for film in Film.query.order_by(Film.id)]
+        per_id = {voce['id']: json.dumps(voce, separators=(',', ':')).encode() for voce in film}
+        lista = b'[' + b','.join(per_id.values()) + b']'
+        return Catalogo(versione, ultima_modifica, lista, per_id)
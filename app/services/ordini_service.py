@@ -1,14 +1,18 @@
 from datetime import datetime
 from typing import List, Dict
 
-from flask import current_app
+from flask import current_app, url_for
 from flask_login import current_user
-from sqlalchemy import and_
+from sqlalchemy import and_, tuple_
 
-from ..models import Ordine, Biglietto, Proiezione, db, Film, Posto, Sala
+from ..models import Ordine, Biglietto, Proiezione, db, Film, Posto, Sala, STATO_PDF_IN_ATTESA, STATO_PDF_PRONTO, \
+    STATO_PDF_ERRORE
 from ..dto.ordini_dto import OrdineDTO
-from ..utils.pdf_utils import genera_biglietto_pdf
-from ..utils.cloudinary_utils import upload_pdf_to_cloudinary
+from ..utils.frammenti_pdf import genera_pdf_ordine_incrementale, archivio_frammenti, pdf_ordine, versione_ordine
+from ..utils.storage import get_storage
+from ..utils.coda_pdf import coda_pdf
+from .posto_service import PostoService
+from .biglietti_service import BigliettiService
 
 
 class OrdiniService:
@@ -23,11 +27,17 @@ class OrdiniService:
         db.session.flush()
         return ordine
 
+    # Una pagina degli ordini dell'utente, dal più recente: stato 'prossimi' o 'passati' tiene solo
+    # gli ordini per proiezioni non ancora iniziate o già iniziate. dopo è (data_acquisto, id)
+    # dell'ultimo ordine della pagina precedente. La pagina si legge dall'indice
+    # idx_ordine_utente_data e i biglietti solo per i suoi ordini, quindi costa uguale
+    # qualunque sia la lunghezza dello storico.
+    # Ritorna (ordini, (data_acquisto, id) dell'ultimo se ce ne sono altri, altrimenti None).
     @staticmethod
-    def get_ordini_utente() -> List['OrdineDTO']:
+    def get_ordini_utente(stato=None, dopo=None, limite=20):
         try:
             # Query principale per ottenere ordini e relazioni
-            ordini = db.session.query(
+            query = db.session.query(
                 Ordine, Proiezione, Film, Sala
             ).join(
                 Proiezione, Ordine.id_proiezione == Proiezione.id
@@ -37,9 +47,20 @@ class OrdiniService:
                 Sala, Proiezione.id_sala == Sala.id
             ).filter(
                 Ordine.id_utente == current_user.id
-            ).order_by(
-                Ordine.data_acquisto.desc()
-            ).all()
+            )
+            if stato == 'prossimi':
+                query = query.filter(Proiezione.data_ora > datetime.now())
+            elif stato == 'passati':
+                query = query.filter(Proiezione.data_ora <= datetime.now())
+            if dopo is not None:
+                query = query.filter(tuple_(Ordine.data_acquisto, Ordine.id) < tuple_(*dopo))
+
+            # uno in più per sapere se c'è una pagina successiva
+            ordini = query.order_by(
+                Ordine.data_acquisto.desc(), Ordine.id.desc()
+            ).limit(limite + 1).all()
+            prossimo = (ordini[limite - 1][0].data_acquisto, ordini[limite - 1][0].id) if len(ordini) > limite else None
+            ordini = ordini[:limite]
 
             # Query per ottenere i biglietti relativi
             biglietti = db.session.query(
@@ -48,7 +69,7 @@ class OrdiniService:
                 Posto, Biglietto.id_posto == Posto.id
             ).filter(
                 Biglietto.id_ordine.in_([ordine.id for ordine, _, _, _ in ordini])
-            ).all()
+            ).order_by(Biglietto.id).all() if ordini else []
 
             # Organizza i biglietti per ordine
             biglietti_per_ordine = {}
@@ -65,10 +86,10 @@ class OrdiniService:
                     biglietti=biglietti_per_ordine.get(ordine.id, [])
                 )
                 for ordine, proiezione, film, sala in ordini
-            ]
+            ], prossimo
         except Exception as e:
             current_app.logger.error(f"Error fetching orders: {str(e)}")
-            return []
+            return [], None
 
     @staticmethod
     def elimina_ordine(ordine_id, user_id):
@@ -86,59 +107,52 @@ class OrdiniService:
         if proiezione.data_ora < datetime.now():
             raise ValueError('Non puoi eliminare un ordine per una proiezione passata')
 
+        biglietti = Biglietto.query.with_entities(Biglietto.id, Biglietto.id_posto).filter_by(id_ordine=ordine_id).all()
+        id_biglietti = [b.id for b in biglietti]
+        id_proiezione = ordine.id_proiezione
+        pdf_url = ordine.pdf_url
         Biglietto.query.filter_by(id_ordine=ordine_id).delete()
         db.session.delete(ordine)
+        PostoService.registra_variazione(id_proiezione, liberati=[b.id_posto for b in biglietti])
         db.session.commit()
 
+        for id_biglietto in id_biglietti:
+            archivio_frammenti.elimina(id_biglietto)
+        archivio_frammenti.elimina_ordine(ordine_id)
+        OrdiniService._elimina_pdf_superato(pdf_url)
+
+    # Ritorna (ordine, biglietti aggiunti come BigliettoAcquistatoDTO)
     @staticmethod
-    def aggiungi_biglietti(ordine_id: int, user_id: int, biglietti_data: List[Dict]) -> str:
-        ordine = Ordine.query.filter(
+    def aggiungi_biglietti(ordine_id: int, user_id: int, biglietti_data: List[Dict]):
+        # ordine e data della proiezione con una sola query
+        ordine, data_ora = db.session.query(
+            Ordine, Proiezione.data_ora
+        ).join(
+            Proiezione, Ordine.id_proiezione == Proiezione.id
+        ).filter(
             and_(
                 Ordine.id == ordine_id,
                 Ordine.id_utente == user_id
             )
-        ).first()
+        ).first() or (None, None)
 
         if not ordine:
             raise ValueError('Ordine non trovato')
 
-        proiezione = Proiezione.query.get(ordine.id_proiezione)
-        if proiezione.data_ora < datetime.now():
+        if data_ora < datetime.now():
             raise ValueError('Non puoi modificare un ordine per una proiezione passata')
 
-        posti_richiesti = [b['id_posto'] for b in biglietti_data]
-        posti_occupati = Biglietto.query.filter(
-            and_(
-                Biglietto.id_proiezione == ordine.id_proiezione,
-                Biglietto.id_posto.in_(posti_richiesti),
-                Biglietto.id_ordine != ordine.id
-            )
-        ).all()
-
-        if posti_occupati:
-            raise ValueError('Alcuni posti selezionati non sono più disponibili')
-
-        for biglietto_data in biglietti_data:
-            nuovo_biglietto = Biglietto(
-                id_proiezione=ordine.id_proiezione,
-                id_utente=user_id,
-                id_posto=biglietto_data['id_posto'],
-                id_ordine=ordine.id,
-                nome_ospite=biglietto_data.get('nome_ospite'),
-                cognome_ospite=biglietto_data.get('cognome_ospite')
-            )
-            db.session.add(nuovo_biglietto)
-
-        db.session.flush()
-
-        pdf_url = OrdiniService._genera_pdf_ordine(ordine.id)
-        ordine.pdf_url = pdf_url
+        # stesso percorso dell'acquisto: lock sulla proiezione, blocchi convertiti e
+        # insert che si ferma sui posti già venduti (PostiNonDisponibili)
+        biglietti = BigliettiService.acquista_biglietto(user_id, ordine.id_proiezione, biglietti_data, ordine.id)
+        OrdiniService.segna_pdf_da_generare(ordine)
         db.session.commit()
+        coda_pdf.accoda(ordine_id)
 
-        return pdf_url
+        return ordine, biglietti
 
     @staticmethod
-    def rimuovi_posto(ordine_id, user_id, id_posto) -> str:
+    def rimuovi_posto(ordine_id, user_id, id_posto) -> Ordine:
         ordine = Ordine.query.filter(
             and_(
                 Ordine.id == ordine_id,
@@ -168,26 +182,124 @@ class OrdiniService:
         if num_biglietti <= 1:
             raise ValueError('Non puoi rimuovere l\'ultimo posto di un ordine')
 
+        id_biglietto = biglietto.id
         db.session.delete(biglietto)
-        db.session.flush()
-
-        pdf_url = OrdiniService._genera_pdf_ordine(ordine_id)
-        ordine.pdf_url = pdf_url
+        PostoService.registra_variazione(ordine.id_proiezione, liberati=[id_posto])
+        OrdiniService.segna_pdf_da_generare(ordine)
         db.session.commit()
 
-        return pdf_url
+        # la pagina del biglietto rimosso non servirà più per ricomporre il PDF
+        archivio_frammenti.elimina(id_biglietto)
+        coda_pdf.accoda(ordine.id)
+
+        return ordine
+
+    @staticmethod
+    def get_stato_pdf(ordine_id, user_id) -> Ordine:
+        ordine = Ordine.query.filter(
+            and_(
+                Ordine.id == ordine_id,
+                Ordine.id_utente == user_id
+            )
+        ).first()
+
+        if not ordine:
+            raise ValueError('Ordine non trovato')
+
+        return ordine
+
+    # Da chiamare prima del commit ogni volta che cambiano i biglietti di un ordine.
+    # Con PDF_SU_RICHIESTA il PDF non si genera in anticipo: l'URL punta all'endpoint
+    # che lo renderizza al primo download, altrimenti ci pensa la coda dopo il commit.
+    @staticmethod
+    def segna_pdf_da_generare(ordine):
+        if current_app.config['PDF_SU_RICHIESTA']:
+            ordine.pdf_url = url_for('ordini_pdf_ordine', ordine_id=ordine.id, _external=True)
+            ordine.stato_pdf = STATO_PDF_PRONTO
+        else:
+            ordine.stato_pdf = STATO_PDF_IN_ATTESA
+
+    @staticmethod
+    def get_pdf_ordine(ordine_id, user_id):
+        ordine = Ordine.query.filter(
+            and_(
+                Ordine.id == ordine_id,
+                Ordine.id_utente == user_id
+            )
+        ).first()
+
+        if not ordine:
+            raise ValueError('Ordine non trovato')
+
+        # ritorna (versione, file aperto): il PDF viene renderizzato solo se questa versione non è in cache
+        return pdf_ordine(OrdiniService._info_biglietti(ordine_id), ordine_id, ordine.utente)
 
     @staticmethod
-    def _genera_pdf_ordine(ordine_id):
-        tickets_info = (
+    def _info_biglietti(ordine_id):
+        return (
             db.session.query(Biglietto, Film, Proiezione, Sala, Posto)
             .join(Proiezione, Biglietto.id_proiezione == Proiezione.id)
             .join(Film, Proiezione.id_film == Film.id)
             .join(Sala, Proiezione.id_sala == Sala.id)
             .join(Posto, Biglietto.id_posto == Posto.id)
             .filter(Biglietto.id_ordine == ordine_id)
+            .order_by(Biglietto.id)
             .all()
         )
 
-        pdf_buffer = genera_biglietto_pdf(tickets_info, ordine_id)
-        return upload_pdf_to_cloudinary(pdf_buffer, f"biglietto{ordine_id}{datetime.now()}")
+    # Eseguito dalla coda dei PDF, in un thread separato e con un suo app context.
+    # Con più worker lo stesso ordine può essere in coda in due processi, e uno dei due
+    # può aver letto i biglietti prima di una modifica: il rendering si fa senza lock, poi
+    # si blocca la riga dell'ordine e si salva l'URL solo se i biglietti sono ancora quelli
+    # renderizzati. Altrimenti il PDF è già superato e ci pensa il job accodato dalla modifica.
+    @staticmethod
+    def genera_pdf_ordine(ordine_id):
+        ordine = Ordine.query.get(ordine_id)
+        if not ordine:
+            # l'ordine è stato eliminato mentre era in coda
+            return
+
+        try:
+            # si renderizzano solo le pagine dei biglietti nuovi, le altre si riusano
+            versione, pdf_buffer = genera_pdf_ordine_incrementale(
+                OrdiniService._info_biglietti(ordine_id), ordine_id, ordine.utente
+            )
+            nuovo_url = get_storage().salva(pdf_buffer)
+            # chiudo la transazione delle letture, così il lock si prende su dati aggiornati
+            db.session.rollback()
+
+            ordine = Ordine.query.filter_by(id=ordine_id).with_for_update().populate_existing().first()
+            if not ordine or versione_ordine(OrdiniService._info_biglietti(ordine_id), ordine_id,
+                                             ordine.utente) != versione:
+                db.session.rollback()
+                OrdiniService._elimina_pdf_superato(nuovo_url)
+                return
+
+            # letto sotto lock: è l'URL che questo PDF sostituisce davvero
+            vecchio_url = ordine.pdf_url
+            ordine.pdf_url = nuovo_url
+            ordine.stato_pdf = STATO_PDF_PRONTO
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            ordine = Ordine.query.get(ordine_id)
+            if ordine:
+                ordine.stato_pdf = STATO_PDF_ERRORE
+                db.session.commit()
+            raise
+
+        if vecchio_url != nuovo_url:
+            OrdiniService._elimina_pdf_superato(vecchio_url)
+
+    # Elimina dallo storage un PDF che non è più usato da nessun ordine.
+    # Se fallisce lo segno e basta: al massimo resta un file orfano.
+    @staticmethod
+    def _elimina_pdf_superato(url):
+        if not url:
+            return
+
+        try:
+            if not Ordine.query.filter_by(pdf_url=url).first():
+                get_storage().elimina_url(url)
+        except Exception as e:
+            current_app.logger.warning(f"Impossibile eliminare il PDF superato {url}: {e}")
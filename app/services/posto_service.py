@@ -1,21 +1,169 @@
-from ..models import Posto, Biglietto, Proiezione, Sala
-from ..dto.posto_dto import PostoDTO, PostoOccupatoDTO
+from sqlalchemy import func, text
+
+from ..models import Posto, Biglietto, Proiezione, Sala, db
+from ..dto.posto_dto import PostoDTO, PostoOccupatoDTO, MappaPostiDTO
+from ..utils.mappa_posti import mappa_posti, LayoutSala, Variazione, CANALE_NOTIFICHE
+from ..utils.layout_sale import layout_sale
+from ..utils.notifiche import notifiche
+from ..utils.versioni import versioni
+from .blocchi_service import BlocchiService
 
 
 class PostoService:
+    # I posti vengono dal layout della sala in cache (utils/layout_sale)
     @staticmethod
     def get_posti_proiezione(id_proiezione: int) -> list[PostoDTO]:
-        posti = Posto.query.join(Sala, Sala.id == Posto.id_sala) \
-            .join(Proiezione, Proiezione.id_sala == Sala.id) \
-            .filter(Proiezione.id == id_proiezione).all()
+        voce = PostoService._get_voce_mappa(id_proiezione)
+        if voce is None:
+            return []
+
+        return [PostoDTO(id=id_posto, fila=fila, numero=numero) for id_posto, fila, numero in voce.layout.posti()]
 
-        return [PostoDTO.from_model(posto) for posto in posti]
+    # Come get_posti_proiezione, ma già serializzati in JSON
+    @staticmethod
+    def get_posti_proiezione_json(id_proiezione: int) -> bytes:
+        voce = PostoService._get_voce_mappa(id_proiezione)
+        return voce.layout.json_posti if voce is not None else b'[]'
 
+    # Servito dalla cache dell'occupazione come la mappa dei posti.
+    # I posti bloccati da qualcuno durante il checkout risultano occupati anche qui.
     @staticmethod
     def get_posti_occupati(projection_id: int) -> list[PostoOccupatoDTO]:
-        posti_occupati = Posto.query \
-            .join(Biglietto, Biglietto.id_posto == Posto.id) \
-            .filter(Biglietto.id_proiezione == projection_id) \
+        voce = PostoService._get_voce_mappa(projection_id)
+        if voce is None:
+            return []
+
+        layout = voce.layout
+        bloccati = PostoService._get_bloccati(projection_id, voce)
+        indici = sorted(set(voce.occupati.indici_attivi()) | set(bloccati.indici_attivi()))
+        return [PostoOccupatoDTO(fila=layout.nomi_file[layout.righe[i]], numero=layout.numeri[i]) for i in indici]
+
+    # Layout della sala e occupazione in una sola risposta.
+    # L'occupazione viene dalla cache in memoria, il database si legge solo
+    # la prima volta che qualcuno apre la mappa di quella proiezione.
+    @staticmethod
+    def get_mappa_posti(id_proiezione: int):
+        voce = PostoService._get_voce_mappa(id_proiezione)
+        if voce is None:
+            return None
+
+        return MappaPostiDTO.from_mappa(id_proiezione, voce, PostoService._get_bloccati(id_proiezione, voce))
+
+    # Il miglior gruppo di quanti posti vicini (stessa fila, numeri consecutivi) liberi e non
+    # bloccati, il più centrale possibile. Ritorna None se la proiezione non esiste e una
+    # lista vuota se non c'è un gruppo abbastanza grande.
+    @staticmethod
+    def get_posti_migliori(id_proiezione: int, quanti: int):
+        voce = PostoService._get_voce_mappa(id_proiezione)
+        if voce is None:
+            return None
+
+        non_disponibili = voce.occupati.unione(PostoService._get_bloccati(id_proiezione, voce))
+        trovato = voce.layout.griglia().cerca(non_disponibili.to_stringa(), quanti)
+        if trovato is None:
+            return []
+
+        primo, _ = trovato
+        return [PostoDTO(id=id_posto, fila=fila, numero=numero)
+                for id_posto, fila, numero in voce.layout.posti(primo, primo + quanti)]
+
+    # Bitset in base64 dei posti bloccati, per lo stream; None se la proiezione non esiste
+    @staticmethod
+    def get_posti_bloccati(id_proiezione: int):
+        voce = PostoService._get_voce_mappa(id_proiezione)
+        if voce is None:
+            return None
+        return PostoService._get_bloccati(id_proiezione, voce).to_base64()
+
+    # ETag degli endpoint dei posti: il layout dipende dalla sala e dalla sua versione,
+    # l'occupazione dalla versione della proiezione e dai blocchi attivi (che non hanno
+    # una versione, scadono da soli: uso un'impronta del loro bitset).
+    # Ritorna None se la proiezione non esiste.
+    @staticmethod
+    def get_versioni_posti(id_proiezione: int):
+        voce = PostoService._get_voce_mappa(id_proiezione)
+        if voce is None:
+            return None
+
+        versione_sala, _ = versioni.get(f'sala:{voce.layout.id_sala}')
+        blocchi = PostoService._get_bloccati(id_proiezione, voce).impronta()
+        return {
+            'layout': f'posti-{voce.layout.id_sala}-{versione_sala}',
+            'occupazione': f'occupazione-{voce.versione}-{blocchi}',
+            'mappa': f'mappa-{voce.layout.id_sala}-{versione_sala}-{voce.versione}-{blocchi}',
+        }
+
+    # Da chiamare nella transazione che crea o elimina dei biglietti, prima del commit.
+    # Incrementa la versione dell'occupazione e aggiorna i posti disponibili (e intanto blocca
+    # la riga della proiezione fino al commit), avvisa gli altri worker e aggiorna la cache
+    # locale dopo il commit.
+    @staticmethod
+    def registra_variazione(id_proiezione, occupati=(), liberati=()):
+        occupati, liberati = list(occupati), list(liberati)
+        versione = db.session.execute(
+            db.update(Proiezione)
+            .where(Proiezione.id == id_proiezione)
+            .values(versione_occupazione=Proiezione.versione_occupazione + 1,
+                    posti_disponibili=Proiezione.posti_disponibili - len(occupati) + len(liberati))
+            .returning(Proiezione.versione_occupazione)
+        ).scalar_one()
+        return PostoService.notifica_variazione(id_proiezione, versione, occupati, liberati)
+
+    # Il resto di registra_variazione, per chi ha già fatto l'UPDATE della proiezione
+    # dentro la propria query (BigliettiService.inserisci_biglietti)
+    @staticmethod
+    def notifica_variazione(id_proiezione, versione, occupati=(), liberati=()):
+        variazione = Variazione(id_proiezione, versione, list(occupati), list(liberati))
+        if notifiche.attive:
+            # NOTIFY viene consegnato solo se la transazione va a buon fine
+            db.session.execute(text("SELECT pg_notify(:canale, :payload)"),
+                               {'canale': CANALE_NOTIFICHE, 'payload': variazione.to_payload()})
+        db.session.info.setdefault('variazioni_occupazione', []).append(variazione)
+        return variazione
+
+    @staticmethod
+    def _get_voce_mappa(id_proiezione):
+        voce = mappa_posti.get(id_proiezione)
+        if voce is not None and PostoService._get_layout(voce.layout.id_sala) is not voce.layout:
+            # i posti della sala sono cambiati: il bitset non corrisponde più al layout
+            voce = None
+        if voce is None:
+            voce = PostoService._carica_mappa(id_proiezione)
+        return voce
+
+    @staticmethod
+    def _get_layout(id_sala):
+        versione, _ = versioni.get(f'sala:{id_sala}')
+        layout = layout_sale.get(id_sala, versione)
+        if layout is not None:
+            return layout
+
+        sala = db.session.get(Sala, id_sala)
+        posti = db.session.query(Posto.id, Posto.fila, Posto.numero) \
+            .filter(Posto.id_sala == id_sala) \
+            .order_by(Posto.fila, Posto.numero) \
             .all()
+        return layout_sale.salva(id_sala, versione, LayoutSala(sala.id, sala.nome, [tuple(posto) for posto in posti]))
+
+    @staticmethod
+    def _get_bloccati(id_proiezione, voce):
+        return voce.layout.bitset(BlocchiService.get_blocchi(id_proiezione))
+
+    @staticmethod
+    def _carica_mappa(id_proiezione):
+        # versione e biglietti vanno letti con la stessa query, così sono coerenti tra loro
+        proiezione = db.session.query(
+            Proiezione.id_sala,
+            Proiezione.data_ora,
+            Proiezione.versione_occupazione,
+            func.array_remove(func.array_agg(Biglietto.id_posto), None)
+        ).outerjoin(Biglietto, Biglietto.id_proiezione == Proiezione.id) \
+            .filter(Proiezione.id == id_proiezione) \
+            .group_by(Proiezione.id) \
+            .first()
+        if not proiezione:
+            return None
 
-        return [PostoOccupatoDTO.from_model(posto) for posto in posti_occupati]
+        id_sala, data_ora, versione, id_occupati = proiezione
+        layout = PostoService._get_layout(id_sala)
+        return mappa_posti.salva(id_proiezione, layout, id_occupati, versione, data_ora)
@@ -1,17 +1,120 @@
+import zlib
+from dataclasses import replace
 from datetime import datetime
-from ..models import Proiezione
-from ..dto.proiezione_dto import ProiezioneDTO
+from sqlalchemy import text
+
+from ..models import Proiezione, Sala, Film, db
+from ..dto.proiezione_dto import ProiezioneDTO, ProiezioneProgrammaDTO
+from ..utils.proiezioni_film import proiezioni_film
+from ..utils.versioni import versioni
 
 
 # Prendo tutte le proiezioni future.
 class ProiezioneService:
     @staticmethod
     def get_proiezioni(film_id: int):
+        return ProiezioneService.get_proiezioni_versionate(film_id)[1]
+
+    # Ritorna (etag, proiezioni). La query si rifà solo se la versione è cambiata:
+    # altrimenti basta togliere dalla lista quelle iniziate nel frattempo, e siccome
+    # la lista è ordinata per data il numero di quelle rimaste completa l'ETag.
+    # I posti disponibili cambiano a ogni acquisto e non fanno cambiare la versione (altrimenti
+    # tutti gli acquisti sulle proiezioni di un film si metterebbero in coda sulla stessa riga
+    # di versione_risorsa): si leggono a ogni richiesta per chiave primaria, insieme a
+    # versione_occupazione, e finiscono nell'ETag.
+    @staticmethod
+    def get_proiezioni_versionate(film_id: int):
+        versione, _ = versioni.get(f'proiezioni:{film_id}')
         now = datetime.now()
-        proiezioni = Proiezione.query \
-            .filter_by(id_film=film_id) \
-            .filter(Proiezione.data_ora > now) \
-            .order_by(Proiezione.data_ora) \
-            .all()
 
-        return [ProiezioneDTO.from_model(p) for p in proiezioni]
+        proiezioni = proiezioni_film.get(film_id, versione)
+        if proiezioni is None:
+            proiezioni = [ProiezioneDTO.from_riga(p) for p in ProiezioneService._query_proiezioni()
+                          .filter(Proiezione.id_film == film_id, Proiezione.data_ora > now)
+                          .order_by(Proiezione.data_ora)
+                          .all()]
+            proiezioni_film.salva(film_id, versione, proiezioni)
+
+        future = [p for p in proiezioni if p.data_ora > now]
+        if not future:
+            return f'proiezioni-{versione}-0', future
+
+        occupazione = {
+            riga.id: riga for riga in db.session.query(
+                Proiezione.id, Proiezione.versione_occupazione, Proiezione.posti_disponibili
+            ).filter(Proiezione.id.in_([p.id for p in future]))
+        }
+        # i DTO in cache sono condivisi tra le richieste: se ne fa una copia
+        future = [replace(p, posti_disponibili=occupazione[p.id].posti_disponibili)
+                  for p in future if p.id in occupazione]
+        # posti_disponibili nell'impronta anche se segue versione_occupazione: lo cambia pure posti-riallinea
+        impronta = zlib.crc32(repr([(p.id, occupazione[p.id].versione_occupazione, p.posti_disponibili)
+                                    for p in future]).encode())
+        return f'proiezioni-{versione}-{len(future)}-{impronta:08x}', future
+
+    # Programmazione di tutti i film (o solo di quelli in film_ids) tra le date dal e al
+    # comprese, raggruppata per giorno: [(data, [ProiezioneProgrammaDTO, ...]), ...].
+    # Una sola query, le proiezioni già iniziate non ci sono (e nemmeno le esaurite con solo_disponibili).
+    @staticmethod
+    def get_programmazione(dal, al, film_ids=None, solo_disponibili=False):
+        inizio = max(datetime.combine(dal, datetime.min.time()), datetime.now())
+        fine = datetime.combine(al, datetime.max.time())
+
+        query = ProiezioneService._query_proiezioni(Proiezione.id_film, Film.titolo) \
+            .join(Film, Film.id == Proiezione.id_film) \
+            .filter(Proiezione.data_ora > inizio, Proiezione.data_ora <= fine)
+        if film_ids:
+            query = query.filter(Proiezione.id_film.in_(film_ids))
+        if solo_disponibili:
+            query = query.filter(Proiezione.posti_disponibili > 0)
+
+        giorni = []
+        for riga in query.order_by(Proiezione.data_ora, Film.titolo).all():
+            giorno = riga.data_ora.date()
+            if not giorni or giorni[-1][0] != giorno:
+                giorni.append((giorno, []))
+            giorni[-1][1].append(ProiezioneProgrammaDTO.from_riga(riga))
+        return giorni
+
+    # Ricalcola posti_disponibili da posto e biglietto per tutte le proiezioni future (o per tutte
+    # con anche_passate) e ritorna [(id_proiezione, valore vecchio, valore nuovo)] di quelle sbagliate.
+    # Le righe vengono bloccate prima di contare: un acquisto o una rimozione ancora in corso o ha
+    # già il lock, e allora si aspetta il suo commit e lo si conta, o lo prende dopo e applica la sua
+    # variazione al valore ricalcolato.
+    @staticmethod
+    def riallinea_posti_disponibili(anche_passate=False):
+        proiezioni = db.select(Proiezione.id)
+        if not anche_passate:
+            proiezioni = proiezioni.where(Proiezione.data_ora > datetime.now())
+        id_proiezioni = db.session.scalars(proiezioni.order_by(Proiezione.id).with_for_update(key_share=True)).all()
+        if not id_proiezioni:
+            return []
+
+        return db.session.execute(text("""
+            WITH calcolo AS (
+                SELECT p.id_proiezione,
+                       (SELECT count(*) FROM posto WHERE posto.id_sala = p.id_sala)
+                       - (SELECT count(*) FROM biglietto WHERE biglietto.id_proiezione = p.id_proiezione) AS disponibili
+                FROM proiezione p
+                WHERE p.id_proiezione = ANY(:id_proiezioni)
+            ), vecchi AS (
+                SELECT id_proiezione, posti_disponibili FROM proiezione WHERE id_proiezione = ANY(:id_proiezioni)
+            )
+            UPDATE proiezione SET posti_disponibili = calcolo.disponibili
+            FROM calcolo JOIN vecchi USING (id_proiezione)
+            WHERE proiezione.id_proiezione = calcolo.id_proiezione
+              AND proiezione.posti_disponibili <> calcolo.disponibili
+            RETURNING proiezione.id_proiezione, vecchi.posti_disponibili, calcolo.disponibili
+        """), {'id_proiezioni': id_proiezioni}).all()
+
+    # Solo le colonne che finiscono nei DTO, con il nome della sala già in join
+    @staticmethod
+    def _query_proiezioni(*colonne):
+        return db.session.query(
+            Proiezione.id,
+            Proiezione.data_ora,
+            Proiezione.costo,
+            Sala.nome.label('sala'),
+            Proiezione.posti_disponibili,
+            *colonne
+        ).join(Sala, Sala.id == Proiezione.id_sala)
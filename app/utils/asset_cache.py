@@ -0,0 +1,143 @@
+import hashlib
+import json
+import logging
+import os
+import tempfile
+import threading
+import time
+from collections import OrderedDict
+
+import requests
+
+from . import http_client
+
+logger = logging.getLogger(__name__)
+
+
+# Cache delle immagini usate nei biglietti (logo e locandine).
+# Il livello in memoria è un LRU limitato in byte, sotto c'è una copia su disco
+# così un worker appena avviato non deve riscaricare tutto dal CDN.
+# Scaduto il TTL la copia viene rivalidata con ETag / Last-Modified:
+# se il server risponde 304 si riusa quella che abbiamo già.
+class AssetCache:
+    def __init__(self, cartella, ttl=3600, max_byte=32 * 1024 * 1024):
+        self.cartella = cartella
+        self.ttl = ttl
+        self.max_byte = max_byte
+        self._voci = OrderedDict()
+        self._byte_occupati = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cartella, exist_ok=True)
+
+    def get(self, url):
+        voce = self._leggi_memoria(url)
+        if voce is None:
+            voce = self._leggi_disco(url)
+            if voce is not None:
+                self._salva_memoria(url, voce)
+
+        if voce is not None and voce['scadenza'] > time.time():
+            return voce['contenuto']
+
+        return self._scarica(url, voce)
+
+    def svuota(self):
+        with self._lock:
+            self._voci.clear()
+            self._byte_occupati = 0
+
+    def _scarica(self, url, voce):
+        headers = {}
+        if voce is not None:
+            if voce.get('etag'):
+                headers['If-None-Match'] = voce['etag']
+            if voce.get('last_modified'):
+                headers['If-Modified-Since'] = voce['last_modified']
+
+        try:
+            response = http_client.get(url, headers=headers)
+            if response.status_code == 304 and voce is not None:
+                # la copia che abbiamo è ancora buona, allungo solo la scadenza
+                voce = dict(voce, scadenza=time.time() + self.ttl)
+            else:
+                response.raise_for_status()
+                voce = {
+                    'contenuto': response.content,
+                    'etag': response.headers.get('ETag'),
+                    'last_modified': response.headers.get('Last-Modified'),
+                    'scadenza': time.time() + self.ttl,
+                }
+        except requests.RequestException as e:
+            if voce is None:
+                raise
+            # se il CDN non risponde uso la copia scaduta piuttosto che niente
+            logger.warning(f"Rivalidazione fallita per {url}, uso la copia in cache: {e}")
+            return voce['contenuto']
+
+        self._salva_memoria(url, voce)
+        self._salva_disco(url, voce)
+        return voce['contenuto']
+
+    def _leggi_memoria(self, url):
+        with self._lock:
+            voce = self._voci.get(url)
+            if voce is not None:
+                self._voci.move_to_end(url)
+            return voce
+
+    def _salva_memoria(self, url, voce):
+        dimensione = len(voce['contenuto'])
+        if dimensione > self.max_byte:
+            return
+
+        with self._lock:
+            vecchia = self._voci.pop(url, None)
+            if vecchia is not None:
+                self._byte_occupati -= len(vecchia['contenuto'])
+
+            self._voci[url] = voce
+            self._byte_occupati += dimensione
+
+            # tolgo le voci usate meno di recente finché non rientro nel limite
+            while self._byte_occupati > self.max_byte:
+                _, rimossa = self._voci.popitem(last=False)
+                self._byte_occupati -= len(rimossa['contenuto'])
+
+    def _percorsi(self, url):
+        chiave = hashlib.sha256(url.encode('utf-8')).hexdigest()
+        base = os.path.join(self.cartella, chiave)
+        return base + '.bin', base + '.json'
+
+    def _leggi_disco(self, url):
+        percorso_dati, percorso_meta = self._percorsi(url)
+        try:
+            with open(percorso_meta, 'r') as f:
+                meta = json.load(f)
+            with open(percorso_dati, 'rb') as f:
+                contenuto = f.read()
+        except (OSError, ValueError):
+            return None
+
+        return dict(meta, contenuto=contenuto)
+
+    def _salva_disco(self, url, voce):
+        percorso_dati, percorso_meta = self._percorsi(url)
+        meta = {k: v for k, v in voce.items() if k != 'contenuto'}
+        try:
+            # scrivo su file temporanei e poi rinomino, così un altro worker
+            # non legge mai un file scritto a metà
+            for percorso, dati, modo in ((percorso_dati, voce['contenuto'], 'wb'),
+                                         (percorso_meta, json.dumps(meta), 'w')):
+                fd, temporaneo = tempfile.mkstemp(dir=self.cartella)
+                with os.fdopen(fd, modo) as f:
+                    f.write(dati)
+                os.replace(temporaneo, percorso)
+        except OSError as e:
+            logger.warning(f"Impossibile salvare {url} nella cache su disco: {e}")
+
+
+asset_cache = AssetCache(
+    cartella=os.environ.get('ASSET_CACHE_DIR', os.path.join(tempfile.gettempdir(), 'cinema_asset_cache')),
+    ttl=int(os.environ.get('ASSET_CACHE_TTL', 3600)),
+    max_byte=int(os.environ.get('ASSET_CACHE_MAX_BYTES', 32 * 1024 * 1024)),
+)
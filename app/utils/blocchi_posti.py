@@ -0,0 +1,142 @@
+import heapq
+import json
+import threading
+import time
+from collections import OrderedDict
+
+from sqlalchemy import event, text
+
+from .notifiche import notifiche
+
+CANALE_BLOCCHI = 'blocchi_posti'
+
+
+# Copia in memoria dei blocchi dei posti (tabella blocco_posto), per mostrarli nella mappa
+# senza query. Il database resta quello che decide chi ottiene un posto; qui si tengono
+# solo i blocchi attivi delle proiezioni già lette, aggiornati dai NOTIFY di ogni
+# operazione. Le scadenze sono in un heap: a ogni lettura si tolgono i blocchi scaduti
+# in cima, senza timer né thread. Un blocco rinnovato lascia nell'heap la vecchia
+# scadenza, che viene scartata quando arriva in cima perché non coincide più.
+class BlocchiPosti:
+    def __init__(self, max_proiezioni=1000):
+        self.max_proiezioni = max_proiezioni
+        self._lock = threading.Lock()
+        # id_proiezione -> {id_posto: (id_utente, scadenza)}
+        self._blocchi = OrderedDict()
+        self._scadenze = []
+        # come in utils/versioni: una lettura dal database vale solo se nel frattempo
+        # non è arrivata nessuna notifica
+        self._epoca = 0
+        self._ascoltatori = []
+        self._registrato = False
+
+    def init_app(self, app, db):
+        self.max_proiezioni = app.config.setdefault('OCCUPAZIONE_MAX_PROIEZIONI', self.max_proiezioni)
+        app.config.setdefault('BLOCCO_POSTI_DURATA', 300)
+        app.config.setdefault('BLOCCO_POSTI_MASSIMI', 50)
+        notifiche.iscrivi(CANALE_BLOCCHI, self._ricevi_notifica, self.svuota)
+        if not self._registrato:
+            event.listen(db.session, 'after_commit', self._dopo_commit)
+            event.listen(db.session, 'after_rollback', self._dopo_rollback)
+            self._registrato = True
+
+    def ascolta_variazioni(self, callback):
+        # callback(id_proiezione), chiamata quando cambiano i blocchi di una proiezione
+        self._ascoltatori.append(callback)
+
+    @property
+    def attiva(self):
+        return notifiche.in_ascolto or not notifiche.attive
+
+    def epoca(self):
+        with self._lock:
+            return self._epoca
+
+    # Ritorna {id_posto: (id_utente, scadenza)} dei blocchi attivi, oppure None
+    # se la proiezione non è in memoria e va letta dal database.
+    def get(self, id_proiezione):
+        if not self.attiva:
+            return None
+
+        with self._lock:
+            self._togli_scaduti(time.time())
+            blocchi = self._blocchi.get(id_proiezione)
+            if blocchi is None:
+                return None
+            self._blocchi.move_to_end(id_proiezione)
+            return dict(blocchi)
+
+    def salva(self, id_proiezione, righe, epoca):
+        # righe: (id_posto, id_utente, scadenza) lette dal database
+        adesso = time.time()
+        blocchi = {id_posto: (id_utente, scadenza) for id_posto, id_utente, scadenza in righe if scadenza > adesso}
+        if not self.attiva:
+            return blocchi
+
+        with self._lock:
+            if epoca == self._epoca:
+                self._blocchi[id_proiezione] = blocchi
+                self._blocchi.move_to_end(id_proiezione)
+                for id_posto, (_, scadenza) in blocchi.items():
+                    heapq.heappush(self._scadenze, (scadenza, id_proiezione, id_posto))
+                while len(self._blocchi) > self.max_proiezioni:
+                    self._blocchi.popitem(last=False)
+        return dict(blocchi)
+
+    # scadenza None vuol dire posti rilasciati (o convertiti in biglietti)
+    def applica(self, id_proiezione, id_utente, posti, scadenza):
+        with self._lock:
+            self._epoca += 1
+            blocchi = self._blocchi.get(id_proiezione)
+            if blocchi is not None:
+                for id_posto in posti:
+                    if scadenza is None:
+                        blocchi.pop(id_posto, None)
+                    else:
+                        blocchi[id_posto] = (id_utente, scadenza)
+                        heapq.heappush(self._scadenze, (scadenza, id_proiezione, id_posto))
+
+        for callback in self._ascoltatori:
+            callback(id_proiezione)
+
+    def svuota(self):
+        with self._lock:
+            self._blocchi.clear()
+            self._scadenze.clear()
+            self._epoca += 1
+
+    def _togli_scaduti(self, adesso):
+        while self._scadenze and self._scadenze[0][0] <= adesso:
+            scadenza, id_proiezione, id_posto = heapq.heappop(self._scadenze)
+            blocchi = self._blocchi.get(id_proiezione)
+            if blocchi is not None and blocchi.get(id_posto, (None, None))[1] == scadenza:
+                del blocchi[id_posto]
+
+    # Da chiamare nella transazione che modifica blocco_posto: manda il NOTIFY agli altri
+    # worker e, senza notifiche, aggiorna questa copia dopo il commit
+    def registra(self, session, id_proiezione, id_utente, posti, scadenza):
+        if not posti:
+            return
+        if notifiche.attive:
+            # come per l'occupazione, il NOTIFY arriva anche a questo worker e nell'ordine dei commit
+            session.execute(text("SELECT pg_notify(:canale, :payload)"), {
+                'canale': CANALE_BLOCCHI,
+                'payload': json.dumps({'p': id_proiezione, 'u': id_utente, 'posti': posti, 's': scadenza},
+                                      separators=(',', ':'))
+            })
+        else:
+            session.info.setdefault('blocchi_posti', []).append((id_proiezione, id_utente, posti, scadenza))
+
+    def _dopo_commit(self, session):
+        for blocco in session.info.pop('blocchi_posti', []):
+            self.applica(*blocco)
+
+    def _dopo_rollback(self, session):
+        session.info.pop('blocchi_posti', None)
+
+    def _ricevi_notifica(self, payload):
+        dati = json.loads(payload)
+        self.applica(dati['p'], dati['u'], dati['posti'], dati['s'])
+
+
+blocchi_posti = BlocchiPosti()
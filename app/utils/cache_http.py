@@ -0,0 +1,43 @@
+from flask import request, Response
+from werkzeug.http import http_date
+
+
+# Il catalogo cambia di rado: CDN e browser possono riusarlo per un minuto senza chiedere.
+CACHE_CATALOGO = 'public, max-age=60'
+# Posti e occupazione si possono tenere in cache, ma vanno rivalidati a ogni richiesta
+# (con la versione in memoria il 304 non costa niente).
+CACHE_POSTI = 'public, no-cache'
+
+
+# Risposte condizionali per le GET pubbliche (catalogo, proiezioni, posti).
+# L'ETag è costruito dalle versioni delle risorse, quindi si può confrontare con
+# If-None-Match senza rifare query e serializzazione: se coincide si risponde 304
+# e genera() non viene nemmeno chiamata. genera() può restituire i dati da serializzare
+# oppure una Response già pronta.
+def risposta_condizionale(etag, genera, cache_control, ultima_modifica=None):
+    headers = {
+        'ETag': f'"{etag}"',
+        'Cache-Control': cache_control,
+    }
+    if ultima_modifica is not None:
+        headers['Last-Modified'] = http_date(ultima_modifica)
+
+    if request.if_none_match:
+        non_modificata = request.if_none_match.contains(etag)
+    else:
+        # If-Modified-Since vale solo se il client non ha mandato un ETag, e ha la precisione del secondo
+        non_modificata = (
+            ultima_modifica is not None
+            and request.if_modified_since is not None
+            and ultima_modifica.replace(microsecond=0, tzinfo=request.if_modified_since.tzinfo) <= request.if_modified_since
+        )
+
+    if non_modificata:
+        return Response(status=304, headers=headers)
+
+    risposta = genera()
+    if isinstance(risposta, Response):
+        # corpo già serializzato, da restituire così com'è
+        risposta.headers.update(headers)
+        return risposta
+    return risposta, 200, headers
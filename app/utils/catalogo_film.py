@@ -0,0 +1,51 @@
+import threading
+
+
+# Il catalogo dei film già serializzato in JSON, per la lista e per ogni film.
+# È immutabile: quando il catalogo cambia se ne costruisce uno nuovo per intero
+# e lo si sostituisce in un colpo solo, così chi sta rispondendo con il vecchio
+# non vede mai un catalogo a metà.
+class Catalogo:
+    __slots__ = ('versione', 'ultima_modifica', 'lista', 'per_id')
+
+    def __init__(self, versione, ultima_modifica, lista, per_id):
+        self.versione = versione
+        self.ultima_modifica = ultima_modifica
+        # bytes della lista completa e {id_film: bytes} dei singoli film
+        self.lista = lista
+        self.per_id = per_id
+
+
+# Il catalogo corrente del worker. Vale finché la versione 'film' di versione_risorsa
+# (incrementata dai trigger a ogni modifica dei film) è quella con cui è stato costruito.
+# Lo ricostruisce una richiesta alla volta: intanto le altre rispondono con quello vecchio,
+# che ha il suo ETag e quindi resta coerente.
+class CatalogoFilm:
+    def __init__(self):
+        self._catalogo = None
+        self._costruzione = threading.Lock()
+
+    # Ritorna (catalogo, da_ricostruire)
+    def get(self, versione):
+        catalogo = self._catalogo
+        return catalogo, catalogo is None or catalogo.versione != versione
+
+    # costruisci() viene chiamata solo se nessun altro sta già ricostruendo il catalogo;
+    # altrimenti ritorna None e si usa quello vecchio. Se un catalogo non c'è ancora
+    # si aspetta chi lo sta costruendo.
+    def ricostruisci(self, versione, costruisci):
+        if not self._costruzione.acquire(blocking=self._catalogo is None):
+            return None
+        try:
+            if self._catalogo is not None and self._catalogo.versione >= versione:
+                # costruito da un altro mentre aspettavo
+                return self._catalogo
+            catalogo = costruisci()
+            if self._catalogo is None or catalogo.versione >= self._catalogo.versione:
+                self._catalogo = catalogo
+            return self._catalogo
+        finally:
+            self._costruzione.release()
+
+
+catalogo_film = CatalogoFilm()
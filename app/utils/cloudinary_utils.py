@@ -2,8 +2,15 @@ import os
 
 import cloudinary
 import cloudinary.uploader
+import cloudinary.utils
+import requests
 from flask import current_app
 
+from . import http_client
+
+CARTELLA_PDF = 'pdf_biglietti'
+HOST_API = 'api.cloudinary.com'
+
 
 def configure_cloudinary():
     cloudinary.config(
@@ -14,23 +21,37 @@ def configure_cloudinary():
     )
 
 
-def upload_pdf_to_cloudinary(pdf_buffer, filename):
+def url_pdf_cloudinary(public_id):
+    url, _ = cloudinary.utils.cloudinary_url(public_id, resource_type='raw', secure=True)
+    return url
+
+
+# controllo con una HEAD sull'URL pubblico se il file c'è già,
+# così non serve chiamare le admin API (che hanno un limite orario)
+def esiste_su_cloudinary(public_id):
     try:
-        # configurazione cloudinary
-        configure_cloudinary()
+        response = http_client.head(url_pdf_cloudinary(public_id))
+        return response.status_code == 200
+    except requests.RequestException:
+        return False
+
 
+def upload_pdf_to_cloudinary(pdf_buffer, public_id):
+    try:
         # Reset buffer
         pdf_buffer.seek(0)
 
-        # Upload PDF su Cloudinary
-        upload_result = cloudinary.uploader.upload(
-            pdf_buffer,
-            resource_type='raw',  # 'raw' per file che non sono immagini
-            folder='pdf_biglietti',
-            public_id=filename.replace('.pdf', ''),  # Rimozione dell'estensione .pdf
-            unique_filename=False,
-            overwrite=True
-        )
+        # Upload PDF su Cloudinary, misurato come le altre chiamate esterne
+        with http_client.misura(HOST_API):
+            upload_result = cloudinary.uploader.upload(
+                pdf_buffer,
+                resource_type='raw',  # 'raw' per file che non sono immagini
+                public_id=public_id,
+                unique_filename=False,
+                # il nome è l'hash del contenuto: se esiste già è lo stesso file
+                overwrite=False,
+                timeout=http_client.TIMEOUT_LETTURA
+            )
 
         # URL del file caricato
         return upload_result['secure_url']
@@ -38,3 +59,13 @@ def upload_pdf_to_cloudinary(pdf_buffer, filename):
     except Exception as e:
         current_app.logger.error(f"Cloudinary error: {str(e)}")
         raise
+
+
+def elimina_da_cloudinary(public_id):
+    try:
+        with http_client.misura(HOST_API):
+            cloudinary.uploader.destroy(public_id, resource_type='raw', invalidate=True,
+                                        timeout=http_client.TIMEOUT_LETTURA)
+    except Exception as e:
+        current_app.logger.error(f"Cloudinary error: {str(e)}")
+        raise
@@ -0,0 +1,68 @@
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+
+# Coda in-process per generare e caricare i PDF degli ordini fuori dalla richiesta.
+# Non serve un broker esterno: lo stato di ogni ordine è salvato in ordine.stato_pdf,
+# quindi se un worker muore gli ordini rimasti 'in_attesa' si possono rimettere
+# in coda con il comando `flask pdf-riaccoda`.
+class CodaPdf:
+    def __init__(self):
+        self.app = None
+        self._executor = None
+        self._lock = threading.Lock()
+        self._in_corso = set()
+        self._da_rifare = set()
+
+    def init_app(self, app):
+        self.app = app
+        app.config.setdefault('PDF_ASINCRONO', True)
+        app.config.setdefault('PDF_WORKER', 2)
+        app.config.setdefault('PDF_SU_RICHIESTA', False)
+        self._executor = ThreadPoolExecutor(
+            max_workers=app.config['PDF_WORKER'],
+            thread_name_prefix='coda-pdf'
+        )
+
+    def accoda(self, ordine_id):
+        # da chiamare solo dopo il commit, altrimenti il worker non vede i biglietti
+        if self.app.config['PDF_SU_RICHIESTA']:
+            # il PDF verrà generato al primo download da /api/ordini/<id>/pdf
+            return
+
+        if not self.app.config['PDF_ASINCRONO']:
+            self._genera(ordine_id)
+            return
+
+        with self._lock:
+            # se l'ordine è già in lavorazione basta ricordarsi di rifarlo alla fine,
+            # così due modifiche ravvicinate non producono due PDF in parallelo
+            if ordine_id in self._in_corso:
+                self._da_rifare.add(ordine_id)
+                return
+            self._in_corso.add(ordine_id)
+
+        self._executor.submit(self._esegui, ordine_id)
+
+    def _esegui(self, ordine_id):
+        while True:
+            with self.app.app_context():
+                self._genera(ordine_id)
+
+            with self._lock:
+                if ordine_id in self._da_rifare:
+                    self._da_rifare.discard(ordine_id)
+                    continue
+                self._in_corso.discard(ordine_id)
+                return
+
+    def _genera(self, ordine_id):
+        from ..services.ordini_service import OrdiniService
+
+        try:
+            OrdiniService.genera_pdf_ordine(ordine_id)
+        except Exception as e:
+            self.app.logger.error(f"Errore nella generazione del PDF dell'ordine {ordine_id}: {e}")
+
+
+coda_pdf = CodaPdf()
@@ -0,0 +1,30 @@
+import base64
+import json
+from datetime import datetime
+
+
+# Cursori opachi per la paginazione keyset: i valori della chiave dell'ultimo elemento
+# della pagina, in JSON e poi in base64 url-safe. Le date viaggiano in ISO 8601.
+def codifica_cursore(*valori):
+    valori = [valore.isoformat() if isinstance(valore, datetime) else valore for valore in valori]
+    return base64.urlsafe_b64encode(json.dumps(valori, separators=(',', ':')).encode()).decode().rstrip('=')
+
+
+# tipi: un tipo per valore (int, str, datetime), per controllare il cursore ricevuto.
+# Solleva ValueError se il cursore non è valido.
+def decodifica_cursore(cursore, *tipi):
+    try:
+        valori = json.loads(base64.urlsafe_b64decode(cursore + '=' * (-len(cursore) % 4)))
+    except (ValueError, TypeError):
+        raise ValueError('Cursore non valido')
+    if not isinstance(valori, list) or len(valori) != len(tipi):
+        raise ValueError('Cursore non valido')
+
+    risultato = []
+    for valore, tipo in zip(valori, tipi):
+        if tipo is datetime and isinstance(valore, str):
+            valore = datetime.fromisoformat(valore)
+        elif not isinstance(valore, tipo) or isinstance(valore, bool):
+            raise ValueError('Cursore non valido')
+        risultato.append(valore)
+    return risultato
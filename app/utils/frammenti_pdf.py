@@ -0,0 +1,263 @@
+import hashlib
+import io
+import os
+import tempfile
+import threading
+import time
+
+from flask import current_app
+from pypdf import PdfReader, PdfWriter
+
+from .pdf_utils import genera_pagine_biglietti
+from .rendering_parallelo import genera_pagine_parallelo
+
+
+# Archivio su disco delle pagine dei biglietti già renderizzate, una per biglietto.
+# Ogni biglietto ha una sua cartella, e dentro il PDF è salvato con l'impronta dei dati
+# stampati: se cambia qualcosa (ospite, posto, proiezione, locandina) l'impronta
+# cambia e la pagina viene rifatta.
+# Nella sottocartella 'ordini' ci sono anche i documenti completi, salvati con la
+# versione dell'insieme dei biglietti dell'ordine.
+# I file si scrivono su un temporaneo e poi si rinominano, e le versioni vecchie si
+# cancellano una per una solo dopo che quella nuova è al suo posto: niente rmtree,
+# così non si toglie mai una cartella a chi ci sta scrivendo. L'archivio è limitato
+# in byte e in età: la pulizia toglie prima i file usati meno di recente (la data di
+# modifica viene aggiornata a ogni lettura).
+class ArchivioFrammenti:
+    TEMPORANEO = '.tmp-'
+    # un temporaneo più vecchio di così è di un processo morto a metà scrittura
+    VITA_TEMPORANEI = 3600
+
+    def __init__(self, cartella, max_byte=512 * 1024 * 1024, eta_massima=7 * 24 * 3600, intervallo_pulizia=60):
+        self.cartella = cartella
+        self.max_byte = max_byte
+        self.eta_massima = eta_massima
+        self.intervallo_pulizia = intervallo_pulizia
+        self._ultima_pulizia = 0
+        self._pulizia = threading.Lock()
+        os.makedirs(self.cartella, exist_ok=True)
+
+    def leggi(self, id_biglietto, impronta):
+        percorso = self._percorso(id_biglietto, impronta)
+        try:
+            with open(percorso, 'rb') as f:
+                contenuto = f.read()
+        except OSError:
+            return None
+
+        self._segna_uso(percorso)
+        return contenuto
+
+    def salva(self, id_biglietto, impronta, contenuto):
+        self._scrivi(os.path.join(self.cartella, str(id_biglietto)), f"{impronta}.pdf", contenuto).close()
+
+    def elimina(self, id_biglietto):
+        self._elimina_versioni(os.path.join(self.cartella, str(id_biglietto)))
+
+    # Ritorna il PDF dell'ordine già aperto, o None se questa versione non c'è.
+    # Aperto e non come percorso: se nel frattempo il file viene cancellato
+    # (versione superata, ordine eliminato, pulizia) chi lo sta inviando lo legge lo stesso.
+    def apri_ordine(self, id_ordine, versione):
+        percorso = self._percorso_ordine(id_ordine, versione)
+        try:
+            f = open(percorso, 'rb')
+        except OSError:
+            return None
+
+        self._segna_uso(percorso)
+        return f
+
+    # Salva il PDF dell'ordine e lo ritorna aperto, posizionato all'inizio
+    def salva_ordine(self, id_ordine, versione, buffer_pdf):
+        return self._scrivi(os.path.join(self.cartella, 'ordini', str(id_ordine)), f"{versione}.pdf",
+                            buffer_pdf.getvalue())
+
+    def elimina_ordine(self, id_ordine):
+        self._elimina_versioni(os.path.join(self.cartella, 'ordini', str(id_ordine)))
+
+    # Toglie i file più vecchi di eta_massima e poi, se l'archivio supera ancora
+    # max_byte, quelli usati meno di recente finché non rientra nel limite.
+    # Le cartelle rimaste vuote si tolgono con rmdir, che fallisce se qualcuno ci ha appena scritto.
+    def pulisci(self):
+        adesso = time.time()
+        file = []
+        for cartella, _, nomi in os.walk(self.cartella):
+            for nome in nomi:
+                percorso = os.path.join(cartella, nome)
+                try:
+                    stat = os.stat(percorso)
+                except OSError:
+                    continue
+                if nome.startswith(self.TEMPORANEO):
+                    if stat.st_mtime < adesso - self.VITA_TEMPORANEI:
+                        self._rimuovi(percorso)
+                    continue
+                file.append((stat.st_mtime, stat.st_size, percorso))
+
+        file.sort()
+        occupati = sum(dimensione for _, dimensione, _ in file)
+        for usato, dimensione, percorso in file:
+            if usato >= adesso - self.eta_massima and occupati <= self.max_byte:
+                break
+            self._rimuovi(percorso)
+            occupati -= dimensione
+
+        radici = {self.cartella, os.path.join(self.cartella, 'ordini')}
+        for cartella, _, _ in os.walk(self.cartella, topdown=False):
+            if cartella not in radici:
+                try:
+                    os.rmdir(cartella)
+                except OSError:
+                    pass
+
+    def _scrivi(self, cartella, nome, contenuto):
+        fd, temporaneo = self._crea_temporaneo(cartella)
+        f = os.fdopen(fd, 'w+b')
+        try:
+            f.write(contenuto)
+            f.flush()
+            os.replace(temporaneo, os.path.join(cartella, nome))
+        except BaseException:
+            f.close()
+            self._rimuovi(temporaneo)
+            raise
+
+        # la nuova versione è al suo posto, adesso le altre si possono togliere
+        self._elimina_versioni(cartella, tranne=nome)
+        self._pulisci_se_serve()
+        f.seek(0)
+        return f
+
+    def _crea_temporaneo(self, cartella):
+        os.makedirs(cartella, exist_ok=True)
+        try:
+            return tempfile.mkstemp(dir=cartella, prefix=self.TEMPORANEO)
+        except FileNotFoundError:
+            # la pulizia ha tolto la cartella vuota tra makedirs e mkstemp
+            os.makedirs(cartella, exist_ok=True)
+            return tempfile.mkstemp(dir=cartella, prefix=self.TEMPORANEO)
+
+    # i temporanei sono di scritture in corso, non si toccano
+    def _elimina_versioni(self, cartella, tranne=None):
+        try:
+            nomi = os.listdir(cartella)
+        except OSError:
+            return
+
+        for nome in nomi:
+            if nome != tranne and not nome.startswith(self.TEMPORANEO):
+                self._rimuovi(os.path.join(cartella, nome))
+
+    def _pulisci_se_serve(self):
+        if time.time() - self._ultima_pulizia < self.intervallo_pulizia:
+            return
+        # se un altro thread sta già pulendo non lo aspetto
+        if not self._pulizia.acquire(blocking=False):
+            return
+        try:
+            self._ultima_pulizia = time.time()
+            self.pulisci()
+        finally:
+            self._pulizia.release()
+
+    @staticmethod
+    def _segna_uso(percorso):
+        try:
+            os.utime(percorso)
+        except OSError:
+            pass
+
+    @staticmethod
+    def _rimuovi(percorso):
+        try:
+            os.remove(percorso)
+        except OSError:
+            pass
+
+    def _percorso(self, id_biglietto, impronta):
+        return os.path.join(self.cartella, str(id_biglietto), f"{impronta}.pdf")
+
+    def _percorso_ordine(self, id_ordine, versione):
+        return os.path.join(self.cartella, 'ordini', str(id_ordine), f"{versione}.pdf")
+
+
+archivio_frammenti = ArchivioFrammenti(
+    os.environ.get('PDF_FRAMMENTI_DIR', os.path.join(tempfile.gettempdir(), 'cinema_frammenti_pdf')),
+    max_byte=int(os.environ.get('PDF_FRAMMENTI_MAX_BYTES', 512 * 1024 * 1024)),
+    eta_massima=int(os.environ.get('PDF_FRAMMENTI_ETA_MASSIMA', 7 * 24 * 3600)),
+)
+
+
+def impronta_biglietto(info_biglietto, id_ordine, intestatario):
+    biglietto, film, proiezione, sala, posto = info_biglietto
+    dati = (
+        id_ordine, biglietto.id,
+        biglietto.nome_ospite or intestatario.nome, biglietto.cognome_ospite or intestatario.cognome,
+        posto.fila, posto.numero,
+        film.titolo, film.url_copertina, proiezione.data_ora.isoformat(), sala.nome,
+    )
+    return hashlib.sha256(repr(dati).encode('utf-8')).hexdigest()[:32]
+
+
+# Ritorna la versione e il PDF dell'ordine già aperto (da chiudere), generandolo solo se serve.
+# La versione è l'impronta di tutti i biglietti dell'ordine: cambia se si aggiunge,
+# toglie o modifica un biglietto, e si usa come chiave della cache e come ETag.
+# Se il documento di questa versione non c'è si renderizzano solo i biglietti nuovi
+# o cambiati e poi si concatenano le pagine; i biglietti rimossi semplicemente
+# non compaiono più in info_biglietti.
+def pdf_ordine(info_biglietti, id_ordine, intestatario):
+    if not info_biglietti:
+        raise ValueError("Impossibile generare il PDF: nessun biglietto disponibile.")
+
+    impronte = [impronta_biglietto(info, id_ordine, intestatario) for info in info_biglietti]
+    versione = _versione(impronte)
+    pdf = archivio_frammenti.apri_ordine(id_ordine, versione)
+    if pdf is not None:
+        return versione, pdf
+
+    pagine = [archivio_frammenti.leggi(info[0].id, impronta) for info, impronta in zip(info_biglietti, impronte)]
+
+    mancanti = [i for i, pagina in enumerate(pagine) if pagina is None]
+    if mancanti:
+        da_renderizzare = [info_biglietti[i] for i in mancanti]
+        soglia = current_app.config['PDF_SOGLIA_PARALLELA']
+        if soglia and len(da_renderizzare) >= soglia:
+            nuove = genera_pagine_parallelo(da_renderizzare, id_ordine, intestatario, current_app.config['PDF_PROCESSI'])
+        else:
+            nuove = genera_pagine_biglietti(da_renderizzare, id_ordine, intestatario)
+        for i, pagina in zip(mancanti, nuove):
+            archivio_frammenti.salva(info_biglietti[i][0].id, impronte[i], pagina)
+            pagine[i] = pagina
+
+    return versione, archivio_frammenti.salva_ordine(id_ordine, versione, unisci_pagine(pagine))
+
+
+# Versione dei biglietti dell'ordine senza generare niente, la stessa che ritorna pdf_ordine
+def versione_ordine(info_biglietti, id_ordine, intestatario):
+    return _versione([impronta_biglietto(info, id_ordine, intestatario) for info in info_biglietti])
+
+
+def _versione(impronte):
+    return hashlib.sha256(''.join(impronte).encode('utf-8')).hexdigest()[:32]
+
+
+# Ritorna (versione, PDF in memoria)
+def genera_pdf_ordine_incrementale(info_biglietti, id_ordine, intestatario):
+    versione, pdf = pdf_ordine(info_biglietti, id_ordine, intestatario)
+    with pdf:
+        return versione, io.BytesIO(pdf.read())
+
+
+def unisci_pagine(pagine):
+    writer = PdfWriter()
+    for pagina in pagine:
+        writer.append(PdfReader(io.BytesIO(pagina)))
+
+    # ogni frammento si porta dietro la sua copia di logo e locandina:
+    # unendo gli oggetti identici nel documento finale resta una copia sola
+    writer.compress_identical_objects(remove_identicals=True, remove_orphans=True)
+
+    buffer_pdf = io.BytesIO()
+    writer.write(buffer_pdf)
+    buffer_pdf.seek(0)
+    return buffer_pdf
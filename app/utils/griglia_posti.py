@@ -0,0 +1,81 @@
+# Ricerca del miglior gruppo di posti vicini per le prenotazioni di gruppo.
+# La griglia si calcola una volta per layout: per ogni fila i tratti di posti con numeri
+# consecutivi (un buco nella numerazione, come un corridoio, spezza il tratto) e il centro
+# della fila. A ogni richiesta resta solo da scorrere i tratti sul bitset dei posti non
+# disponibili, senza query e senza allocare niente per posto: per una sala di qualche
+# centinaio di posti sono poche decine di microsecondi.
+
+# La fila migliore non è la prima: di solito si sta meglio verso i due terzi della sala
+PROFONDITA_IDEALE = 2 / 3
+# quanto pesa stare lontano dalla fila ideale rispetto a stare lontano dal centro della fila
+PESO_FILA = 0.5
+
+
+class TrattoFila:
+    __slots__ = ('inizio', 'numeri', 'centro_fila', 'distanza_fila')
+
+    def __init__(self, inizio, numeri, centro_fila, distanza_fila):
+        # inizio: indice nel layout del primo posto del tratto
+        self.inizio = inizio
+        self.numeri = numeri
+        self.centro_fila = centro_fila
+        self.distanza_fila = distanza_fila
+
+
+class GrigliaSala:
+    def __init__(self, posti):
+        # posti: (id_posto, fila, numero) ordinati per fila e numero, come in LayoutSala.posti()
+        file = []
+        for indice, (_, fila, numero) in enumerate(posti):
+            if not file or file[-1][0] != fila:
+                file.append((fila, []))
+            file[-1][1].append((indice, numero))
+
+        self.larghezza = max((len(posti_fila) for _, posti_fila in file), default=1)
+        fila_ideale = (len(file) - 1) * PROFONDITA_IDEALE
+        self.tratti = []
+        for riga, (_, posti_fila) in enumerate(file):
+            centro = (posti_fila[0][1] + posti_fila[-1][1]) / 2
+            distanza_fila = abs(riga - fila_ideale) / max(len(file) - 1, 1)
+
+            inizio = 0
+            for i in range(1, len(posti_fila) + 1):
+                if i == len(posti_fila) or posti_fila[i][1] != posti_fila[i - 1][1] + 1:
+                    self.tratti.append(TrattoFila(
+                        posti_fila[inizio][0],
+                        [numero for _, numero in posti_fila[inizio:i]],
+                        centro,
+                        distanza_fila
+                    ))
+                    inizio = i
+
+    # Ritorna (indice del primo posto, punteggio) del miglior gruppo di quanti posti consecutivi
+    # liberi, o None se non ce n'è uno. non_disponibili è una stringa di '0'/'1' lunga quanto il
+    # layout (Bitset.to_stringa). Punteggio più basso = gruppo più centrale.
+    def cerca(self, non_disponibili, quanti):
+        migliore = None
+        semi_larghezza = max(self.larghezza / 2, 1)
+        for tratto in self.tratti:
+            lunghezza = len(tratto.numeri)
+            if lunghezza < quanti:
+                continue
+
+            base = PESO_FILA * tratto.distanza_fila
+            if migliore is not None and base >= migliore[1]:
+                # anche il gruppo più centrale di questo tratto non batterebbe il migliore
+                continue
+
+            segmento = non_disponibili[tratto.inizio:tratto.inizio + lunghezza]
+            # scorro i pezzi di posti liberi del tratto
+            libero = segmento.find('0')
+            while libero != -1:
+                occupato = segmento.find('1', libero)
+                if occupato == -1:
+                    occupato = lunghezza
+                for primo in range(libero, occupato - quanti + 1):
+                    centro = (tratto.numeri[primo] + tratto.numeri[primo + quanti - 1]) / 2
+                    punteggio = base + abs(centro - tratto.centro_fila) / semi_larghezza
+                    if migliore is None or punteggio < migliore[1]:
+                        migliore = (tratto.inizio + primo, punteggio)
+                libero = segmento.find('0', occupato)
+        return migliore
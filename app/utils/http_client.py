@@ -0,0 +1,109 @@
+import os
+import threading
+import time
+from contextlib import contextmanager
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+
+# Client HTTP condiviso per tutte le chiamate verso l'esterno (CDN delle immagini, Cloudinary).
+# Ogni thread ha la sua Session, che tiene un pool di connessioni keep-alive per host,
+# così non si riapre una connessione TLS a ogni download. Tutte le richieste hanno un
+# timeout (senza, un CDN lento blocca il worker di gunicorn all'infinito) e i tentativi
+# sui 5xx e sugli errori di connessione vengono ripetuti con backoff.
+TIMEOUT_CONNESSIONE = float(os.environ.get('HTTP_TIMEOUT_CONNESSIONE', 3.05))
+TIMEOUT_LETTURA = float(os.environ.get('HTTP_TIMEOUT_LETTURA', 10))
+TENTATIVI = int(os.environ.get('HTTP_TENTATIVI', 3))
+CONNESSIONI_PER_HOST = int(os.environ.get('HTTP_CONNESSIONI_PER_HOST', 10))
+# pool_connections in requests è il numero di host diversi di cui tenere il pool, non le
+# connessioni: parliamo solo con il CDN delle immagini, Cloudinary e poco altro
+HOST_DISTINTI = 4
+
+_locale = threading.local()
+
+
+def _crea_sessione():
+    retry = Retry(
+        total=TENTATIVI,
+        backoff_factor=0.3,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=('GET', 'HEAD'),
+        # dopo l'ultimo tentativo ritorno la risposta, ci pensa il chiamante con raise_for_status
+        raise_on_status=False,
+    )
+    adapter = HTTPAdapter(pool_connections=HOST_DISTINTI, pool_maxsize=CONNESSIONI_PER_HOST, max_retries=retry)
+
+    sessione = requests.Session()
+    sessione.mount('http://', adapter)
+    sessione.mount('https://', adapter)
+    return sessione
+
+
+def _sessione():
+    sessione = getattr(_locale, 'sessione', None)
+    if sessione is None:
+        sessione = _locale.sessione = _crea_sessione()
+    return sessione
+
+
+# Contatori per host: numero di richieste, errori e latenza (totale e massima)
+class StatisticheHttp:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._per_host = {}
+
+    def registra(self, host, durata, errore):
+        with self._lock:
+            voce = self._per_host.setdefault(host, {'richieste': 0, 'errori': 0, 'tempo_totale': 0.0, 'tempo_massimo': 0.0})
+            voce['richieste'] += 1
+            voce['errori'] += 1 if errore else 0
+            voce['tempo_totale'] += durata
+            voce['tempo_massimo'] = max(voce['tempo_massimo'], durata)
+
+    def riepilogo(self):
+        with self._lock:
+            return {
+                host: dict(voce, tempo_medio=voce['tempo_totale'] / voce['richieste'])
+                for host, voce in self._per_host.items()
+            }
+
+
+statistiche = StatisticheHttp()
+
+
+# misura una chiamata fatta con un client diverso (ad esempio l'SDK di Cloudinary)
+@contextmanager
+def misura(host):
+    inizio = time.perf_counter()
+    errore = True
+    try:
+        yield
+        errore = False
+    finally:
+        statistiche.registra(host, time.perf_counter() - inizio, errore)
+
+
+def richiesta(metodo, url, **kwargs):
+    kwargs.setdefault('timeout', (TIMEOUT_CONNESSIONE, TIMEOUT_LETTURA))
+    host = urlsplit(url).netloc
+
+    inizio = time.perf_counter()
+    try:
+        response = _sessione().request(metodo, url, **kwargs)
+    except requests.RequestException:
+        statistiche.registra(host, time.perf_counter() - inizio, True)
+        raise
+
+    statistiche.registra(host, time.perf_counter() - inizio, response.status_code >= 500)
+    return response
+
+
+def get(url, **kwargs):
+    return richiesta('GET', url, **kwargs)
+
+
+def head(url, **kwargs):
+    return richiesta('HEAD', url, **kwargs)
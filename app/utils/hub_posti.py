@@ -0,0 +1,95 @@
+import threading
+from collections import deque
+
+from .blocchi_posti import blocchi_posti
+from .mappa_posti import mappa_posti
+
+
+# Smistamento delle variazioni dell'occupazione verso gli stream SSE dei client.
+# Per ogni proiezione seguita da almeno un client c'è un canale con le ultime variazioni
+# (in ordine di versione) e una Condition su cui gli stream aspettano: chi pubblica
+# non scrive sui singoli client, li sveglia e ognuno si prende quello che gli manca.
+# Non serve quindi un thread per client oltre a quello che serve la richiesta, e con
+# i worker gevent l'attesa sulla Condition non blocca nemmeno quello.
+# Le variazioni tenute servono anche a riprendere uno stream da Last-Event-ID:
+# se il client è rimasto indietro oltre il buffer gli si rimanda la mappa intera.
+class CanaleProiezione:
+    __slots__ = ('condizione', 'eventi', 'base', 'ultima', 'iscritti')
+
+    def __init__(self, max_eventi):
+        self.condizione = threading.Condition()
+        self.eventi = deque(maxlen=max_eventi)
+        # le variazioni nel buffer partono dalla versione base + 1
+        self.base = None
+        self.ultima = None
+        self.iscritti = 0
+
+
+class HubPosti:
+    def __init__(self, max_eventi=256):
+        self.max_eventi = max_eventi
+        self._lock = threading.Lock()
+        self._canali = {}
+
+    def init_app(self, app):
+        self.max_eventi = app.config.setdefault('SSE_MAX_EVENTI', self.max_eventi)
+        mappa_posti.ascolta_variazioni(self.pubblica)
+        blocchi_posti.ascolta_variazioni(self.sveglia)
+
+    def iscrivi(self, id_proiezione):
+        with self._lock:
+            canale = self._canali.get(id_proiezione)
+            if canale is None:
+                canale = self._canali[id_proiezione] = CanaleProiezione(self.max_eventi)
+            canale.iscritti += 1
+            return canale
+
+    def disiscrivi(self, id_proiezione, canale):
+        with self._lock:
+            canale.iscritti -= 1
+            if canale.iscritti == 0 and self._canali.get(id_proiezione) is canale:
+                del self._canali[id_proiezione]
+
+    def pubblica(self, variazione):
+        with self._lock:
+            canale = self._canali.get(variazione.id_proiezione)
+        if canale is None:
+            # nessuno la sta guardando
+            return
+
+        with canale.condizione:
+            if canale.ultima is not None and variazione.versione <= canale.ultima:
+                return
+
+            if variazione.occupati is None or (canale.ultima is not None and variazione.versione != canale.ultima + 1):
+                # non posso dire cosa è cambiato: chi è indietro dovrà ricaricare la mappa
+                canale.eventi.clear()
+                canale.base = variazione.versione
+            else:
+                canale.eventi.append(variazione)
+                canale.base = canale.eventi[0].versione - 1
+
+            canale.ultima = variazione.versione
+            canale.condizione.notify_all()
+
+    # I blocchi non passano dal buffer: sveglio gli stream, che rileggono il bitset dei bloccati
+    def sveglia(self, id_proiezione):
+        with self._lock:
+            canale = self._canali.get(id_proiezione)
+        if canale is not None:
+            with canale.condizione:
+                canale.condizione.notify_all()
+
+    # Ritorna (variazioni successive a da_versione, serve_la_mappa_intera).
+    # Se non c'è niente di nuovo aspetta al massimo timeout secondi.
+    def attendi(self, canale, da_versione, timeout):
+        with canale.condizione:
+            if timeout and (canale.ultima is None or canale.ultima <= da_versione):
+                canale.condizione.wait(timeout)
+
+            if canale.base is not None and da_versione < canale.base:
+                return [], True
+            return [e for e in canale.eventi if e.versione > da_versione], False
+
+
+hub_posti = HubPosti()
@@ -0,0 +1,125 @@
+import html
+import json
+import re
+import threading
+import unicodedata
+from collections import defaultdict
+
+# Indice invertito in memoria per la ricerca dei film, usato al posto della ricerca full text
+# di Postgres quando il database non è Postgres (per esempio un SQLite di prova).
+# Imita quello che fa il database: stesse parole vuote da ignorare, una radice grossolana
+# delle parole (senza accenti e senza la vocale finale, così "avventura" trova "avventure"),
+# tutte le parole cercate devono esserci e il titolo pesa più del regista e della descrizione,
+# con gli stessi pesi di ts_rank per A, B e C.
+
+PESI = {'titolo': 1.0, 'regista': 0.4, 'descrizione': 0.2}
+
+PAROLE_VUOTE = {
+    'a', 'ad', 'al', 'alla', 'alle', 'agli', 'ai', 'allo', 'che', 'chi', 'con', 'da', 'dal', 'dalla',
+    'dei', 'del', 'della', 'delle', 'dello', 'degli', 'di', 'e', 'ed', 'gli', 'i', 'il', 'in', 'la',
+    'le', 'lo', 'ma', 'nei', 'nel', 'nella', 'nelle', 'non', 'o', 'per', 'si', 'su', 'sul', 'sulla',
+    'tra', 'fra', 'un', 'una', 'uno'
+}
+
+_PAROLA = re.compile(r'\w+', re.UNICODE)
+_ESCLUSA = re.compile(r'(?:^|(?<=\s))-(\w+)', re.UNICODE)
+
+
+def _normalizza(parola):
+    parola = unicodedata.normalize('NFKD', parola.lower())
+    return ''.join(c for c in parola if not unicodedata.combining(c))
+
+
+def radice(parola):
+    parola = _normalizza(parola)
+    if parola in PAROLE_VUOTE:
+        return None
+    return parola[:-1] if len(parola) > 3 and parola[-1] in 'aeiou' else parola
+
+
+def radici(testo):
+    return [r for r in (radice(parola) for parola in _PAROLA.findall(testo or '')) if r]
+
+
+# Delimitatori delle parole trovate, da passare anche a ts_headline come StartSel e StopSel:
+# caratteri di controllo che non compaiono in un titolo o in una descrizione, così si fa
+# l'escape dell'HTML su tutto il testo e solo dopo diventano <mark> e </mark>
+INIZIO_EVIDENZIATO = '\x02'
+FINE_EVIDENZIATO = '\x03'
+
+
+# Toglie dal testo i delimitatori, se per caso ci sono, perché non diventino <mark> finti
+def senza_delimitatori(testo):
+    return (testo or '').replace(INIZIO_EVIDENZIATO, '').replace(FINE_EVIDENZIATO, '')
+
+
+# Testo con i delimitatori -> HTML sicuro con le parole trovate tra <mark> e </mark>
+def html_evidenziato(testo):
+    return html.escape(testo or '').replace(INIZIO_EVIDENZIATO, '<mark>').replace(FINE_EVIDENZIATO, '</mark>')
+
+
+# Come ts_headline con HighlightAll: HTML con le parole che corrispondono alla ricerca tra <mark> e </mark>
+def evidenzia(testo, cercate):
+    delimitato = _PAROLA.sub(
+        lambda m: f'{INIZIO_EVIDENZIATO}{m.group()}{FINE_EVIDENZIATO}' if radice(m.group()) in cercate else m.group(),
+        senza_delimitatori(testo)
+    )
+    return html_evidenziato(delimitato)
+
+
+class IndiceRicerca:
+    def __init__(self, film):
+        # film: dizionari con id, titolo, regista e descrizione
+        self._film = {f['id']: f for f in film}
+        # radice -> {id_film: punteggio}
+        self._indice = defaultdict(dict)
+        for f in film:
+            for campo, peso in PESI.items():
+                for r in radici(f.get(campo)):
+                    self._indice[r][f['id']] = self._indice[r].get(f['id'], 0) + peso
+
+    def film(self, id_film):
+        return self._film[id_film]
+
+    # Ritorna ([(punteggio, id_film), ...] in ordine di punteggio decrescente e id, radici cercate).
+    # dopo: (punteggio, id) dell'ultimo risultato della pagina precedente.
+    # Come websearch_to_tsquery, le parole precedute da - escludono i film che le contengono.
+    def cerca(self, testo, dopo=None, limite=20):
+        escluse = set(radici(' '.join(_ESCLUSA.findall(testo))))
+        cercate = set(radici(_ESCLUSA.sub(' ', testo)))
+        if not cercate:
+            return [], cercate
+
+        # comincio dalla parola più rara, così l'intersezione resta piccola
+        liste = sorted((self._indice.get(r, {}) for r in cercate), key=len)
+        punteggi = dict(liste[0])
+        for lista in liste[1:]:
+            punteggi = {id_film: p + lista[id_film] for id_film, p in punteggi.items() if id_film in lista}
+        for r in escluse:
+            for id_film in self._indice.get(r, ()):
+                punteggi.pop(id_film, None)
+
+        risultati = sorted(((p, id_film) for id_film, p in punteggi.items()), key=lambda r: (-r[0], r[1]))
+        if dopo is not None:
+            risultati = [r for r in risultati if (-r[0], r[1]) > (-dopo[0], dopo[1])]
+        return risultati[:limite + 1], cercate
+
+
+# L'indice del catalogo corrente del worker, ricostruito quando cambia il catalogo (utils/catalogo_film)
+class IndiceFilm:
+    def __init__(self):
+        self._voce = None
+        self._costruzione = threading.Lock()
+
+    def get(self, catalogo):
+        voce = self._voce
+        if voce is not None and voce[0] is catalogo:
+            return voce[1]
+        with self._costruzione:
+            if self._voce is None or self._voce[0] is not catalogo:
+                film = [json.loads(voce) for voce in catalogo.per_id.values()]
+                self._voce = (catalogo, IndiceRicerca(film))
+            return self._voce[1]
+
+
+indice_film = IndiceFilm()
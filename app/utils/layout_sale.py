@@ -0,0 +1,33 @@
+import threading
+
+
+# Layout delle sale (LayoutSala), uno per sala, condiviso da tutte le proiezioni.
+# I posti di una sala non cambiano quasi mai: ogni layout è salvato con la versione
+# 'sala:<id>' di versione_risorsa, che i trigger incrementano quando cambiano i posti
+# o il nome della sala, e viene ricostruito solo quando la versione non coincide più.
+# Con le notifiche attive leggere la versione non costa una query (utils/versioni).
+class LayoutSale:
+    def __init__(self):
+        self._lock = threading.Lock()
+        # id_sala -> (versione, LayoutSala)
+        self._layout = {}
+
+    # Ritorna il layout se è ancora quello della versione indicata, altrimenti None
+    def get(self, id_sala, versione):
+        with self._lock:
+            voce = self._layout.get(id_sala)
+        if voce is None or voce[0] != versione:
+            return None
+        return voce[1]
+
+    # versione va letta prima dei posti: se nel frattempo cambiano, il layout viene
+    # salvato con la versione vecchia e ricostruito alla richiesta successiva
+    def salva(self, id_sala, versione, layout):
+        with self._lock:
+            attuale = self._layout.get(id_sala)
+            if attuale is None or attuale[0] <= versione:
+                self._layout[id_sala] = (versione, layout)
+        return layout
+
+
+layout_sale = LayoutSale()
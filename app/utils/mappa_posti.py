@@ -0,0 +1,303 @@
+import base64
+import json
+import threading
+import zlib
+from array import array
+from collections import OrderedDict
+from datetime import datetime
+
+from sqlalchemy import event
+
+from .griglia_posti import GrigliaSala
+from .notifiche import notifiche
+
+
+# Mappa dei posti di una proiezione in forma compatta.
+# Il layout della sala (file e numeri dei posti) si manda una volta sola, l'occupazione
+# invece è un bitset: il bit i corrisponde all'i-esimo posto del layout, nell'ordine
+# (fila, numero), e vale 1 se il posto è venduto. Per una sala da 300 posti sono 40 byte
+# contro i ~10 KB della lista di dizionari di /api/posti/occupati.
+
+CANALE_NOTIFICHE = 'occupazione_posti'
+# il payload di NOTIFY non può superare gli 8000 byte
+MAX_PAYLOAD = 7900
+
+
+class Bitset:
+    __slots__ = ('dimensione', '_byte')
+
+    def __init__(self, dimensione):
+        self.dimensione = dimensione
+        self._byte = bytearray((dimensione + 7) // 8)
+
+    # il bit più significativo del primo byte è il posto 0, come si legge da sinistra a destra
+    def imposta(self, indice):
+        self._byte[indice >> 3] |= 0x80 >> (indice & 7)
+
+    def azzera(self, indice):
+        self._byte[indice >> 3] &= ~(0x80 >> (indice & 7)) & 0xFF
+
+    def copia(self):
+        copia = Bitset(self.dimensione)
+        copia._byte[:] = self._byte
+        return copia
+
+    def attivo(self, indice):
+        return bool(self._byte[indice >> 3] & (0x80 >> (indice & 7)))
+
+    def indici_attivi(self):
+        return [i for i in range(self.dimensione) if self._byte[i >> 3] & (0x80 >> (i & 7))]
+
+    def conta(self):
+        return int.from_bytes(self._byte, 'big').bit_count()
+
+    def unione(self, altro):
+        unione = self.copia()
+        for i, byte in enumerate(altro._byte):
+            unione._byte[i] |= byte
+        return unione
+
+    # '0'/'1' per posto, nell'ordine del layout
+    def to_stringa(self):
+        return format(int.from_bytes(self._byte, 'big'), f'0{len(self._byte) * 8}b')[:self.dimensione]
+
+    def impronta(self):
+        return f'{zlib.crc32(self._byte):08x}'
+
+    def to_base64(self):
+        return base64.b64encode(self._byte).decode('ascii')
+
+
+# Layout di una sala, immutabile: si costruisce una volta per sala (vedi utils/layout_sale)
+# ed è condiviso da tutte le proiezioni e da tutte le richieste. I posti stanno in array
+# paralleli indicizzati come i bit dell'occupazione, più la lista dei posti già serializzata
+# in JSON per /api/posti/<id_proiezione>.
+class LayoutSala:
+
+    def __init__(self, id_sala, nome_sala, posti):
+        # posti: lista di (id_posto, fila, numero) già ordinata per fila e numero
+        self.id_sala = id_sala
+        self.nome_sala = nome_sala
+        self.id_posti = array('l')
+        self.numeri = array('h')
+        # per ogni posto l'indice della sua fila in nomi_file
+        self.righe = array('H')
+        self.nomi_file = []
+        for id_posto, fila, numero in posti:
+            if not self.nomi_file or self.nomi_file[-1] != fila:
+                self.nomi_file.append(fila)
+            self.id_posti.append(id_posto)
+            self.numeri.append(numero)
+            self.righe.append(len(self.nomi_file) - 1)
+
+        self.indici = {id_posto: i for i, id_posto in enumerate(self.id_posti)}
+        self.file = self._file()
+        self.json_posti = json.dumps(
+            [{'id': id_posto, 'fila': fila, 'numero': numero} for id_posto, fila, numero in self.posti()],
+            separators=(',', ':')
+        ).encode()
+        self._griglia = None
+
+    def __len__(self):
+        return len(self.id_posti)
+
+    def posto(self, indice):
+        return self.id_posti[indice], self.nomi_file[self.righe[indice]], self.numeri[indice]
+
+    def posti(self, inizio=0, fine=None):
+        for indice in range(inizio, len(self) if fine is None else fine):
+            yield self.posto(indice)
+
+    # Bitset dei posti di questo layout presenti in id_posti
+    def bitset(self, id_posti):
+        bitset = Bitset(len(self))
+        for id_posto in id_posti:
+            indice = self.indici.get(id_posto)
+            if indice is not None:
+                bitset.imposta(indice)
+        return bitset
+
+    # calcolata alla prima ricerca dei posti migliori e poi riusata
+    def griglia(self):
+        if self._griglia is None:
+            self._griglia = GrigliaSala(self.posti())
+        return self._griglia
+
+    def _file(self):
+        file = []
+        for id_posto, fila, numero in self.posti():
+            if not file or file[-1]['fila'] != fila:
+                file.append({'fila': fila, 'posti': []})
+            file[-1]['posti'].append([id_posto, numero])
+        return file
+
+
+# Variazione dell'occupazione di una proiezione, registrata nella stessa transazione
+# dei biglietti. versione è il nuovo valore di proiezione.versione_occupazione;
+# occupati/liberati sono None quando non si conoscono (payload troppo grande).
+class Variazione:
+    __slots__ = ('id_proiezione', 'versione', 'occupati', 'liberati')
+
+    def __init__(self, id_proiezione, versione, occupati, liberati):
+        self.id_proiezione = id_proiezione
+        self.versione = versione
+        self.occupati = occupati
+        self.liberati = liberati
+
+    def to_payload(self):
+        payload = json.dumps({'p': self.id_proiezione, 'v': self.versione, 'o': self.occupati, 'l': self.liberati},
+                             separators=(',', ':'))
+        if len(payload) > MAX_PAYLOAD:
+            # chi riceve la notifica butta la voce e la ricarica dal database
+            payload = json.dumps({'p': self.id_proiezione, 'v': self.versione}, separators=(',', ':'))
+        return payload
+
+    @classmethod
+    def da_payload(cls, payload):
+        dati = json.loads(payload)
+        return cls(dati['p'], dati['v'], dati.get('o'), dati.get('l'))
+
+
+class VoceMappa:
+    __slots__ = ('layout', 'occupati', 'versione', 'data_ora')
+
+    def __init__(self, layout, occupati, versione, data_ora):
+        self.layout = layout
+        self.occupati = occupati
+        self.versione = versione
+        self.data_ora = data_ora
+
+
+# Cache dell'occupazione dei posti per proiezione, per servire la mappa senza database.
+#
+# - Write-through: i servizi registrano ogni variazione nella transazione dei biglietti
+#   (PostoService.registra_variazione) e qui viene applicata al bitset dopo il commit.
+# - Versioni: proiezione.versione_occupazione viene incrementata da ogni variazione,
+#   quindi è uguale per tutti i worker. Una variazione si applica solo se è la successiva
+#   di quella in cache; se ne manca una la voce viene buttata e ricaricata.
+# - Invalidazione tra worker: ogni variazione fa un NOTIFY su Postgres, consegnato solo
+#   al commit; il thread di utils/notifiche lo riceve e aggiorna la cache del worker.
+#   Se la connessione cade la cache si svuota e, finché non torna, si legge dal database.
+# - Memoria limitata: al massimo OCCUPAZIONE_MAX_PROIEZIONI voci, si tolgono prima
+#   quelle di proiezioni già passate e poi le meno usate di recente.
+class MappaPosti:
+    def __init__(self, max_proiezioni=1000):
+        self.app = None
+        self.max_proiezioni = max_proiezioni
+        self._db = None
+        self._lock = threading.Lock()
+        self._voci = OrderedDict()
+        # ultima versione vista per proiezione, anche se non in cache: serve per non salvare
+        # una lettura dal database superata da una variazione arrivata nel frattempo
+        self._ultime_versioni = OrderedDict()
+        # chi vuole sapere delle variazioni nell'ordine dei commit (lo stream dei posti)
+        self._ascoltatori = []
+
+    def init_app(self, app, db):
+        self.app = app
+        self.max_proiezioni = app.config.setdefault('OCCUPAZIONE_MAX_PROIEZIONI', self.max_proiezioni)
+        if self._db is None:
+            # le variazioni in sospeso vivono nella sessione e si applicano solo se la transazione va a buon fine
+            event.listen(db.session, 'after_commit', self._dopo_commit)
+            event.listen(db.session, 'after_rollback', self._dopo_rollback)
+        self._db = db
+        notifiche.iscrivi(CANALE_NOTIFICHE, self._ricevi_notifica, self.svuota)
+
+    def ascolta_variazioni(self, callback):
+        self._ascoltatori.append(callback)
+
+    @property
+    def attiva(self):
+        # senza notifiche (un solo worker) bastano le variazioni fatte da questo processo
+        return notifiche.in_ascolto or not notifiche.attive
+
+    def get(self, id_proiezione):
+        if not self.attiva:
+            return None
+
+        with self._lock:
+            voce = self._voci.get(id_proiezione)
+            if voce is not None:
+                self._voci.move_to_end(id_proiezione)
+            return voce
+
+    def salva(self, id_proiezione, layout, id_occupati, versione, data_ora):
+        voce = VoceMappa(layout, layout.bitset(id_occupati), versione, data_ora)
+        if not self.attiva:
+            return voce
+
+        with self._lock:
+            if versione >= self._ultime_versioni.get(id_proiezione, 0):
+                self._voci[id_proiezione] = voce
+                self._voci.move_to_end(id_proiezione)
+                self._libera_spazio()
+        return voce
+
+    def applica(self, variazione):
+        with self._lock:
+            id_proiezione = variazione.id_proiezione
+            self._ultime_versioni[id_proiezione] = max(variazione.versione, self._ultime_versioni.get(id_proiezione, 0))
+            self._ultime_versioni.move_to_end(id_proiezione)
+            while len(self._ultime_versioni) > 10 * self.max_proiezioni:
+                self._ultime_versioni.popitem(last=False)
+
+            voce = self._voci.get(id_proiezione)
+            if voce is None or variazione.versione <= voce.versione:
+                # già applicata (la notifica della nostra stessa transazione arriva dopo)
+                return
+
+            if variazione.versione != voce.versione + 1 or variazione.occupati is None:
+                # ne manca qualcuna: meglio ricaricare che tenere una mappa sbagliata
+                del self._voci[id_proiezione]
+                return
+
+            # copio il bitset invece di modificarlo: chi ha appena letto la voce
+            # continua a vedere una mappa coerente con la sua versione
+            occupati = voce.occupati.copia()
+            for id_posto in variazione.occupati:
+                indice = voce.layout.indici.get(id_posto)
+                if indice is not None:
+                    occupati.imposta(indice)
+            for id_posto in variazione.liberati:
+                indice = voce.layout.indici.get(id_posto)
+                if indice is not None:
+                    occupati.azzera(indice)
+            self._voci[id_proiezione] = VoceMappa(voce.layout, occupati, variazione.versione, voce.data_ora)
+
+    def svuota(self):
+        with self._lock:
+            self._voci.clear()
+
+    def _libera_spazio(self):
+        if len(self._voci) <= self.max_proiezioni:
+            return
+
+        adesso = datetime.now()
+        passate = [id_proiezione for id_proiezione, voce in self._voci.items() if voce.data_ora < adesso]
+        for id_proiezione in passate[:len(self._voci) - self.max_proiezioni]:
+            del self._voci[id_proiezione]
+        while len(self._voci) > self.max_proiezioni:
+            self._voci.popitem(last=False)
+
+    def _ricevi_notifica(self, payload):
+        variazione = Variazione.da_payload(payload)
+        self.applica(variazione)
+        self._avvisa(variazione)
+
+    def _dopo_commit(self, session):
+        for variazione in session.info.pop('variazioni_occupazione', []):
+            self.applica(variazione)
+            # con le notifiche attive la stessa variazione arriva anche dal NOTIFY,
+            # che rispetta l'ordine dei commit: agli ascoltatori la passo solo da lì
+            if not notifiche.attive:
+                self._avvisa(variazione)
+
+    def _avvisa(self, variazione):
+        for callback in self._ascoltatori:
+            callback(variazione)
+
+    def _dopo_rollback(self, session):
+        session.info.pop('variazioni_occupazione', None)
+
+
+mappa_posti = MappaPosti()
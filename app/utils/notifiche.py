@@ -0,0 +1,90 @@
+import select
+import threading
+import time
+
+
+# Ascolto delle notifiche di Postgres (LISTEN/NOTIFY), usate per tenere allineate
+# le cache in memoria dei vari worker. Una sola connessione per worker ascolta tutti i canali
+# registrati con iscrivi(); ogni canale ha la sua callback per il payload e una funzione
+# per svuotare la cache quando la connessione cade o si riapre, perché nel frattempo
+# qualche notifica può essere andata persa.
+class Notifiche:
+    def __init__(self):
+        self.app = None
+        self.attive = False
+        self._db = None
+        self._canali = {}
+        self._lock = threading.Lock()
+        self._in_ascolto = False
+        self._ascoltatore = None
+
+    def init_app(self, app, db):
+        self.app = app
+        self._db = db
+        self.attive = app.config.setdefault('NOTIFICHE_POSTGRES', True)
+
+    def iscrivi(self, canale, ricevi, svuota):
+        self._canali[canale] = (ricevi, svuota)
+
+    @property
+    def in_ascolto(self):
+        # una cache condivisa tra worker è affidabile solo mentre si ricevono le notifiche
+        if not self.attive:
+            return False
+        self._avvia_ascoltatore()
+        return self._in_ascolto
+
+    def _avvia_ascoltatore(self):
+        if self._ascoltatore is not None:
+            return
+        with self._lock:
+            # parte al primo uso, così con gunicorn ogni worker ha il suo thread
+            if self._ascoltatore is None:
+                self._ascoltatore = threading.Thread(target=self._ascolta, name='notifiche-postgres', daemon=True)
+                self._ascoltatore.start()
+
+    def _svuota_tutto(self):
+        for _, svuota in self._canali.values():
+            svuota()
+
+    def _ascolta(self):
+        while True:
+            connessione = None
+            try:
+                with self.app.app_context():
+                    connessione = self._db.engine.raw_connection()
+                driver = connessione.driver_connection
+                # la connessione resta aperta per sempre, non deve tornare nel pool
+                connessione.detach()
+                driver.autocommit = True
+                with driver.cursor() as cursore:
+                    for canale in self._canali:
+                        cursore.execute(f"LISTEN {canale}")
+
+                self._svuota_tutto()
+                self._in_ascolto = True
+
+                while True:
+                    if select.select([driver], [], [], 60) == ([], [], []):
+                        # nessuna notifica: controllo che la connessione sia ancora viva
+                        with driver.cursor() as cursore:
+                            cursore.execute("SELECT 1")
+                        continue
+                    driver.poll()
+                    while driver.notifies:
+                        notifica = driver.notifies.pop(0)
+                        ricevi, _ = self._canali[notifica.channel]
+                        ricevi(notifica.payload)
+            except Exception as e:
+                self._in_ascolto = False
+                self._svuota_tutto()
+                self.app.logger.warning(f"Notifiche di Postgres interrotte, riprovo: {e}")
+                if connessione is not None:
+                    try:
+                        connessione.close()
+                    except Exception:
+                        pass
+                time.sleep(5)
+
+
+notifiche = Notifiche()
@@ -1,17 +1,39 @@
 import io
+import logging
+import threading
+from collections import OrderedDict
+
 import qrcode
 import requests
-from flask import current_app
-from flask_login import current_user
+from PIL import Image
 from reportlab.lib.pagesizes import letter
 from reportlab.lib.units import inch
 from reportlab.lib.colors import black
 from reportlab.lib.styles import getSampleStyleSheet, ParagraphStyle
-from reportlab.platypus import SimpleDocTemplate, Paragraph, Image as ReportlabImage, PageBreak
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+from reportlab.platypus import Paragraph
 from reportlab.lib.enums import TA_CENTER
+from .asset_cache import asset_cache
+
+# logger del modulo e non current_app.logger: queste funzioni girano anche nei processi
+# di rendering_parallelo, dove non c'è un contesto dell'app. Dentro Flask i messaggi
+# risalgono comunque al logger 'app'.
+logger = logging.getLogger(__name__)
 
 URL_LOGO = "https://res.cloudinary.com/dj5udxse6/image/upload/v1738162706/logo.webp"
 
+LARGHEZZA_PAGINA, ALTEZZA_PAGINA = letter
+MARGINE = inch
+LARGHEZZA_UTILE = LARGHEZZA_PAGINA - 2 * MARGINE
+
+# risoluzione a cui ricampiono logo e locandina: non serve tenerli più grandi
+# di come vengono stampati, e immagini più piccole fanno PDF più leggeri
+PIXEL_PER_PUNTO = 2
+
+# numero massimo di template tenuti in memoria
+MAX_TEMPLATE = 64
+
 
 def crea_stili_pdf():
 
@@ -62,83 +84,247 @@ def genera_qr_code(dati):
     return buffer_img
 
 
+# Versione vettoriale: invece di passare da un PNG prendo direttamente la matrice
+# del QR e la disegno come rettangoli nel PDF, senza codifica e decodifica dell'immagine
+def genera_matrice_qr(dati):
+    return genera_matrici_qr([dati])[0]
+
+
+# codifica tutti i QR di un ordine in un colpo solo: versione e maschera si scelgono una volta
+# sola (la versione sul testo più lungo, così va bene per tutti), perché provare le 8 maschere
+# per ogni QR è la parte più lenta della libreria. Qualsiasi maschera produce un QR valido.
+def genera_matrici_qr(lista_dati):
+    if not lista_dati:
+        return []
+
+    qr = qrcode.QRCode(
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        border=4
+    )
+    qr.add_data(max(lista_dati, key=len))
+    qr.make(fit=True)
+    versione = qr.version
+    maschera = qr.best_mask_pattern()
+
+    qr = qrcode.QRCode(
+        version=versione,
+        error_correction=qrcode.constants.ERROR_CORRECT_L,
+        border=4,
+        mask_pattern=maschera
+    )
+
+    matrici = []
+    for dati in lista_dati:
+        qr.clear()
+        qr.add_data(dati)
+        qr.make(fit=False)
+        matrici.append(qr.get_matrix())
+    return matrici
+
+
+def disegna_qr(pdf, matrice, x, y, lato):
+    modulo = lato / len(matrice)
+    percorso = pdf.beginPath()
+
+    # unisco i moduli neri consecutivi della stessa riga in un solo rettangolo
+    for indice_riga, riga in enumerate(matrice):
+        y_riga = y + lato - (indice_riga + 1) * modulo
+        inizio = None
+        for indice_colonna, nero in enumerate(riga + [False]):
+            if nero and inizio is None:
+                inizio = indice_colonna
+            elif not nero and inizio is not None:
+                percorso.rect(x + inizio * modulo, y_riga, (indice_colonna - inizio) * modulo, modulo)
+                inizio = None
+
+    pdf.setFillColor(black)
+    pdf.drawPath(percorso, stroke=0, fill=1)
+
+
 # scarico la copertina e salvo anche quella in memoria
+# passando dalla cache, così logo e locandine si scaricano una volta sola per worker
 def scarica_immagine(url):
     try:
-        response = requests.get(url)
-        response.raise_for_status()
-        return io.BytesIO(response.content)
+        return io.BytesIO(asset_cache.get(url))
     except requests.RequestException as e:
-        current_app.logger.error(f"Errore nel download dell'immagine: {e}")
+        logger.error(f"Errore nel download dell'immagine: {e}")
+        return None
+
+
+# preparo l'immagine una volta sola: la ridimensiono alla misura in cui verrà stampata
+# e la decodifico subito, così i documenti successivi la riusano già pronta
+def prepara_immagine(buffer_img, larghezza, altezza):
+    if buffer_img is None:
         return None
 
+    try:
+        img = Image.open(buffer_img)
+        img.load()
+        dimensione_massima = (int(larghezza * PIXEL_PER_PUNTO), int(altezza * PIXEL_PER_PUNTO))
+        if img.width > dimensione_massima[0] or img.height > dimensione_massima[1]:
+            img = img.resize(dimensione_massima, Image.LANCZOS)
+        if img.mode not in ('RGB', 'RGBA'):
+            img = img.convert('RGBA' if 'transparency' in img.info else 'RGB')
+
+        reader = ImageReader(img)
+        # forzo la decodifica adesso, dopo il reader viene solo letto
+        reader.getRGBData()
+        return reader
+    except Exception as e:
+        logger.error(f"Errore nella preparazione dell'immagine: {e}")
+        return None
+
+
+# Parte statica di una pagina del biglietto: logo, locandina, titolo del film, data, ora e sala.
+# È uguale per tutti i biglietti di una proiezione, quindi la preparo una volta sola
+# e in ogni documento la disegno in un unico form XObject richiamato da tutte le pagine.
+# Su ogni pagina poi stampo solo QR, nome e posto.
+class TemplateBiglietto:
+    def __init__(self, film, proiezione, sala):
+        self.logo = prepara_immagine(scarica_immagine(URL_LOGO), 1.5 * inch, 1.5 * inch)
+        self.locandina = prepara_immagine(scarica_immagine(film.url_copertina), 3 * inch, 4 * inch)
+        self.righe = [
+            f"Film: {film.titolo}",
+            f"Data: {proiezione.data_ora.strftime('%d/%m/%Y')}",
+            f"Ora: {proiezione.data_ora.strftime('%H:%M')}",
+            f"Sala: {sala.nome}",
+        ]
+
+    def disegna(self, pdf, id_ordine, stili):
+        # disegna la parte statica partendo dall'alto e ritorna la y da cui continuare
+        y = ALTEZZA_PAGINA - MARGINE
+
+        y -= 1.5 * inch
+        if self.logo:
+            pdf.drawImage(self.logo, LARGHEZZA_PAGINA - MARGINE - 1.5 * inch, y,
+                          width=1.5 * inch, height=1.5 * inch, mask='auto')
 
-def genera_biglietto_pdf(info_biglietti, id_ordine):
+        if self.locandina:
+            y -= 4 * inch
+            pdf.drawImage(self.locandina, (LARGHEZZA_PAGINA - 3 * inch) / 2, y,
+                          width=3 * inch, height=4 * inch, mask='auto')
+
+        y = disegna_paragrafo(pdf, f"Ordine ID: {id_ordine} - CINEMA PEGASUS", stili['TitoloCustom'], y)
+        for riga in self.righe:
+            y = disegna_paragrafo(pdf, riga, stili['SottotitoloCustom'], y)
+
+        return y
+
+
+_template_cache = OrderedDict()
+_template_lock = threading.Lock()
+
+
+# la chiave è la proiezione più l'url della copertina, che su cloudinary contiene la versione:
+# se cambia la locandina cambia anche la chiave. Aggiungo anche i testi, così se viene
+# spostata la proiezione o rinominata la sala non si stampa un template vecchio.
+def get_template(film, proiezione, sala):
+    chiave = (proiezione.id, film.url_copertina, film.titolo, proiezione.data_ora, sala.nome)
+
+    with _template_lock:
+        template = _template_cache.get(chiave)
+        if template is not None:
+            _template_cache.move_to_end(chiave)
+            return template
+
+    template = TemplateBiglietto(film, proiezione, sala)
+
+    with _template_lock:
+        _template_cache[chiave] = template
+        while len(_template_cache) > MAX_TEMPLATE:
+            _template_cache.popitem(last=False)
+
+    return template
+
+
+def disegna_paragrafo(pdf, testo, stile, y):
+    paragrafo = Paragraph(testo, stile)
+    _, altezza = paragrafo.wrap(LARGHEZZA_UTILE, ALTEZZA_PAGINA)
+    y -= stile.spaceBefore + altezza
+    paragrafo.drawOn(pdf, MARGINE, y)
+    return y - stile.spaceAfter
+
+
+def testo_qr(biglietto, film, proiezione):
+    return f"ID Biglietto: {biglietto.id}, Film: {film.titolo}, Data: {proiezione.data_ora}"
+
+
+def disegna_biglietto(pdf, info_biglietto, matrice_qr, id_ordine, intestatario, stili, form_definiti):
+    biglietto, film, proiezione, sala, posto = info_biglietto
+    template = get_template(film, proiezione, sala)
+
+    # form_definiti tiene, per ogni template già usato nel documento,
+    # il nome del form e la y da cui parte la parte variabile
+    if id(template) not in form_definiti:
+        nome_form = f"pagina{len(form_definiti)}"
+        pdf.beginForm(nome_form)
+        y_iniziale = template.disegna(pdf, id_ordine, stili)
+        pdf.endForm()
+        form_definiti[id(template)] = (nome_form, y_iniziale)
+
+    nome_form, y = form_definiti[id(template)]
+    pdf.doForm(nome_form)
+
+    y -= 1.5 * inch
+    disegna_qr(pdf, matrice_qr, (LARGHEZZA_PAGINA - 1.5 * inch) / 2, y, 1.5 * inch)
+
+    # Siccome il primo biglietto non è mai dell'ospite, sarà sempe dell'utente
+    # Per quelli che seguono invece se ci sono ospiti, prenderà prima loro.
+    # L'intestatario è passato esplicitamente perché il PDF si genera anche fuori dalla richiesta
+    nome_ospite = f"{biglietto.nome_ospite or intestatario.nome} {biglietto.cognome_ospite or intestatario.cognome}"
+
+    y = disegna_paragrafo(pdf, f"Nome: {nome_ospite}", stili['SottotitoloCustom'], y)
+    disegna_paragrafo(pdf, f"Posto: {posto.fila}{posto.numero}", stili['SottotitoloCustom'], y)
+
+    pdf.showPage()
+
+
+def genera_biglietto_pdf(info_biglietti, id_ordine, intestatario):
 
     if not info_biglietti:
         raise ValueError("Impossibile generare il PDF: nessun biglietto disponibile.")
 
     buffer_pdf = io.BytesIO()
-    documento = SimpleDocTemplate(buffer_pdf, pagesize=letter)
+    # invariant toglie data di creazione e ID casuale: a parità di contenuto il PDF
+    # è identico byte per byte, e lo storage può deduplicarlo con l'hash
+    pdf = canvas.Canvas(buffer_pdf, pagesize=letter, invariant=1)
     stili = crea_stili_pdf()
-    contenuto = []
-
-    for biglietto, film, proiezione, sala, posto in info_biglietti:
-        contenuto_pagina = []
-
-    # Scarico il logo e lo aggiungo
-        logo_bytes = scarica_immagine(URL_LOGO)
-        if logo_bytes:
-            try:
-                logo = ReportlabImage(logo_bytes, width=1.5 * inch, height=1.5 * inch)
-                logo.hAlign = 'RIGHT'
-                contenuto_pagina.append(logo)
-            except Exception as e:
-                current_app.logger.error(f"Errore nel caricamento del logo: {e}")
-
-        # Stessa cosa con la copertina del film del film
-        film_poster = scarica_immagine(film.url_copertina)
-        if film_poster:
-            try:
-                poster = ReportlabImage(film_poster, width=3 * inch, height=4 * inch)
-                poster.hAlign = 'CENTER'
-                contenuto_pagina.append(poster)
-            except Exception as e:
-                current_app.logger.error(f"Errore nel caricamento della locandina: {e}")
-
-        # Generazione del codice QR
-        dati_qr = f"ID Biglietto: {biglietto.id}, Film: {film.titolo}, Data: {proiezione.data_ora}"
-        qr_img = genera_qr_code(dati_qr)
-        immagine_qr = ReportlabImage(qr_img, width=1.5 * inch, height=1.5 * inch)
-        immagine_qr.hAlign = 'CENTER'
-
-        # Siccome il primo biglietto non è mai dell'ospite, sarà sempe dell'utente
-        # Per quelli che seguono invece se ci sono ospiti, prenderà prima loro.
-        nome_ospite = f"{biglietto.nome_ospite or current_user.nome} {biglietto.cognome_ospite or current_user.cognome}"
-
-        # Aggiunta dei dettagli del biglietto
-        contenuto_pagina.extend([
-            Paragraph(f"Ordine ID: {id_ordine} - CINEMA PEGASUS", stili['TitoloCustom']),
-            Paragraph(f"Film: {film.titolo}", stili['SottotitoloCustom']),
-            Paragraph(f"Data: {proiezione.data_ora.strftime('%d/%m/%Y')}", stili['SottotitoloCustom']),
-            Paragraph(f"Ora: {proiezione.data_ora.strftime('%H:%M')}", stili['SottotitoloCustom']),
-            Paragraph(f"Sala: {sala.nome}", stili['SottotitoloCustom']),
-            immagine_qr,
-            Paragraph(f"Nome: {nome_ospite}", stili['SottotitoloCustom']),
-            Paragraph(f"Posto: {posto.fila}{posto.numero}", stili['SottotitoloCustom']),
-        ])
-
-        # Aggiunta alla contenuto del documento
-        contenuto.extend(contenuto_pagina)
-        contenuto.append(PageBreak())
-
-    # Generazione del PDF
+    form_definiti = {}
+
+    # Generazione dei codici QR di tutto l'ordine
+    matrici_qr = genera_matrici_qr([testo_qr(b, f, p) for b, f, p, _, _ in info_biglietti])
+
     try:
-        documento.build(contenuto)
+        for info_biglietto, matrice_qr in zip(info_biglietti, matrici_qr):
+            disegna_biglietto(pdf, info_biglietto, matrice_qr, id_ordine, intestatario, stili, form_definiti)
+
+        # Generazione del PDF
+        pdf.save()
     except Exception as e:
-        current_app.logger.error(f"Errore nella generazione del PDF: {e}")
+        logger.error(f"Errore nella generazione del PDF: {e}")
         raise ValueError("Errore durante la creazione del PDF.")
 
     # seek riporta il cursore del buffer all'inizio.
     buffer_pdf.seek(0)
     return buffer_pdf
+
+
+# Come genera_biglietto_pdf, ma ogni biglietto finisce in un PDF di una pagina a sé:
+# servono come frammenti da ricomporre quando l'ordine cambia
+def genera_pagine_biglietti(info_biglietti, id_ordine, intestatario):
+    stili = crea_stili_pdf()
+    matrici_qr = genera_matrici_qr([testo_qr(b, f, p) for b, f, p, _, _ in info_biglietti])
+
+    pagine = []
+    try:
+        for info_biglietto, matrice_qr in zip(info_biglietti, matrici_qr):
+            buffer_pdf = io.BytesIO()
+            pdf = canvas.Canvas(buffer_pdf, pagesize=letter, invariant=1)
+            disegna_biglietto(pdf, info_biglietto, matrice_qr, id_ordine, intestatario, stili, {})
+            pdf.save()
+            pagine.append(buffer_pdf.getvalue())
+    except Exception as e:
+        logger.error(f"Errore nella generazione del PDF: {e}")
+        raise ValueError("Errore durante la creazione del PDF.")
+
+    return pagine
@@ -0,0 +1,44 @@
+import threading
+from collections import OrderedDict
+
+
+# Proiezioni future di ogni film già convertite in DTO, con la versione di 'proiezioni:<id_film>'
+# (versione_risorsa) con cui sono state lette: valgono finché la versione non cambia.
+# È un LRU limitato a max_film film; le liste vuote non si tengono, così chi chiede film
+# inesistenti (o senza proiezioni) non riempie la cache e per loro basta la query, che è vuota.
+class ProiezioniFilm:
+    def __init__(self, max_film=500):
+        self.max_film = max_film
+        self._voci = OrderedDict()
+        self._lock = threading.Lock()
+
+    def init_app(self, app):
+        self.max_film = app.config.setdefault('PROIEZIONI_MAX_FILM', self.max_film)
+
+    # Ritorna la lista salvata per questa versione, o None se va riletta
+    def get(self, id_film, versione):
+        with self._lock:
+            voce = self._voci.get(id_film)
+            if voce is None or voce[0] != versione:
+                return None
+            self._voci.move_to_end(id_film)
+            return voce[1]
+
+    def salva(self, id_film, versione, proiezioni):
+        if not proiezioni:
+            with self._lock:
+                self._voci.pop(id_film, None)
+            return
+
+        with self._lock:
+            self._voci[id_film] = (versione, proiezioni)
+            self._voci.move_to_end(id_film)
+            while len(self._voci) > self.max_film:
+                self._voci.popitem(last=False)
+
+    def svuota(self):
+        with self._lock:
+            self._voci.clear()
+
+
+proiezioni_film = ProiezioniFilm()
@@ -0,0 +1,71 @@
+import logging
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from types import SimpleNamespace
+
+from .pdf_utils import genera_pagine_biglietti
+
+
+# Rendering delle pagine dei biglietti su più processi, per gli ordini di gruppo
+# (gite scolastiche, proiezioni aziendali). Sotto la soglia PDF_SOGLIA_PARALLELA
+# non conviene: passare i dati ai processi costa più che renderizzare qualche pagina.
+# Il pool usa 'spawn' perché il processo principale ha già dei thread (gunicorn, coda dei PDF)
+# e fare fork in quella situazione può lasciare lock bloccati nei figli.
+# I processi non creano l'app: genera_pagine_biglietti lavora solo su SimpleNamespace
+# e la cache delle immagini si configura dalle variabili d'ambiente, che 'spawn' eredita.
+# Niente database, coda dei PDF o LISTEN/NOTIFY nei figli.
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _inizializza_processo(livello_log):
+    # solo il logging, con lo stesso livello del processo principale
+    logging.basicConfig(level=livello_log, format='[%(asctime)s] %(levelname)s in %(module)s (pid %(process)d): %(message)s')
+
+
+def _get_pool(processi):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = ProcessPoolExecutor(
+                max_workers=processi,
+                mp_context=multiprocessing.get_context('spawn'),
+                initializer=_inizializza_processo,
+                initargs=(logging.getLogger(__name__).getEffectiveLevel(),)
+            )
+        return _pool
+
+
+# I modelli SQLAlchemy non vanno passati agli altri processi:
+# copio solo i campi che servono per stampare il biglietto
+def _semplifica(info_biglietto):
+    biglietto, film, proiezione, sala, posto = info_biglietto
+    return (
+        SimpleNamespace(id=biglietto.id, nome_ospite=biglietto.nome_ospite, cognome_ospite=biglietto.cognome_ospite),
+        SimpleNamespace(titolo=film.titolo, url_copertina=film.url_copertina),
+        SimpleNamespace(id=proiezione.id, data_ora=proiezione.data_ora),
+        SimpleNamespace(nome=sala.nome),
+        SimpleNamespace(fila=posto.fila, numero=posto.numero),
+    )
+
+
+def genera_pagine_parallelo(info_biglietti, id_ordine, intestatario, processi=None):
+    processi = processi or os.cpu_count() or 1
+    info_semplici = [_semplifica(info) for info in info_biglietti]
+    intestatario_semplice = SimpleNamespace(nome=intestatario.nome, cognome=intestatario.cognome)
+
+    # divido i biglietti in blocchi contigui, uno per processo, così ogni processo
+    # prepara il template e sceglie versione e maschera dei QR una volta sola
+    dimensione_blocco = -(-len(info_semplici) // processi)
+    blocchi = [info_semplici[i:i + dimensione_blocco] for i in range(0, len(info_semplici), dimensione_blocco)]
+
+    pool = _get_pool(processi)
+    futures = [pool.submit(genera_pagine_biglietti, blocco, id_ordine, intestatario_semplice) for blocco in blocchi]
+
+    pagine = []
+    for future in futures:
+        pagine.extend(future.result())
+    return pagine
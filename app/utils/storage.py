@@ -0,0 +1,107 @@
+import hashlib
+import io
+import os
+import tempfile
+
+from flask import current_app
+
+from .cloudinary_utils import configure_cloudinary, esiste_su_cloudinary, upload_pdf_to_cloudinary, \
+    elimina_da_cloudinary, url_pdf_cloudinary, CARTELLA_PDF
+
+
+# Storage dei PDF dei biglietti indirizzato per contenuto: il nome del file è l'hash
+# SHA-256 dei byte, quindi due PDF identici finiscono nello stesso oggetto e non si
+# ricaricano mai. Le implementazioni devono solo sapere salvare, controllare ed
+# eliminare un oggetto a partire dalla sua chiave.
+class StorageBiglietti:
+    def salva(self, pdf_buffer):
+        contenuto = pdf_buffer.getvalue()
+        chiave = hashlib.sha256(contenuto).hexdigest() + '.pdf'
+
+        if not self.esiste(chiave):
+            self._carica(chiave, contenuto)
+
+        return self.url(chiave)
+
+    def elimina_url(self, url):
+        chiave = self.chiave_da_url(url)
+        if chiave:
+            self.elimina(chiave)
+
+    def chiave_da_url(self, url):
+        # gli URL che non sono nostri (ad esempio quelli vecchi con il nome a data) vengono ignorati
+        if not url or not url.startswith(self.url('')):
+            return None
+        return url[len(self.url('')):]
+
+    def esiste(self, chiave):
+        raise NotImplementedError
+
+    def url(self, chiave):
+        raise NotImplementedError
+
+    def elimina(self, chiave):
+        raise NotImplementedError
+
+    def _carica(self, chiave, contenuto):
+        raise NotImplementedError
+
+
+class StorageCloudinary(StorageBiglietti):
+    def __init__(self):
+        configure_cloudinary()
+
+    def esiste(self, chiave):
+        return esiste_su_cloudinary(f"{CARTELLA_PDF}/{chiave}")
+
+    def url(self, chiave):
+        return url_pdf_cloudinary(f"{CARTELLA_PDF}/{chiave}")
+
+    def elimina(self, chiave):
+        elimina_da_cloudinary(f"{CARTELLA_PDF}/{chiave}")
+
+    def _carica(self, chiave, contenuto):
+        upload_pdf_to_cloudinary(io.BytesIO(contenuto), f"{CARTELLA_PDF}/{chiave}")
+
+
+# Salva i PDF in una cartella locale, serviti da GET /api/biglietti/pdf/<chiave>.
+# Serve per far girare tutto il percorso d'acquisto offline (sviluppo e benchmark).
+class StorageLocale(StorageBiglietti):
+    def __init__(self, cartella, url_base):
+        self.cartella = cartella
+        self.url_base = url_base
+        os.makedirs(self.cartella, exist_ok=True)
+
+    def esiste(self, chiave):
+        return os.path.exists(self.percorso(chiave))
+
+    def url(self, chiave):
+        return self.url_base + chiave
+
+    def elimina(self, chiave):
+        try:
+            os.remove(self.percorso(chiave))
+        except FileNotFoundError:
+            pass
+
+    def percorso(self, chiave):
+        return os.path.join(self.cartella, chiave)
+
+    def _carica(self, chiave, contenuto):
+        fd, temporaneo = tempfile.mkstemp(dir=self.cartella)
+        with os.fdopen(fd, 'wb') as f:
+            f.write(contenuto)
+        os.replace(temporaneo, self.percorso(chiave))
+
+
+_storage = None
+
+
+def get_storage():
+    global _storage
+    if _storage is None:
+        if current_app.config['STORAGE_BIGLIETTI'] == 'locale':
+            _storage = StorageLocale(current_app.config['STORAGE_LOCALE_DIR'], current_app.config['STORAGE_LOCALE_URL'])
+        else:
+            _storage = StorageCloudinary()
+    return _storage
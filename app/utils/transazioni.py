@@ -0,0 +1,32 @@
+import random
+import time
+
+from flask import current_app
+from sqlalchemy.exc import DBAPIError
+
+from ..models import db
+
+# Errori di Postgres per cui ha senso rifare da capo la transazione:
+# serializzazione fallita, deadlock e lock_timeout scaduto
+ERRORI_TRANSITORI = {'40001', '40P01', '55P03'}
+
+
+def errore_transitorio(errore):
+    return isinstance(errore, DBAPIError) and getattr(errore.orig, 'pgcode', None) in ERRORI_TRANSITORI
+
+
+# Esegue funzione (che deve fare lei il commit) e, se la transazione fallisce per un errore
+# transitorio, fa rollback e riprova fino a TRANSAZIONE_TENTATIVI volte con un'attesa crescente
+# e un po' casuale, così i tentativi di più richieste non ripartono tutti insieme.
+# Gli altri errori, e l'ultimo tentativo fallito, arrivano al chiamante.
+def ripeti_transazione(funzione, tentativi=None):
+    tentativi = tentativi or current_app.config['TRANSAZIONE_TENTATIVI']
+    for tentativo in range(1, tentativi + 1):
+        try:
+            return funzione()
+        except DBAPIError as e:
+            if not errore_transitorio(e) or tentativo == tentativi:
+                raise
+            db.session.rollback()
+            current_app.logger.warning(f"Transazione ripetuta ({tentativo}/{tentativi}): {e.orig.pgcode}")
+            time.sleep(random.uniform(0, 0.05 * 2 ** tentativo))
@@ -0,0 +1,51 @@
+import threading
+
+from ..models import VersioneRisorsa, db
+from .notifiche import notifiche
+
+CANALE_VERSIONI = 'versioni_risorse'
+
+
+# Versioni delle risorse servite in GET, per rispondere 304 senza rifare query e serializzazione.
+# Il contatore sta nella tabella versione_risorsa ed è incrementato dai trigger; ogni worker
+# tiene in memoria le versioni che ha già letto e le dimentica quando arriva il NOTIFY
+# della risorsa. Senza notifiche (o mentre la connessione è giù) si legge sempre dal
+# database, che resta comunque una lettura per chiave primaria.
+class VersioniRisorse:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._versioni = {}
+        self._epoca = 0
+
+    def init_app(self, app):
+        notifiche.iscrivi(CANALE_VERSIONI, self._ricevi, self.svuota)
+
+    def get(self, risorsa):
+        # ritorna (versione, data dell'ultima modifica); (0, None) se la risorsa non è mai cambiata
+        in_ascolto = notifiche.in_ascolto
+        with self._lock:
+            if in_ascolto and risorsa in self._versioni:
+                return self._versioni[risorsa]
+            epoca = self._epoca
+
+        voce = db.session.get(VersioneRisorsa, risorsa)
+        versione = (voce.versione, voce.aggiornata) if voce else (0, None)
+
+        with self._lock:
+            # se nel frattempo è arrivata una notifica la lettura potrebbe essere già vecchia
+            if in_ascolto and epoca == self._epoca:
+                self._versioni[risorsa] = versione
+        return versione
+
+    def svuota(self):
+        with self._lock:
+            self._versioni.clear()
+            self._epoca += 1
+
+    def _ricevi(self, risorsa):
+        with self._lock:
+            self._versioni.pop(risorsa, None)
+            self._epoca += 1
+
+
+versioni = VersioniRisorse()
@@ -0,0 +1,192 @@
+# Stress test degli acquisti concorrenti sulla stessa proiezione.
+#
+# Più thread comprano gruppi di posti a caso su un'unica proiezione finché la sala non è
+# esaurita, passando dallo stesso percorso dell'endpoint di acquisto (lock sulla proiezione,
+# insert con ON CONFLICT, tentativi sugli errori transitori). Alla fine controlla che nessun
+# posto sia stato venduto due volte e che i biglietti in tabella siano esattamente quelli
+# degli acquisti andati a buon fine, poi stampa throughput e latenze.
+#
+# ATTENZIONE: come per la suite, il database indicato viene svuotato e ripopolato.
+#
+#   BENCHMARK_DATABASE_URI=postgresql://localhost/cinema_bench python -m benchmark.concorrenza --thread 12
+import argparse
+import os
+import random
+import sys
+import threading
+import time
+from datetime import datetime, timedelta
+
+from benchmark.suite import percentili
+
+
+def popola(file, posti_per_fila):
+    from werkzeug.security import generate_password_hash
+    from app import db
+    from app.models import User, Film, Sala, Posto, Proiezione
+
+    db.session.remove()
+    db.drop_all()
+    db.create_all()
+
+    utente = User('Utente', 'Concorrenza', 'concorrenza@example.com', generate_password_hash('concorrenza'))
+    film = Film(titolo='Film', regista='Regista', durata=120, url_copertina='http://127.0.0.1/locandina.jpg',
+                descrizione='Film usato dallo stress test', generi=['Azione'])
+    sala = Sala(nome='Sala Concorrenza', numero_posti=file * posti_per_fila)
+    db.session.add_all([utente, film, sala])
+    db.session.flush()
+
+    nomi_file = [chr(ord('A') + i) for i in range(file)]
+    id_posti = db.session.execute(db.insert(Posto).returning(Posto.id), [
+        {'id_sala': sala.id, 'fila': fila, 'numero': numero}
+        for fila in nomi_file for numero in range(1, posti_per_fila + 1)
+    ]).scalars().all()
+    proiezione = Proiezione(id_film=film.id, id_sala=sala.id, costo=8,
+                            data_ora=datetime.now().replace(microsecond=0) + timedelta(days=1))
+    db.session.add(proiezione)
+    db.session.commit()
+    return utente.id, proiezione.id, id_posti
+
+
+class Statistiche:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.acquisti = 0
+        self.biglietti = 0
+        self.posti_persi = 0
+        self.rifiutati = 0
+        self.errori = []
+        self.tempi = []
+
+    def registra(self, durata, biglietti=0, persi=0, errore=None):
+        with self.lock:
+            self.tempi.append(durata * 1000)
+            if errore:
+                self.errori.append(errore)
+            elif persi:
+                self.rifiutati += 1
+                self.posti_persi += persi
+            else:
+                self.acquisti += 1
+                self.biglietti += biglietti
+
+
+def compratore(app, id_utente, id_proiezione, id_posti, gruppo_massimo, venduti, statistiche, seme):
+    from app import db
+    from app.services.biglietti_service import BigliettiService, PostiNonDisponibili
+    from app.services.ordini_service import OrdiniService
+    from app.utils.transazioni import ripeti_transazione
+
+    casuale = random.Random(seme)
+    with app.app_context():
+        while len(venduti) < len(id_posti):
+            # sceglie tra i posti che crede liberi: come un client con la mappa un po' vecchia
+            liberi = [id_posto for id_posto in id_posti if id_posto not in venduti] or id_posti
+            scelti = casuale.sample(liberi, min(len(liberi), casuale.randint(1, gruppo_massimo)))
+
+            def acquisto():
+                ordine = OrdiniService.crea_ordine(id_utente, id_proiezione)
+                biglietti = BigliettiService.acquista_biglietto(
+                    id_utente, id_proiezione, [{'id_posto': id_posto} for id_posto in scelti], ordine.id)
+                db.session.commit()
+                return biglietti
+
+            inizio = time.perf_counter()
+            try:
+                biglietti = ripeti_transazione(acquisto)
+                statistiche.registra(time.perf_counter() - inizio, biglietti=len(biglietti))
+                venduti.update(scelti)
+            except PostiNonDisponibili as e:
+                db.session.rollback()
+                statistiche.registra(time.perf_counter() - inizio, persi=len(e.posti))
+                venduti.update(e.posti)
+            except Exception as e:
+                db.session.rollback()
+                statistiche.registra(time.perf_counter() - inizio, errore=repr(e))
+        db.session.remove()
+
+
+def verifica(id_proiezione, statistiche):
+    from app import db
+    from app.models import Biglietto, Ordine
+
+    biglietti, posti_distinti = db.session.query(
+        db.func.count(Biglietto.id), db.func.count(db.distinct(Biglietto.id_posto))
+    ).filter(Biglietto.id_proiezione == id_proiezione).one()
+    ordini_vuoti = Ordine.query.filter(
+        Ordine.id_proiezione == id_proiezione, ~Ordine.biglietti.any()
+    ).count()
+
+    problemi = []
+    if biglietti != posti_distinti:
+        problemi.append(f"{biglietti - posti_distinti} posti venduti più di una volta")
+    if biglietti != statistiche.biglietti:
+        problemi.append(f"{biglietti} biglietti in tabella, {statistiche.biglietti} acquisti confermati")
+    if ordini_vuoti:
+        problemi.append(f"{ordini_vuoti} ordini senza biglietti")
+    return biglietti, problemi
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Stress test degli acquisti concorrenti su una proiezione")
+    parser.add_argument('--thread', type=int, default=12,
+                        help="compratori concorrenti (il pool di SQLAlchemy ha 15 connessioni)")
+    parser.add_argument('--file', type=int, default=15)
+    parser.add_argument('--posti-per-fila', type=int, default=20)
+    parser.add_argument('--gruppo', type=int, default=4, help="posti massimi per acquisto")
+    args = parser.parse_args()
+
+    uri = os.environ.get('BENCHMARK_DATABASE_URI')
+    if not uri:
+        sys.exit("Imposta BENCHMARK_DATABASE_URI con un database di prova: verrà svuotato.")
+
+    os.environ.update({
+        'SQLALCHEMY_DATABASE_URI': uri,
+        'SECRET_KEY': os.environ.get('SECRET_KEY', 'benchmark'),
+        'PDF_ASINCRONO': '0',
+    })
+
+    from app import create_app
+    app = create_app()
+    with app.app_context():
+        id_utente, id_proiezione, id_posti = popola(args.file, args.posti_per_fila)
+
+    statistiche = Statistiche()
+    # posti che i compratori sanno già venduti, condiviso tra i thread (solo come suggerimento)
+    venduti = set()
+    thread = [
+        threading.Thread(target=compratore, args=(app, id_utente, id_proiezione, id_posti,
+                                                  args.gruppo, venduti, statistiche, i))
+        for i in range(args.thread)
+    ]
+    inizio = time.perf_counter()
+    for t in thread:
+        t.start()
+    for t in thread:
+        t.join()
+    durata = time.perf_counter() - inizio
+
+    with app.app_context():
+        biglietti, problemi = verifica(id_proiezione, statistiche)
+
+    tentativi = len(statistiche.tempi)
+    print(f"{args.thread} thread, {len(id_posti)} posti, esauriti in {durata:.2f} s")
+    print(f"acquisti riusciti  {statistiche.acquisti:6d}  ({statistiche.acquisti / durata:8.1f}/s)")
+    print(f"biglietti venduti  {biglietti:6d}  ({biglietti / durata:8.1f}/s)")
+    print(f"acquisti rifiutati {statistiche.rifiutati:6d}  ({statistiche.posti_persi} posti già venduti)")
+    print(f"errori             {len(statistiche.errori):6d}")
+    if tentativi:
+        latenze = percentili(statistiche.tempi)
+        print(f"latenza ms         p50 {latenze['p50']:.2f}  p90 {latenze['p90']:.2f}  p99 {latenze['p99']:.2f}"
+              f"  max {latenze['max']:.2f}")
+
+    for errore in statistiche.errori[:5]:
+        print(f"  errore: {errore}")
+    problemi += [f"{len(statistiche.errori)} acquisti falliti con un errore"] if statistiche.errori else []
+    if problemi:
+        sys.exit("VERIFICA FALLITA: " + "; ".join(problemi))
+    print("verifica ok: nessun posto venduto due volte")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,36 @@
+# Confronta due file di risultati di benchmark.suite e mostra la variazione del p50.
+#   python -m benchmark.confronta benchmark/risultati/prima.json benchmark/risultati/dopo.json
+import argparse
+import json
+
+
+def carica(percorso):
+    with open(percorso) as f:
+        dati = json.load(f)
+    return dati, {(r['nome'], json.dumps(r['parametri'], sort_keys=True)): r for r in dati['risultati']}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Confronto tra due esecuzioni di benchmark.suite")
+    parser.add_argument('prima')
+    parser.add_argument('dopo')
+    parser.add_argument('--soglia', type=float, default=10, help="variazione percentuale da segnalare")
+    args = parser.parse_args()
+
+    dati_prima, prima = carica(args.prima)
+    dati_dopo, dopo = carica(args.dopo)
+    print(f"{dati_prima['commit']} -> {dati_dopo['commit']}")
+
+    for chiave in prima:
+        if chiave not in dopo:
+            continue
+        p50_prima = prima[chiave]['latenza_ms']['p50']
+        p50_dopo = dopo[chiave]['latenza_ms']['p50']
+        variazione = (p50_dopo - p50_prima) / p50_prima * 100 if p50_prima else 0
+        segnale = ' <-- peggiorato' if variazione > args.soglia else ''
+        nome, parametri = chiave
+        print(f"{nome:<28} {parametri:<32} {p50_prima:9.2f} -> {p50_dopo:9.2f} ms ({variazione:+6.1f}%){segnale}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,66 @@
+# Confronto tra il QR come immagine PNG (genera_qr_code) e il QR vettoriale (disegna_qr).
+# Si lancia dalla root del progetto con:
+#   python -m benchmark.qr --biglietti 40 --ripetizioni 20
+import argparse
+import io
+import statistics
+import time
+
+from reportlab.lib.pagesizes import letter
+from reportlab.lib.units import inch
+from reportlab.lib.utils import ImageReader
+from reportlab.pdfgen import canvas
+
+from app.utils.pdf_utils import genera_qr_code, genera_matrici_qr, disegna_qr
+
+LATO = 1.5 * inch
+
+
+def dati_biglietti(n):
+    return [f"ID Biglietto: {i}, Film: Film di prova, Data: 2025-01-01 21:00:00" for i in range(n)]
+
+
+def pdf_png(lista_dati):
+    buffer_pdf = io.BytesIO()
+    pdf = canvas.Canvas(buffer_pdf, pagesize=letter)
+    for dati in lista_dati:
+        pdf.drawImage(ImageReader(genera_qr_code(dati)), inch, inch, width=LATO, height=LATO)
+        pdf.showPage()
+    pdf.save()
+    return buffer_pdf.getvalue()
+
+
+def pdf_vettoriale(lista_dati):
+    buffer_pdf = io.BytesIO()
+    pdf = canvas.Canvas(buffer_pdf, pagesize=letter)
+    for matrice in genera_matrici_qr(lista_dati):
+        disegna_qr(pdf, matrice, inch, inch, LATO)
+        pdf.showPage()
+    pdf.save()
+    return buffer_pdf.getvalue()
+
+
+def misura(funzione, lista_dati, ripetizioni):
+    tempi = []
+    for _ in range(ripetizioni):
+        inizio = time.perf_counter()
+        contenuto = funzione(lista_dati)
+        tempi.append((time.perf_counter() - inizio) * 1000)
+    return statistics.median(tempi), len(contenuto)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark QR PNG contro QR vettoriale")
+    parser.add_argument('--biglietti', type=int, default=10)
+    parser.add_argument('--ripetizioni', type=int, default=10)
+    args = parser.parse_args()
+
+    lista_dati = dati_biglietti(args.biglietti)
+    print(f"{args.biglietti} biglietti, mediana su {args.ripetizioni} ripetizioni")
+    for nome, funzione in (('png', pdf_png), ('vettoriale', pdf_vettoriale)):
+        mediana, dimensione = misura(funzione, lista_dati, args.ripetizioni)
+        print(f"{nome:>12}: {mediana:8.1f} ms  {dimensione / 1024:8.1f} KiB")
+
+
+if __name__ == '__main__':
+    main()
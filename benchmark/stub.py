@@ -0,0 +1,47 @@
+# Server HTTP locale che sostituisce il CDN delle immagini durante i benchmark,
+# così le misure non dipendono dalla rete.
+import io
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from PIL import Image
+
+
+def _immagine_di_prova(larghezza, altezza):
+    # un'immagine con del rumore comprime in modo simile a una locandina vera
+    buffer_img = io.BytesIO()
+    Image.effect_noise((larghezza, altezza), 40).convert('RGB').save(buffer_img, format='JPEG', quality=85)
+    return buffer_img.getvalue()
+
+
+class ServerImmagini:
+    def __init__(self, larghezza=600, altezza=800):
+        contenuto = _immagine_di_prova(larghezza, altezza)
+        self.richieste = 0
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                server.richieste += 1
+                self.send_response(200)
+                self.send_header('Content-Type', 'image/jpeg')
+                self.send_header('Content-Length', str(len(contenuto)))
+                self.send_header('ETag', '"benchmark"')
+                self.end_headers()
+                self.wfile.write(contenuto)
+
+            def log_message(self, *args):
+                pass
+
+        self._server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    def avvia(self):
+        self._thread.start()
+        return self
+
+    def url(self, nome):
+        return f"http://127.0.0.1:{self._server.server_port}/{nome}.jpg"
+
+    def ferma(self):
+        self._server.shutdown()
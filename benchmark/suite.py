@@ -0,0 +1,264 @@
+# Suite di benchmark del rendering dei biglietti e del percorso d'acquisto.
+#
+# ATTENZIONE: il database indicato in BENCHMARK_DATABASE_URI viene svuotato e ripopolato,
+# non usare quello di produzione. Download delle immagini e storage dei PDF sono sostituiti
+# da uno stub locale e da una cartella temporanea, quindi non serve la rete.
+#
+#   BENCHMARK_DATABASE_URI=postgresql://localhost/cinema_bench python -m benchmark.suite
+#
+# I risultati vengono salvati in JSON (di default in benchmark/risultati/) e due esecuzioni
+# si confrontano con `python -m benchmark.confronta prima.json dopo.json`.
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta
+
+CARTELLA_RISULTATI = os.path.join(os.path.dirname(__file__), 'risultati')
+
+
+def percentili(tempi):
+    ordinati = sorted(tempi)
+
+    def percentile(p):
+        # nearest-rank: con poche ripetizioni è più onesto di un'interpolazione
+        indice = max(0, min(len(ordinati) - 1, int(round(p / 100 * len(ordinati) + 0.5)) - 1))
+        return round(ordinati[indice], 3)
+
+    return {
+        'p50': percentile(50),
+        'p90': percentile(90),
+        'p99': percentile(99),
+        'min': round(ordinati[0], 3),
+        'max': round(ordinati[-1], 3),
+    }
+
+
+def misura(funzione, ripetizioni, prima=None, dopo=None):
+    # prima e dopo servono per preparare e ripulire ogni ripetizione senza misurarle
+    tempi = []
+    risultato = None
+    for _ in range(ripetizioni):
+        if prima:
+            prima()
+        inizio = time.perf_counter()
+        risultato = funzione()
+        tempi.append((time.perf_counter() - inizio) * 1000)
+        if dopo:
+            dopo()
+
+    # un'esecuzione in più con tracemalloc per le allocazioni, fuori dalle misure di tempo
+    if prima:
+        prima()
+    tracemalloc.start()
+    funzione()
+    corrente, picco = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    if dopo:
+        dopo()
+
+    return {
+        'latenza_ms': percentili(tempi),
+        'allocazioni': {'picco_kib': round(picco / 1024, 1), 'residuo_kib': round(corrente / 1024, 1)},
+    }, risultato
+
+
+def commit_corrente():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], text=True).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+class Benchmark:
+    def __init__(self, app, server, ripetizioni):
+        self.app = app
+        self.server = server
+        self.ripetizioni = ripetizioni
+        self.risultati = []
+
+    def registra(self, nome, parametri, misure, **extra):
+        voce = dict(nome=nome, parametri=parametri, **misure, **extra)
+        self.risultati.append(voce)
+        print(f"{nome:<28} {json.dumps(parametri):<32} p50 {misure['latenza_ms']['p50']:9.2f} ms"
+              f"  p90 {misure['latenza_ms']['p90']:9.2f} ms  picco {misure['allocazioni']['picco_kib']:9.1f} KiB")
+
+    # Dataset: un utente, qualche film, una sala da 120 posti e `numero_ordini` ordini
+    # da due biglietti ciascuno, distribuiti su proiezioni future. Più due proiezioni
+    # vuote usate per misurare acquisto e rendering.
+    def popola(self, numero_ordini):
+        from werkzeug.security import generate_password_hash
+        from app import db
+        from app.models import User, Film, Sala, Posto, Proiezione, Ordine, Biglietto, STATO_PDF_PRONTO
+
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+
+        utente = User('Utente', 'Benchmark', 'benchmark@example.com', generate_password_hash('benchmark'))
+        db.session.add(utente)
+        film = [
+            Film(titolo=f"Film {i}", regista='Regista', durata=120, url_copertina=self.server.url(f"locandina{i}"),
+                 descrizione='Film usato dai benchmark', generi=['Azione'])
+            for i in range(10)
+        ]
+        db.session.add_all(film)
+        sala = Sala(nome='Sala Benchmark', numero_posti=120)
+        db.session.add(sala)
+        db.session.flush()
+
+        db.session.execute(db.insert(Posto), [
+            {'id_sala': sala.id, 'fila': fila, 'numero': numero}
+            for fila in 'ABCDEFGHIJ' for numero in range(1, 13)
+        ])
+        posti = [p.id for p in Posto.query.filter_by(id_sala=sala.id).order_by(Posto.fila, Posto.numero)]
+
+        ordini_per_proiezione = len(posti) // 2
+        numero_proiezioni = numero_ordini // ordini_per_proiezione + 3
+        domani = datetime.now().replace(microsecond=0) + timedelta(days=1)
+        id_proiezioni = db.session.execute(db.insert(Proiezione).returning(Proiezione.id), [
+            {'id_film': film[i % len(film)].id, 'id_sala': sala.id, 'data_ora': domani + timedelta(hours=i), 'costo': 8}
+            for i in range(numero_proiezioni)
+        ]).scalars().all()
+
+        if numero_ordini:
+            id_ordini = db.session.execute(db.insert(Ordine).returning(Ordine.id), [
+                {'id_utente': utente.id, 'id_proiezione': id_proiezioni[i // ordini_per_proiezione],
+                 'data_acquisto': datetime.now() - timedelta(minutes=i), 'stato_pdf': STATO_PDF_PRONTO}
+                for i in range(numero_ordini)
+            ]).scalars().all()
+            db.session.execute(db.insert(Biglietto), [
+                {'id_proiezione': id_proiezioni[i // ordini_per_proiezione], 'id_utente': utente.id,
+                 'id_posto': posti[2 * (i % ordini_per_proiezione) + k], 'id_ordine': id_ordine}
+                for i, id_ordine in enumerate(id_ordini) for k in range(2)
+            ])
+
+        db.session.commit()
+        # le ultime due proiezioni restano vuote: una per l'acquisto e una per il rendering
+        return utente.id, posti, id_proiezioni[-2], id_proiezioni[-1]
+
+    def rendering_e_acquisto(self, dimensioni):
+        from app import db
+        from app.models import User, Ordine, Biglietto
+        from app.services.biglietti_service import BigliettiService
+        from app.services.ordini_service import OrdiniService
+        from app.utils.pdf_utils import genera_biglietto_pdf, genera_qr_code, genera_matrici_qr
+
+        id_utente, posti, proiezione_acquisto, proiezione_pdf = self.popola(0)
+        utente = db.session.get(User, id_utente)
+
+        misure, _ = misura(lambda: genera_qr_code("ID Biglietto: 1, Film: Film 0, Data: 2025-01-01 21:00:00"),
+                           self.ripetizioni)
+        self.registra('genera_qr_code', {}, misure)
+
+        for n in dimensioni:
+            if n > len(posti):
+                print(f"salto {n} biglietti: la sala ha solo {len(posti)} posti")
+                continue
+
+            dati = [f"ID Biglietto: {i}, Film: Film 0, Data: 2025-01-01 21:00:00" for i in range(n)]
+            misure, _ = misura(lambda: genera_matrici_qr(dati), self.ripetizioni)
+            self.registra('genera_matrici_qr', {'biglietti': n}, misure)
+
+            biglietti = [{'id_posto': id_posto} for id_posto in posti[:n]]
+
+            def acquista():
+                ordine = OrdiniService.crea_ordine(id_utente, proiezione_acquisto)
+                return BigliettiService.acquista_biglietto(id_utente, proiezione_acquisto, biglietti, ordine.id)
+
+            misure, _ = misura(acquista, self.ripetizioni, dopo=db.session.rollback)
+            self.registra('acquista_biglietto', {'biglietti': n}, misure)
+
+            ordine = OrdiniService.crea_ordine(id_utente, proiezione_pdf)
+            BigliettiService.acquista_biglietto(id_utente, proiezione_pdf, biglietti, ordine.id)
+            db.session.commit()
+            info_biglietti = OrdiniService._info_biglietti(ordine.id)
+
+            # il primo rendering scalda la cache delle immagini e dei template, non lo misuro
+            genera_biglietto_pdf(info_biglietti, ordine.id, utente)
+            misure, pdf = misura(lambda: genera_biglietto_pdf(info_biglietti, ordine.id, utente), self.ripetizioni)
+            self.registra('genera_biglietto_pdf', {'biglietti': n}, misure,
+                          dimensione_pdf_kib=round(len(pdf.getvalue()) / 1024, 1))
+
+            Biglietto.query.filter_by(id_ordine=ordine.id).delete()
+            Ordine.query.filter_by(id=ordine.id).delete()
+            db.session.commit()
+
+    def storico_ordini(self, dataset):
+        from flask_login import login_user
+        from app import db
+        from app.models import User
+        from app.services.ordini_service import OrdiniService
+
+        for numero_ordini in dataset:
+            id_utente, _, _, _ = self.popola(numero_ordini)
+            with self.app.test_request_context():
+                login_user(db.session.get(User, id_utente))
+                # la prima pagina, come la chiede il frontend
+                misure, (ordini, _) = misura(OrdiniService.get_ordini_utente, self.ripetizioni)
+            self.registra('get_ordini_utente', {'ordini': numero_ordini}, misure, risultati=len(ordini))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark del rendering dei biglietti e del percorso d'acquisto")
+    parser.add_argument('--dimensioni', default='1,5,10,20,50,100', help="numero di biglietti per ordine")
+    parser.add_argument('--dataset', default='10,100,1000', help="numero di ordini dell'utente nel database")
+    parser.add_argument('--ripetizioni', type=int, default=10)
+    parser.add_argument('--output', help="file JSON dei risultati")
+    args = parser.parse_args()
+
+    uri = os.environ.get('BENCHMARK_DATABASE_URI')
+    if not uri:
+        sys.exit("Imposta BENCHMARK_DATABASE_URI con un database di prova: verrà svuotato.")
+
+    # la configurazione va impostata prima di importare l'app,
+    # perché cache e archivi leggono l'ambiente all'import
+    cartella = tempfile.mkdtemp(prefix='cinema_benchmark_')
+    os.environ.update({
+        'SQLALCHEMY_DATABASE_URI': uri,
+        'SECRET_KEY': os.environ.get('SECRET_KEY', 'benchmark'),
+        'STORAGE_BIGLIETTI': 'locale',
+        'STORAGE_LOCALE_DIR': os.path.join(cartella, 'pdf'),
+        'ASSET_CACHE_DIR': os.path.join(cartella, 'asset'),
+        'PDF_FRAMMENTI_DIR': os.path.join(cartella, 'frammenti'),
+        'PDF_ASINCRONO': '0',
+    })
+
+    from benchmark.stub import ServerImmagini
+    from app import create_app
+    from app.utils import pdf_utils
+
+    server = ServerImmagini().avvia()
+    pdf_utils.URL_LOGO = server.url('logo')
+
+    app = create_app()
+    benchmark = Benchmark(app, server, args.ripetizioni)
+    with app.app_context():
+        benchmark.rendering_e_acquisto([int(n) for n in args.dimensioni.split(',')])
+        benchmark.storico_ordini([int(n) for n in args.dataset.split(',')])
+    server.ferma()
+
+    commit = commit_corrente()
+    output = args.output or os.path.join(
+        CARTELLA_RISULTATI, f"{datetime.now():%Y%m%d-%H%M%S}-{commit or 'sconosciuto'}.json")
+    os.makedirs(os.path.dirname(os.path.abspath(output)), exist_ok=True)
+    with open(output, 'w') as f:
+        json.dump({
+            'commit': commit,
+            'data': datetime.now().isoformat(),
+            'python': platform.python_version(),
+            'piattaforma': platform.platform(),
+            'ripetizioni': args.ripetizioni,
+            'download_immagini': server.richieste,
+            'risultati': benchmark.risultati,
+        }, f, indent=2)
+    print(f"Risultati salvati in {output}")
+
+
+if __name__ == '__main__':
+    main()
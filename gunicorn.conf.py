@@ -0,0 +1,27 @@
+import os
+
+# Configurazione di gunicorn, letta da sola se si lancia gunicorn dalla root del progetto.
+# L'API gira su worker gthread: le query, il lock sulla proiezione durante l'acquisto e il
+# rendering dei PDF (coda dei PDF e pool di processi) occupano solo il loro thread.
+# Gli stream SSE di /api/posti/stream invece restano aperti per minuti: vanno su una seconda
+# istanza con GUNICORN_WORKER_CLASS=gevent, a cui il proxy manda solo quel percorso
+# (vedi il README), così lì non arrivano mai acquisti né PDF da generare.
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+worker_class = os.environ.get('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+# con gthread: richieste servite insieme da ogni worker
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+# con gevent: stream aperti insieme da ogni worker
+worker_connections = int(os.environ.get('GUNICORN_WORKER_CONNECTIONS', 1000))
+
+
+def post_fork(server, worker):
+    if worker_class == 'gevent':
+        # psycopg2 è in C e senza questo ogni query blocca tutto il worker, con tutti i suoi stream:
+        # con la wait callback di psycogreen aspetta il database cedendo il posto agli altri greenlet.
+        # Il thread del LISTEN (utils/notifiche) diventa un greenlet e aspetta con select, che gevent
+        # ha già reso cooperativo.
+        from psycogreen.gevent import patch_psycopg
+
+        patch_psycopg()
+        server.log.info(f"Worker {worker.pid}: psycopg2 reso cooperativo per gevent")
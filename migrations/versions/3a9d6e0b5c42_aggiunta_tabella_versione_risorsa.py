@@ -0,0 +1,108 @@
+"""aggiunta tabella versione_risorsa e trigger delle versioni
+
+Revision ID: 3a9d6e0b5c42
+Revises: b4e8a1c62d17
+Create Date: 2026-10-18 12:20:05.386110
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '3a9d6e0b5c42'
+down_revision = 'b4e8a1c62d17'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('versione_risorsa',
+    sa.Column('risorsa', sa.String(length=64), nullable=False),
+    sa.Column('versione', sa.BigInteger(), nullable=False),
+    sa.Column('aggiornata', sa.DateTime(), nullable=False),
+    sa.PrimaryKeyConstraint('risorsa')
+    )
+
+    op.execute("""
+CREATE OR REPLACE FUNCTION incrementa_versione_risorsa(nome text) RETURNS void AS $$
+BEGIN
+    INSERT INTO versione_risorsa (risorsa, versione, aggiornata) VALUES (nome, 1, timezone('utc', now()))
+    ON CONFLICT (risorsa) DO UPDATE SET versione = versione_risorsa.versione + 1, aggiornata = timezone('utc', now());
+    PERFORM pg_notify('versioni_risorse', nome);
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION trigger_versione_film() RETURNS trigger AS $$
+BEGIN
+    PERFORM incrementa_versione_risorsa('film');
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION trigger_versione_proiezione() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM incrementa_versione_risorsa('proiezioni:' || OLD.id_film);
+    END IF;
+    IF TG_OP <> 'DELETE' AND (TG_OP = 'INSERT' OR NEW.id_film <> OLD.id_film) THEN
+        PERFORM incrementa_versione_risorsa('proiezioni:' || NEW.id_film);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE OR REPLACE FUNCTION trigger_versione_posto() RETURNS trigger AS $$
+BEGIN
+    IF TG_OP <> 'INSERT' THEN
+        PERFORM incrementa_versione_risorsa('sala:' || OLD.id_sala);
+    END IF;
+    IF TG_OP <> 'DELETE' AND (TG_OP = 'INSERT' OR NEW.id_sala <> OLD.id_sala) THEN
+        PERFORM incrementa_versione_risorsa('sala:' || NEW.id_sala);
+    END IF;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+-- il nome della sala compare nelle proiezioni e nella mappa dei posti
+CREATE OR REPLACE FUNCTION trigger_versione_sala() RETURNS trigger AS $$
+BEGIN
+    PERFORM incrementa_versione_risorsa('sala:' || NEW.id_sala);
+    PERFORM incrementa_versione_risorsa('proiezioni:' || id_film)
+        FROM (SELECT DISTINCT id_film FROM proiezione WHERE id_sala = NEW.id_sala) AS film_in_sala;
+    RETURN NULL;
+END
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS versione_film ON film;
+CREATE TRIGGER versione_film AFTER INSERT OR UPDATE OR DELETE ON film
+    FOR EACH STATEMENT EXECUTE FUNCTION trigger_versione_film();
+
+-- versione_occupazione cambia a ogni acquisto e non tocca l'elenco delle proiezioni
+DROP TRIGGER IF EXISTS versione_proiezione ON proiezione;
+CREATE TRIGGER versione_proiezione AFTER INSERT OR DELETE OR UPDATE OF id_film, id_sala, data_ora, costo
+    ON proiezione FOR EACH ROW EXECUTE FUNCTION trigger_versione_proiezione();
+
+DROP TRIGGER IF EXISTS versione_posto ON posto;
+CREATE TRIGGER versione_posto AFTER INSERT OR UPDATE OR DELETE ON posto
+    FOR EACH ROW EXECUTE FUNCTION trigger_versione_posto();
+
+DROP TRIGGER IF EXISTS versione_sala ON sala;
+CREATE TRIGGER versione_sala AFTER UPDATE OF nome ON sala
+    FOR EACH ROW EXECUTE FUNCTION trigger_versione_sala();
+""")
+
+
+def downgrade():
+    op.execute("""
+DROP TRIGGER IF EXISTS versione_sala ON sala;
+DROP TRIGGER IF EXISTS versione_posto ON posto;
+DROP TRIGGER IF EXISTS versione_proiezione ON proiezione;
+DROP TRIGGER IF EXISTS versione_film ON film;
+DROP FUNCTION IF EXISTS trigger_versione_sala();
+DROP FUNCTION IF EXISTS trigger_versione_posto();
+DROP FUNCTION IF EXISTS trigger_versione_proiezione();
+DROP FUNCTION IF EXISTS trigger_versione_film();
+DROP FUNCTION IF EXISTS incrementa_versione_risorsa(text);
+""")
+    op.drop_table('versione_risorsa')
@@ -0,0 +1,34 @@
+"""indici per filtri del catalogo
+
+Revision ID: 6b0e4f8d2a71
+Revises: f2c7a9d3e816
+Create Date: 2026-10-18 16:20:45.731902
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '6b0e4f8d2a71'
+down_revision = 'f2c7a9d3e816'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # serve un utente che possa creare estensioni (o pg_trgm già installata sul database)
+    op.execute("CREATE EXTENSION IF NOT EXISTS pg_trgm")
+
+    with op.batch_alter_table('film', schema=None) as batch_op:
+        batch_op.create_index('idx_film_generi', ['generi'], unique=False, postgresql_using='gin')
+        batch_op.create_index('idx_film_titolo_trgm', ['titolo'], unique=False, postgresql_using='gin',
+                              postgresql_ops={'titolo': 'gin_trgm_ops'})
+
+
+def downgrade():
+    with op.batch_alter_table('film', schema=None) as batch_op:
+        batch_op.drop_index('idx_film_titolo_trgm')
+        batch_op.drop_index('idx_film_generi')
+
+    # l'estensione resta: potrebbe usarla altro sul database
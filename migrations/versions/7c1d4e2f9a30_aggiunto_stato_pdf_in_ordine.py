@@ -0,0 +1,30 @@
+"""aggiunto stato_pdf in ordine
+
+Revision ID: 7c1d4e2f9a30
+Revises: 2db39b482a41
+Create Date: 2026-10-18 10:12:41.518302
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = '7c1d4e2f9a30'
+down_revision = '2db39b482a41'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # gli ordini già esistenti hanno il PDF generato in modo sincrono, quindi sono pronti
+    with op.batch_alter_table('ordine', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('stato_pdf', sa.String(length=20), nullable=False, server_default='pronto'))
+
+    with op.batch_alter_table('ordine', schema=None) as batch_op:
+        batch_op.alter_column('stato_pdf', server_default=None)
+
+
+def downgrade():
+    with op.batch_alter_table('ordine', schema=None) as batch_op:
+        batch_op.drop_column('stato_pdf')
@@ -0,0 +1,34 @@
+"""ricerca full text sui film
+
+Revision ID: a5d2c8e1f934
+Revises: 6b0e4f8d2a71
+Create Date: 2026-10-18 17:05:12.660318
+
+"""
+from alembic import op
+import sqlalchemy as sa
+from sqlalchemy.dialects import postgresql
+
+
+# revision identifiers, used by Alembic.
+revision = 'a5d2c8e1f934'
+down_revision = '6b0e4f8d2a71'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('film', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('ricerca', postgresql.TSVECTOR(), sa.Computed(
+            "setweight(to_tsvector('italian', coalesce(titolo, '')), 'A') || "
+            "setweight(to_tsvector('italian', coalesce(regista, '')), 'B') || "
+            "setweight(to_tsvector('italian', coalesce(descrizione, '')), 'C')",
+            persisted=True
+        ), nullable=True))
+        batch_op.create_index('idx_film_ricerca', ['ricerca'], unique=False, postgresql_using='gin')
+
+
+def downgrade():
+    with op.batch_alter_table('film', schema=None) as batch_op:
+        batch_op.drop_index('idx_film_ricerca')
+        batch_op.drop_column('ricerca')
@@ -0,0 +1,26 @@
+"""aggiunta versione_occupazione in proiezione
+
+Revision ID: b4e8a1c62d17
+Revises: 7c1d4e2f9a30
+Create Date: 2026-10-18 11:02:37.104215
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'b4e8a1c62d17'
+down_revision = '7c1d4e2f9a30'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('proiezione', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('versione_occupazione', sa.Integer(), nullable=False, server_default='0'))
+
+
+def downgrade():
+    with op.batch_alter_table('proiezione', schema=None) as batch_op:
+        batch_op.drop_column('versione_occupazione')
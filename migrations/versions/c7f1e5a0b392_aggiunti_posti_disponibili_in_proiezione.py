@@ -0,0 +1,53 @@
+"""aggiunti posti_disponibili in proiezione
+
+Revision ID: c7f1e5a0b392
+Revises: a5d2c8e1f934
+Create Date: 2026-10-18 18:21:40.735102
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'c7f1e5a0b392'
+down_revision = 'a5d2c8e1f934'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    with op.batch_alter_table('proiezione', schema=None) as batch_op:
+        batch_op.add_column(sa.Column('posti_disponibili', sa.Integer(), nullable=True))
+
+    op.execute("""
+UPDATE proiezione SET posti_disponibili =
+    (SELECT count(*) FROM posto WHERE posto.id_sala = proiezione.id_sala)
+    - (SELECT count(*) FROM biglietto WHERE biglietto.id_proiezione = proiezione.id_proiezione)
+""")
+
+    with op.batch_alter_table('proiezione', schema=None) as batch_op:
+        batch_op.alter_column('posti_disponibili', nullable=False)
+
+    # le nuove proiezioni partono dai posti della sala anche con un INSERT che non indica la colonna
+    op.execute("""
+CREATE OR REPLACE FUNCTION trigger_posti_disponibili() RETURNS trigger AS $$
+BEGIN
+    IF NEW.posti_disponibili IS NULL THEN
+        NEW.posti_disponibili := (SELECT count(*) FROM posto WHERE posto.id_sala = NEW.id_sala);
+    END IF;
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER posti_disponibili_proiezione BEFORE INSERT ON proiezione
+    FOR EACH ROW EXECUTE FUNCTION trigger_posti_disponibili();
+""")
+
+
+def downgrade():
+    op.execute("DROP TRIGGER IF EXISTS posti_disponibili_proiezione ON proiezione")
+    op.execute("DROP FUNCTION IF EXISTS trigger_posti_disponibili()")
+
+    with op.batch_alter_table('proiezione', schema=None) as batch_op:
+        batch_op.drop_column('posti_disponibili')
@@ -0,0 +1,38 @@
+"""aggiunta tabella blocco_posto
+
+Revision ID: d81f3b7e4a09
+Revises: 3a9d6e0b5c42
+Create Date: 2026-10-18 13:41:27.902554
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'd81f3b7e4a09'
+down_revision = '3a9d6e0b5c42'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    op.create_table('blocco_posto',
+    sa.Column('id_proiezione', sa.Integer(), nullable=False),
+    sa.Column('id_posto', sa.Integer(), nullable=False),
+    sa.Column('id_utente', sa.Integer(), nullable=False),
+    sa.Column('scadenza', sa.DateTime(), nullable=False),
+    sa.ForeignKeyConstraint(['id_posto'], ['posto.id_posto'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['id_proiezione'], ['proiezione.id_proiezione'], ondelete='CASCADE'),
+    sa.ForeignKeyConstraint(['id_utente'], ['utente.id_utente'], ondelete='CASCADE'),
+    sa.PrimaryKeyConstraint('id_proiezione', 'id_posto')
+    )
+    with op.batch_alter_table('blocco_posto', schema=None) as batch_op:
+        batch_op.create_index('idx_blocco_posto_utente', ['id_utente', 'id_proiezione'], unique=False)
+
+
+def downgrade():
+    with op.batch_alter_table('blocco_posto', schema=None) as batch_op:
+        batch_op.drop_index('idx_blocco_posto_utente')
+
+    op.drop_table('blocco_posto')
@@ -0,0 +1,30 @@
+"""indice storico ordini
+
+Revision ID: e9b3d7c4f158
+Revises: c7f1e5a0b392
+Create Date: 2026-10-18 19:02:57.118463
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'e9b3d7c4f158'
+down_revision = 'c7f1e5a0b392'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # sostituisce idx_ordine_utente, che ne è un prefisso
+    with op.batch_alter_table('ordine', schema=None) as batch_op:
+        batch_op.create_index('idx_ordine_utente_data',
+                              ['id_utente', sa.text('data_acquisto DESC'), sa.text('id_ordine DESC')], unique=False)
+        batch_op.drop_index('idx_ordine_utente')
+
+
+def downgrade():
+    with op.batch_alter_table('ordine', schema=None) as batch_op:
+        batch_op.create_index('idx_ordine_utente', ['id_utente'], unique=False)
+        batch_op.drop_index('idx_ordine_utente_data')
@@ -0,0 +1,38 @@
+"""vincolo unico posto per proiezione
+
+Revision ID: f2c7a9d3e816
+Revises: d81f3b7e4a09
+Create Date: 2026-10-18 15:02:11.418230
+
+"""
+from alembic import op
+import sqlalchemy as sa
+
+
+# revision identifiers, used by Alembic.
+revision = 'f2c7a9d3e816'
+down_revision = 'd81f3b7e4a09'
+branch_labels = None
+depends_on = None
+
+
+def upgrade():
+    # se ci sono già posti venduti due volte il vincolo non si può creare:
+    # meglio fermarsi con un messaggio chiaro che cancellare biglietti pagati
+    doppi = op.get_bind().execute(sa.text(
+        "SELECT id_proiezione, id_posto FROM biglietto "
+        "GROUP BY id_proiezione, id_posto HAVING count(*) > 1 LIMIT 20"
+    )).all()
+    if doppi:
+        raise RuntimeError(f"Posti venduti più volte (id_proiezione, id_posto): {doppi}. "
+                           f"Vanno sistemati a mano prima della migrazione.")
+
+    with op.batch_alter_table('biglietto', schema=None) as batch_op:
+        batch_op.create_unique_constraint('uq_biglietto_proiezione_posto', ['id_proiezione', 'id_posto'])
+        batch_op.drop_index('idx_biglietto_proiezione')
+
+
+def downgrade():
+    with op.batch_alter_table('biglietto', schema=None) as batch_op:
+        batch_op.create_index('idx_biglietto_proiezione', ['id_proiezione'], unique=False)
+        batch_op.drop_constraint('uq_biglietto_proiezione_posto', type_='unique')
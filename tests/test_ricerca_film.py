@@ -0,0 +1,111 @@
+import os
+
+import pytest
+
+from app import create_app, db
+from app.models import Film
+from app.services.film_service import FilmService
+
+# Ricerca dei film: l'indice in memoria usato fuori da Postgres deve comportarsi come la
+# ricerca full text del database (stesso ordine, stessa paginazione, HTML con l'escape).
+# Il confronto con Postgres gira solo se TEST_POSTGRES_URI punta a un database con lo schema
+# aggiornato (flask db upgrade): i film di prova si inseriscono in una transazione annullata alla fine.
+
+# "astronave" nel titolo e nel regista, solo nel titolo, solo nel regista, solo nella descrizione
+FILM = [
+    dict(titolo='Astronave & <i>co</i>', regista='Astronave Film', descrizione='Commedia spaziale'),
+    dict(titolo='Astronave perduta', regista='Gino Rossi', descrizione='Un viaggio tra le stelle'),
+    dict(titolo='Notte fonda', regista='Mario Astronave', descrizione='Un giallo in città'),
+    dict(titolo='Il ritorno', regista='Anna Neri', descrizione='Una astronave <script>alert(1)</script> torna a casa'),
+    dict(titolo='Senza parole', regista='Luca Verdi', descrizione='Un film muto'),
+]
+
+
+def _aggiungi_film():
+    film = [Film(durata=100, url_copertina='https://esempio.it/locandina.jpg', generi=['Fantascienza'], **dati)
+            for dati in FILM]
+    db.session.add_all(film)
+    db.session.flush()
+    return {f.titolo: f.id for f in film}
+
+
+def _crea_app(monkeypatch, uri):
+    monkeypatch.setenv('SQLALCHEMY_DATABASE_URI', uri)
+    monkeypatch.setenv('SECRET_KEY', 'test')
+    monkeypatch.setenv('NOTIFICHE_POSTGRES', '0')
+    return create_app()
+
+
+# Tutte le pagine di una ricerca: [(titolo, titolo_evidenziato, estratto), ...]
+def _tutte_le_pagine(testo, limite, id_film):
+    risultati, dopo = [], None
+    while True:
+        pagina, dopo = FilmService.cerca_film(testo, dopo, limite)
+        risultati.extend(r for r in pagina if r.id in id_film.values())
+        if dopo is None:
+            return [(r.titolo, r.titolo_evidenziato, r.estratto) for r in risultati]
+
+
+# un'unica app SQLite per il modulo: il catalogo in memoria da cui si costruisce l'indice è
+# condiviso dal processo e si ricostruisce solo quando cambia la versione dei film
+@pytest.fixture(scope='module')
+def app_indice():
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        app = _crea_app(monkeypatch, 'sqlite://')
+    with app.app_context():
+        assert db.engine.dialect.name == 'sqlite'
+        db.create_all()
+        id_film = _aggiungi_film()
+        db.session.commit()
+        yield id_film
+
+
+@pytest.fixture(scope='module')
+def risultati_indice(app_indice):
+    return _tutte_le_pagine('astronave', 2, app_indice)
+
+
+@pytest.fixture(scope='module')
+def risultati_postgres():
+    uri = os.environ.get('TEST_POSTGRES_URI')
+    if not uri:
+        pytest.skip('TEST_POSTGRES_URI non impostato')
+    with pytest.MonkeyPatch.context() as monkeypatch:
+        app = _crea_app(monkeypatch, uri)
+    with app.app_context():
+        try:
+            id_film = _aggiungi_film()
+            yield _tutte_le_pagine('astronave', 2, id_film)
+        finally:
+            db.session.rollback()
+
+
+def test_ordine_per_campo(risultati_indice):
+    # il titolo pesa più del regista, che pesa più della descrizione; senza la parola non c'è
+    assert [titolo for titolo, _, _ in risultati_indice] == [
+        'Astronave & <i>co</i>', 'Astronave perduta', 'Notte fonda', 'Il ritorno'
+    ]
+
+
+def test_escape_e_mark(risultati_indice):
+    evidenziati = {titolo: (titolo_evidenziato, estratto) for titolo, titolo_evidenziato, estratto in risultati_indice}
+    assert evidenziati['Astronave & <i>co</i>'][0] == '<mark>Astronave</mark> &amp; &lt;i&gt;co&lt;/i&gt;'
+    estratto = evidenziati['Il ritorno'][1]
+    assert '<mark>astronave</mark>' in estratto
+    assert '<script>' not in estratto and '&lt;script&gt;' in estratto
+
+
+def test_cursore_senza_doppioni(app_indice):
+    prima, dopo = FilmService.cerca_film('astronave', None, 3)
+    seconda, fine = FilmService.cerca_film('astronave', dopo, 3)
+    assert len(prima) == 3 and dopo == (prima[-1].punteggio, prima[-1].id)
+    assert [r.titolo for r in seconda] == ['Il ritorno'] and fine is None
+
+
+def test_come_postgres(risultati_indice, risultati_postgres):
+    assert [titolo for titolo, _, _ in risultati_postgres] == [titolo for titolo, _, _ in risultati_indice]
+    # con HighlightAll il titolo evidenziato è lo stesso; l'estratto di Postgres è solo un pezzo della descrizione
+    assert [t for _, t, _ in risultati_postgres] == [t for _, t, _ in risultati_indice]
+    for (_, _, estratto_pg), (_, _, estratto) in zip(risultati_postgres, risultati_indice):
+        assert '<script>' not in estratto_pg
+        assert ('<mark>' in estratto_pg) == ('<mark>' in estratto)
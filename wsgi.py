@@ -1,3 +1,8 @@
 from app import create_app
+from app.services.film_service import FilmService
 
-app = create_app()
\ No newline at end of file
+app = create_app()
+
+# il catalogo dei film si prepara all'avvio del worker invece che alla prima richiesta
+with app.app_context():
+    FilmService.precarica_catalogo()